@@ -0,0 +1,297 @@
+"""Retrieval benchmark for the semantic search
+
+The benchmark measures the effect of the `segmentor`, `embedding_model`, `vector_db` and `search`
+settings in the configuration file. The segments are those of the text database, so the `segmentor`
+settings are the ones it was built with, which are recorded in it by `make_raw_text.py` and
+`pipeline.py`. The benchmark fails if they are not those of the configuration file; rebuild the text
+database with `text_source.rebuild` to measure other settings. Indexes are built in
+`benchmark.work_folder`, so the databases of the scripts are not touched, and two corpora are run:
+
+* `swedish_monarchs`: the text database. The segments are embedded and indexed, and the queries go
+  through `SemanticSearcher`, as in the search scripts.
+* `synthetic_<n>`: n vectors made by adding noise to copies of the embeddings of the text database,
+  for each n in `benchmark.synthetic_sizes`. This measures the vector index at scales that would take
+  days to embed on CPU. The queries are embedded once and go to the vector index directly. The vectors
+  are generated and indexed in chunks, so the whole corpus is never in memory outside the index. The
+  backend is `benchmark.synthetic_backend`, by default `numpy`: Qdrant run locally keeps every point
+  in a Python object and searches exhaustively, which at a million vectors measures the local client
+  rather than the index. Set it to null to use `vector_db.backend`.
+
+The queries and their relevant texts are in `benchmark_queries.yaml`. A segment is relevant to a query
+if it belongs to one of the listed texts; a synthetic vector is relevant if the vector it is a copy of is.
+
+For each corpus, one JSON object is printed and appended to `benchmark.output_file`, with the
+indexing throughput, the query latency percentiles, the memory, and recall@k and MRR. The memory of
+the index is the size of the vectors searched in memory, in `compression_report`, and the change of
+the resident memory of the process while the index is built and while it is searched. The peak
+resident memory is not reported, since it is set by the embedding model and the largest corpus.
+
+"""
+import os
+import copy
+import json
+import time
+import sqlite3
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import yaml
+import numpy as np
+
+from embedding import embedding_model_id
+from vector_index import make_vector_index
+from semantic_searcher import SemanticSearcher
+from page_source import segmentor_settings, stored_segmentor_settings
+
+
+def _latency_percentiles(latencies: List[float]) -> Dict:
+    latencies_ms = 1000.0 * np.asarray(latencies)
+    return {
+        'latency_ms_p50': float(np.percentile(latencies_ms, 50)),
+        'latency_ms_p95': float(np.percentile(latencies_ms, 95)),
+        'latency_ms_p99': float(np.percentile(latencies_ms, 99)),
+        'latency_ms_mean': float(np.mean(latencies_ms)),
+    }
+
+
+def _relevance_metrics(retrieved: List[List[bool]], n_relevant: List[int], k: int) -> Dict:
+    """recall@k and MRR, given for each query whether each retrieved item is relevant
+
+    The recall is capped by k, so a query with more than k relevant items can reach 1.0.
+
+    """
+    recall = [sum(is_relevant[:k]) / min(k, n) for is_relevant, n in zip(retrieved, n_relevant) if n > 0]
+    reciprocal_rank = [
+        next((1.0 / rank for rank, is_relevant in enumerate(flags[:k], start=1) if is_relevant), 0.0)
+        for flags in retrieved
+    ]
+    return {
+        'k': k,
+        'recall_at_k': float(np.mean(recall)),
+        'mrr': float(np.mean(reciprocal_rank)),
+    }
+
+
+def _folder_bytes(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(folder, name))
+        for folder, _, names in os.walk(path) for name in names
+    )
+
+
+def _resident_memory_mb() -> Optional[float]:
+    """The current resident memory of the process, None where `/proc` is not available
+
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def _memory_change_mb(before: Optional[float], after: Optional[float]) -> Optional[float]:
+    return after - before if before is not None and after is not None else None
+
+
+def _chunks(ids: np.ndarray, vectors: np.ndarray, payloads: List[Dict], batch_size: int) -> Iterable[Tuple]:
+    for start in range(0, len(ids), batch_size):
+        yield ids[start:start + batch_size], vectors[start:start + batch_size], payloads[start:start + batch_size]
+
+
+def _synthetic_chunks(unit_vectors: np.ndarray,
+                      titles: List[str],
+                      n_synthetic: int,
+                      noise: float,
+                      rng: np.random.Generator,
+                      batch_size: int,
+                      ) -> Iterable[Tuple]:
+    """Generate the synthetic vectors in chunks, vector i + 1 a noisy copy of unit vector i modulo their number
+
+    """
+    dim = unit_vectors.shape[1]
+    for start in range(0, n_synthetic, batch_size):
+        source = np.arange(start, min(start + batch_size, n_synthetic)) % len(unit_vectors)
+        vectors = unit_vectors[source] + noise / np.sqrt(dim) * rng.standard_normal((len(source), dim), dtype=np.float32)
+        yield np.arange(start + 1, start + len(source) + 1), vectors, [{'title': titles[k_source]} for k_source in source]
+
+
+def _build_index(vector_index, dim: int, chunks: Iterable[Tuple]) -> float:
+    """Build the index from scratch from chunks of ids, vectors and payloads, and return the time it took
+
+    The time spent making the chunks is not included.
+
+    """
+    time_start = time.perf_counter()
+    vector_index.recreate(dim=dim)
+    time_index = time.perf_counter() - time_start
+    for ids, vectors, payloads in chunks:
+        time_start = time.perf_counter()
+        vector_index.upsert(ids=[int(point_id) for point_id in ids], vectors=vectors, payloads=payloads)
+        time_index += time.perf_counter() - time_start
+    time_start = time.perf_counter()
+    vector_index.compress()
+    return time_index + time.perf_counter() - time_start
+
+
+def _record(config: Dict, corpus: str, metrics: Dict) -> Dict:
+    return {
+        'time': datetime.now(timezone.utc).isoformat(),
+        'corpus': corpus,
+        'embedding_model': embedding_model_id(config),
+        'segmentor': segmentor_settings(config),
+        'vector_db_backend': config['vector_db']['backend'],
+        'vector_db_dtype': config['vector_db']['dtype'],
+        'compression': config['vector_db']['compression'],
+        'search_mode': config['search']['mode'],
+        **metrics,
+    }
+
+
+if __name__ == '__main__':
+    #
+    # Parse the configuration file, sql strings file and query set
+    with open('./conf.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+    with open('./sql_strings.yaml', 'r') as f:
+        sql_strings = yaml.safe_load(f)
+    benchmark_config = config['benchmark']
+    with open(benchmark_config['queries_file'], 'r') as f:
+        query_set = yaml.safe_load(f)['queries']
+    queries = [entry['query'] for entry in query_set]
+    relevant_titles = [set(entry['relevant_titles']) for entry in query_set]
+    k = benchmark_config['k']
+    batch_size = config['indexing']['batch_size']
+    records = []
+
+    #
+    # The text database corpus, searched through SemanticSearcher with the index in the work folder.
+    # The searcher returns the surrogate keys, which are compared to the relevant segments.
+    bench_config = copy.deepcopy(config)
+    bench_config['vector_db']['path'] = os.path.join(benchmark_config['work_folder'], 'swedish_monarchs')
+    bench_config['search']['output_keys'] = ['surrogate_key']
+    bench_config['search']['n_results'] = k
+    bench_config['embedding_cache']['enabled'] = benchmark_config['use_embedding_cache']
+    os.makedirs(benchmark_config['work_folder'], exist_ok=True)
+
+    conn = sqlite3.connect(config['text_source']['text_data_file'])
+    text_segmentor_settings = stored_segmentor_settings(conn, sql_strings)
+    if text_segmentor_settings != segmentor_settings(config):
+        raise ValueError('Segmentor settings of the text database {}, of the configuration file {}. '
+                         'Rebuild the text database with text_source.rebuild'.format(
+                             text_segmentor_settings, segmentor_settings(config)))
+    rows = conn.execute(sql_strings['sql_select_all']).fetchall()
+    conn.close()
+    ids = np.array([row[0] for row in rows])
+    titles = [row[3] for row in rows]
+    title_of_id = dict(zip(ids.tolist(), titles))
+
+    time_start = time.perf_counter()
+    searcher = SemanticSearcher(bench_config, sql_strings)
+    time_load = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    vectors = np.asarray(searcher.embedding_model.encode([row[5] for row in rows], batch_size=batch_size), dtype=np.float32)
+    time_embed = time.perf_counter() - time_start
+    memory_start = _resident_memory_mb()
+    time_index = _build_index(searcher.vector_index, vectors.shape[1], _chunks(
+        ids, vectors,
+        [{'title': row[3], 'url': row[4]} for row in rows],
+        batch_size,
+    ))
+    memory_index = _resident_memory_mb()
+
+    searcher.search(queries[:1])
+    latencies = []
+    results = None
+    for _ in range(benchmark_config['n_repeats']):
+        results = []
+        for query in queries:
+            time_start = time.perf_counter()
+            results.append(searcher.search([query])[0])
+            latencies.append(time.perf_counter() - time_start)
+    time_start = time.perf_counter()
+    searcher.search(queries)
+    time_batch = time.perf_counter() - time_start
+    memory_search = _resident_memory_mb()
+
+    records.append(_record(bench_config, 'swedish_monarchs', {
+        'n_segments': len(rows),
+        'n_queries': len(queries),
+        'model_load_sec': time_load,
+        'embed_segments_per_sec': len(rows) / time_embed,
+        'index_segments_per_sec': len(rows) / time_index,
+        **_latency_percentiles(latencies),
+        'batch_queries_per_sec': len(queries) / time_batch,
+        'index_bytes_on_disk': _folder_bytes(bench_config['vector_db']['path']),
+        'compression_report': searcher.vector_index.compression_report(k=k),
+        'index_build_memory_mb': _memory_change_mb(memory_start, memory_index),
+        'search_memory_mb': _memory_change_mb(memory_index, memory_search),
+        **_relevance_metrics(
+            [[title_of_id[segment['surrogate_key']] in relevant for segment in result]
+             for result, relevant in zip(results, relevant_titles)],
+            [sum(title in relevant for title in titles) for relevant in relevant_titles],
+            k,
+        ),
+    }))
+    print(json.dumps(records[-1]))
+
+    #
+    # The synthetic corpora, vector i + 1 a noisy copy of the embedding of segment i modulo the number of segments.
+    # The vectors of the text database are no longer needed, only their unit vectors
+    query_vectors = np.asarray(searcher.embedding_model.encode(queries), dtype=np.float32)
+    unit_vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    del vectors
+    rng = np.random.default_rng(benchmark_config['seed'])
+    for n_synthetic in benchmark_config['synthetic_sizes']:
+        synthetic_config = copy.deepcopy(bench_config)
+        synthetic_config['vector_db']['path'] = os.path.join(benchmark_config['work_folder'], 'synthetic_{}'.format(n_synthetic))
+        if benchmark_config.get('synthetic_backend') is not None:
+            synthetic_config['vector_db']['backend'] = benchmark_config['synthetic_backend']
+        vector_index = make_vector_index(synthetic_config)
+
+        memory_start = _resident_memory_mb()
+        time_index = _build_index(vector_index, unit_vectors.shape[1], _synthetic_chunks(
+            unit_vectors, titles, n_synthetic, benchmark_config['synthetic_noise'], rng, batch_size * 16,
+        ))
+        memory_index = _resident_memory_mb()
+
+        vector_index.search(query_vectors[:1], [k])
+        latencies = []
+        for _ in range(benchmark_config['n_repeats']):
+            results = []
+            for query_vector in query_vectors:
+                time_start = time.perf_counter()
+                results.append(vector_index.search(query_vector[np.newaxis], [k])[0])
+                latencies.append(time.perf_counter() - time_start)
+        time_start = time.perf_counter()
+        vector_index.search(query_vectors, [k] * len(queries))
+        time_batch = time.perf_counter() - time_start
+        memory_search = _resident_memory_mb()
+
+        source = np.arange(n_synthetic) % len(rows)
+        records.append(_record(synthetic_config, 'synthetic_{}'.format(n_synthetic), {
+            'n_segments': n_synthetic,
+            'n_queries': len(queries),
+            'index_segments_per_sec': n_synthetic / time_index,
+            **_latency_percentiles(latencies),
+            'batch_queries_per_sec': len(queries) / time_batch,
+            'index_bytes_on_disk': _folder_bytes(synthetic_config['vector_db']['path']),
+            'compression_report': vector_index.compression_report(k=k),
+            'index_build_memory_mb': _memory_change_mb(memory_start, memory_index),
+            'search_memory_mb': _memory_change_mb(memory_index, memory_search),
+            **_relevance_metrics(
+                [[titles[(hit.id - 1) % len(rows)] in relevant for hit in result]
+                 for result, relevant in zip(results, relevant_titles)],
+                [sum(titles[k_source] in relevant for k_source in source) for relevant in relevant_titles],
+                k,
+            ),
+        }))
+        vector_index.close()
+        print(json.dumps(records[-1]))
+
+    with open(benchmark_config['output_file'], 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
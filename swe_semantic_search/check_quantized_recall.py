@@ -0,0 +1,87 @@
+"""Check the accuracy loss of the quantized embedding model against the full precision model
+
+The text segments of the text database are embedded with both the `torch` and the `onnx_int8`
+backend. For a set of queries, the top-k segments by cosine similarity are found with each, and
+the recall@k of the quantized model is the fraction of the full precision top-k it retrieves.
+The queries are the query in the configuration file and the first words of a fixed random sample
+of the segments. The embedding throughput of both backends is reported as well, so the speedup can
+be weighed against the loss of recall.
+
+"""
+import copy
+import json
+import time
+import random
+import sqlite3
+
+import yaml
+import numpy as np
+
+from embedding import load_sentence_transformer
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def _top_k(query_vectors: np.ndarray, corpus_vectors: np.ndarray, k: int) -> np.ndarray:
+    scores = query_vectors @ corpus_vectors.T
+    return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+
+#
+# Parse the configuration file and sql strings file
+with open('./conf.yaml', 'r') as f:
+    config = yaml.safe_load(f)
+with open('./sql_strings.yaml', 'r') as f:
+    sql_strings = yaml.safe_load(f)
+check_config = config['quantization_check']
+k = check_config['k']
+
+#
+# The corpus is all text segments, the queries a fixed sample of them shortened to their first words
+conn = sqlite3.connect(config['text_source']['text_data_file'])
+corpus = [row[5] for row in conn.execute(sql_strings['sql_select_all'])]
+conn.close()
+sample = random.Random(check_config['seed']).sample(corpus, min(check_config['n_queries'], len(corpus)))
+queries = [config['search']['my_query']] + [' '.join(text.split()[:check_config['n_query_words']]) for text in sample]
+
+#
+# Embed corpus and queries with both backends
+results = {}
+for backend in ('torch', 'onnx_int8'):
+    backend_config = copy.deepcopy(config)
+    backend_config['embedding_model']['backend'] = backend
+    model = load_sentence_transformer(backend_config)
+
+    time_start = time.perf_counter()
+    corpus_vectors = _normalize(model.encode(corpus, batch_size=config['indexing']['batch_size']))
+    time_elapsed = time.perf_counter() - time_start
+    query_vectors = _normalize(model.encode(queries))
+    results[backend] = {
+        'corpus_vectors': corpus_vectors,
+        'top_k': _top_k(query_vectors, corpus_vectors, k),
+        'segments_per_sec': len(corpus) / time_elapsed,
+    }
+
+#
+# Compare the top-k of the quantized model to that of the full precision model
+recall = np.mean([
+    len(set(top_quantized) & set(top_reference)) / k
+    for top_quantized, top_reference in zip(results['onnx_int8']['top_k'], results['torch']['top_k'])
+])
+cosine = np.sum(results['onnx_int8']['corpus_vectors'] * results['torch']['corpus_vectors'], axis=1)
+
+print(json.dumps({
+    'model': config['embedding_model']['model_name_or_path'],
+    'quantization_config': config['embedding_model']['quantization_config'],
+    'n_segments': len(corpus),
+    'n_queries': len(queries),
+    'k': k,
+    'recall_at_k': float(recall),
+    'mean_cosine_to_fp32': float(np.mean(cosine)),
+    'min_cosine_to_fp32': float(np.min(cosine)),
+    'fp32_segments_per_sec': results['torch']['segments_per_sec'],
+    'int8_segments_per_sec': results['onnx_int8']['segments_per_sec'],
+    'speedup': results['onnx_int8']['segments_per_sec'] / results['torch']['segments_per_sec'],
+}, indent=2))
@@ -0,0 +1,168 @@
+"""Load the embedding model as configured
+
+Two backends are available, selected by `embedding_model.backend` in the configuration file:
+
+* `torch`: the model in full precision with PyTorch
+* `onnx_int8`: the model exported to ONNX and dynamically quantized to int8, which is faster on CPU.
+  The export is done once and stored in `embedding_model.export_folder`. The loss of accuracy can be
+  checked with `check_quantized_recall.py`.
+
+"""
+import os
+import resource
+import multiprocessing
+from typing import Dict, List
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from embedding_cache import EmbeddingCache, CachedEmbeddingModel
+
+
+def embedding_model_id(config: Dict) -> str:
+    """The identity of the embeddings the configured model makes, the model name and the backend if not the default
+
+    """
+    model_config = config['embedding_model']
+    backend = model_config.get('backend', 'torch')
+    if backend == 'torch':
+        return model_config['model_name_or_path']
+    return '{}#{}_{}'.format(model_config['model_name_or_path'], backend, model_config['quantization_config'])
+
+
+def load_sentence_transformer(config: Dict) -> SentenceTransformer:
+    """Load the model with the configured backend, exporting and quantizing it first if needed
+
+    The model is not wrapped in the embedding cache, see `load_embedding_model`, so it can be used to
+    compare the backends on the same texts.
+
+    """
+    model_config = config['embedding_model']
+    backend = model_config.get('backend', 'torch')
+    if backend == 'torch':
+        return SentenceTransformer(
+            model_name_or_path=model_config['model_name_or_path'],
+            cache_folder=model_config['cache_folder'],
+        )
+
+    elif backend == 'onnx_int8':
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+
+        export_folder = model_config['export_folder']
+        quantization_config = model_config['quantization_config']
+        file_name = 'onnx/model_qint8_{}.onnx'.format(quantization_config)
+        if not os.path.exists(os.path.join(export_folder, file_name)):
+            onnx_model = SentenceTransformer(
+                model_name_or_path=model_config['model_name_or_path'],
+                cache_folder=model_config['cache_folder'],
+                backend='onnx',
+            )
+            onnx_model.save(export_folder)
+            export_dynamic_quantized_onnx_model(onnx_model, quantization_config, export_folder)
+
+        return SentenceTransformer(
+            model_name_or_path=export_folder,
+            backend='onnx',
+            model_kwargs={'file_name': file_name},
+        )
+
+    else:
+        raise ValueError('Unknown embedding model backend: {}'.format(backend))
+
+
+#
+# The model of a worker process of the ParallelEncoder, loaded once per process
+_worker_model = None
+
+
+def _init_worker(config: Dict, n_threads: int):
+    global _worker_model
+    import torch
+    torch.set_num_threads(n_threads)
+    _worker_model = load_sentence_transformer(config)
+
+
+def _worker_dimension() -> int:
+    return _worker_model.get_sentence_embedding_dimension()
+
+
+def _worker_encode(args):
+    sentences, kwargs = args
+    embeddings = _worker_model.encode(sentences, **kwargs)
+    return embeddings, os.getpid(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class ParallelEncoder:
+    """Embedding model run in a pool of worker processes
+
+    Each worker loads the model once. The sentences of a call to `encode` are split in contiguous
+    shards, one per worker, and the embeddings are gathered back in the order of the sentences.
+    The workers are forked, so that the scripts, which run at module level, are not re-executed
+    in the workers.
+
+    Args:
+        config (Dict): The parsed configuration file
+        n_workers (int): The number of worker processes
+        n_threads_per_worker (int): The number of threads of the model in each worker
+
+    """
+    def __init__(self, config: Dict, n_workers: int, n_threads_per_worker: int = 1):
+        self.n_workers = n_workers
+        self.peak_memory_kb = {}
+        self._pool = multiprocessing.get_context('fork').Pool(
+            processes=n_workers,
+            initializer=_init_worker,
+            initargs=(config, n_threads_per_worker),
+        )
+        self._dimension = self._pool.apply(_worker_dimension)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dimension
+
+    def encode(self, sentences: List[str], **kwargs) -> np.ndarray:
+        if len(sentences) == 0:
+            return np.empty((0, self._dimension), dtype=np.float32)
+        shard_size = -(-len(sentences) // self.n_workers)
+        shards = [sentences[k:k + shard_size] for k in range(0, len(sentences), shard_size)]
+        embeddings = []
+        for shard_embeddings, pid, peak_memory_kb in self._pool.map(_worker_encode, [(shard, kwargs) for shard in shards]):
+            embeddings.append(shard_embeddings)
+            self.peak_memory_kb[pid] = max(self.peak_memory_kb.get(pid, 0), peak_memory_kb)
+        return np.concatenate(embeddings, axis=0)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+def load_embedding_model(config: Dict, n_workers: int = 1):
+    """Load the embedding model, wrapped in the embedding cache if the cache is enabled
+
+    Args:
+        config (Dict): The parsed configuration file
+        n_workers (int): The number of processes the model is run in. If more than one, the
+            model is run in a `ParallelEncoder`.
+
+    """
+    if n_workers > 1:
+        embedding_model = ParallelEncoder(
+            config=config,
+            n_workers=n_workers,
+            n_threads_per_worker=config['indexing']['n_threads_per_worker'],
+        )
+    else:
+        embedding_model = load_sentence_transformer(config)
+
+    cache_config = config.get('embedding_cache', {})
+    if cache_config.get('enabled', False):
+        embedding_model = CachedEmbeddingModel(
+            model=embedding_model,
+            cache=EmbeddingCache(
+                path=cache_config['path'],
+                model_name=embedding_model_id(config),
+                dim=embedding_model.get_sentence_embedding_dimension(),
+                max_entries=cache_config['max_entries'],
+            ),
+        )
+
+    return embedding_model
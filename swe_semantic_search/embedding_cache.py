@@ -0,0 +1,209 @@
+"""Persistent cache of text embeddings on disk
+
+The embeddings are content-addressed: the key is the model name and a hash of the text. The vectors
+are stored in a memory-mapped array with a fixed number of slots, one array per model, and a small
+SQLite index maps keys to slots. When all slots are taken, the least recently used entries are evicted.
+
+The cache is shared by the scripts, which can run at the same time in several processes. The lookups
+and the allocation of slots are therefore done in write transactions of the SQLite index, which are
+exclusive across processes, and a vector is written to its slot in the transaction that claims it.
+
+"""
+import os
+import re
+import hashlib
+import sqlite3
+from contextlib import contextmanager
+from typing import List, Callable
+
+import numpy as np
+
+SQL_CREATE = '''
+CREATE TABLE IF NOT EXISTS embedding (
+  model_name TEXT NOT NULL,
+  text_hash TEXT NOT NULL,
+  slot INTEGER NOT NULL,
+  last_used INTEGER NOT NULL,
+  PRIMARY KEY (model_name, text_hash)
+);
+'''
+SQL_CREATE_SLOT_INDEX = 'CREATE INDEX IF NOT EXISTS embedding_last_used ON embedding (model_name, last_used);'
+SQL_SELECT_SLOT = 'SELECT slot FROM embedding WHERE model_name = ? AND text_hash = ?;'
+SQL_COUNT = 'SELECT COUNT(*) FROM embedding WHERE model_name = ?;'
+SQL_SELECT_LAST_USED = 'SELECT MAX(last_used) FROM embedding;'
+SQL_SELECT_OLDEST = 'SELECT text_hash, slot FROM embedding WHERE model_name = ? ORDER BY last_used LIMIT ?;'
+SQL_INSERT = 'INSERT OR REPLACE INTO embedding (model_name, text_hash, slot, last_used) VALUES (?, ?, ?, ?);'
+SQL_TOUCH = 'UPDATE embedding SET last_used = ? WHERE model_name = ? AND text_hash = ?;'
+SQL_DELETE = 'DELETE FROM embedding WHERE model_name = ? AND text_hash = ?;'
+SQL_CLEAR = 'DELETE FROM embedding WHERE model_name = ?;'
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache for one model
+
+    Args:
+        path (str): The folder in which the vectors and the index are stored
+        model_name (str): The name of the embedding model, part of the cache key
+        dim (int): The dimension of the embeddings
+        max_entries (int): The maximum number of embeddings in the cache for the model
+        dtype (str): The data type of the stored embeddings
+
+    """
+    def __init__(self,
+                 path: str,
+                 model_name: str,
+                 dim: int,
+                 max_entries: int,
+                 dtype: str = 'float32',
+                 ):
+        self.model_name = model_name
+        self.dim = dim
+        self.max_entries = max_entries
+        self.dtype = np.dtype(dtype)
+        self.n_hits = 0
+        self.n_misses = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(path, 'index.db'), timeout=60.0, isolation_level=None)
+        self._conn.execute(SQL_CREATE)
+        self._conn.execute(SQL_CREATE_SLOT_INDEX)
+        self._clock = (self._conn.execute(SQL_SELECT_LAST_USED).fetchone()[0] or 0) + 1
+
+        #
+        # One array per model. If the shape of an existing array does not agree with the
+        # settings it cannot be reused, and the entries of the model are dropped from the index
+        vectors_file = os.path.join(path, '{}.{}.{}'.format(re.sub(r'[^\w.-]', '_', model_name), dim, self.dtype.name))
+        shape = (max_entries, dim)
+        with self._transaction():
+            if os.path.exists(vectors_file) and os.path.getsize(vectors_file) == max_entries * dim * self.dtype.itemsize:
+                self._vectors = np.memmap(vectors_file, dtype=self.dtype, mode='r+', shape=shape)
+            else:
+                self._vectors = np.memmap(vectors_file, dtype=self.dtype, mode='w+', shape=shape)
+                self._conn.execute(SQL_CLEAR, (model_name,))
+
+    def __len__(self):
+        return self._conn.execute(SQL_COUNT, (self.model_name,)).fetchone()[0]
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction of the index, which excludes the other processes that use the cache
+
+        """
+        self._conn.execute('BEGIN IMMEDIATE;')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK;')
+            raise
+        self._conn.execute('COMMIT;')
+
+    def _allocate_slots(self, n: int) -> List[int]:
+        """Return n free slots, evicting the least recently used entries if needed
+
+        Slots are handed out in order and an evicted slot is reused at once, so the
+        slots in use are always the first `len(self)` ones. Call in a transaction, in which the
+        slots are claimed.
+
+        """
+        n_used = len(self)
+        free_slots = list(range(n_used, min(n_used + n, self.max_entries)))
+        n_evict = n - len(free_slots)
+        if n_evict > 0:
+            evicted = self._conn.execute(SQL_SELECT_OLDEST, (self.model_name, n_evict)).fetchall()
+            self._conn.executemany(SQL_DELETE, [(self.model_name, hash_value) for hash_value, _ in evicted])
+            free_slots.extend(slot for _, slot in evicted)
+        return free_slots
+
+    def encode(self, texts: List[str], encode_func: Callable, **kwargs) -> np.ndarray:
+        """Return the embeddings of the texts, computing only those not in the cache
+
+        Args:
+            texts (List[str]): The texts to embed
+            encode_func (Callable): The function that embeds a list of texts, e.g. `SentenceTransformer.encode`
+            **kwargs: Keyword arguments passed to `encode_func`. They are not part of the cache key.
+
+        """
+        hashes = [text_hash(text) for text in texts]
+        embeddings = np.empty((len(texts), self.dim), dtype=self.dtype)
+
+        #
+        # Copy the cached vectors. This is done before new vectors are stored, so the
+        # eviction below cannot overwrite a slot that is read in this call
+        tick = self._tick()
+        misses = {}
+        with self._transaction():
+            for k, hash_value in enumerate(hashes):
+                slot = self._conn.execute(SQL_SELECT_SLOT, (self.model_name, hash_value)).fetchone()
+                if slot is None:
+                    misses.setdefault(hash_value, []).append(k)
+                else:
+                    embeddings[k] = self._vectors[slot[0]]
+            self._conn.executemany(SQL_TOUCH, [
+                (tick, self.model_name, hash_value) for hash_value in set(hashes) if hash_value not in misses
+            ])
+        self.n_hits += len(texts) - sum(len(inds) for inds in misses.values())
+        self.n_misses += len(misses)
+
+        #
+        # Embed the texts not in the cache, each distinct text once
+        if len(misses) > 0:
+            miss_hashes = list(misses)
+            miss_embeddings = np.asarray(
+                encode_func([texts[misses[hash_value][0]] for hash_value in miss_hashes], **kwargs),
+                dtype=self.dtype,
+            )
+            for hash_value, embedding in zip(miss_hashes, miss_embeddings):
+                embeddings[misses[hash_value]] = embedding
+
+            #
+            # Claim the slots and write the vectors to them. Texts stored by another process since
+            # the lookup are not stored again
+            with self._transaction():
+                store = [
+                    (hash_value, embedding) for hash_value, embedding in zip(miss_hashes, miss_embeddings)
+                    if self._conn.execute(SQL_SELECT_SLOT, (self.model_name, hash_value)).fetchone() is None
+                ][-self.max_entries:]
+                slots = self._allocate_slots(len(store))
+                self._conn.executemany(SQL_INSERT, [
+                    (self.model_name, hash_value, slot, tick)
+                    for (hash_value, _), slot in zip(store, slots)
+                ])
+                for (_, embedding), slot in zip(store, slots):
+                    self._vectors[slot] = embedding
+                self._vectors.flush()
+
+        return embeddings
+
+    def close(self):
+        self._vectors.flush()
+        self._conn.close()
+
+
+class CachedEmbeddingModel:
+    """Embedding model that looks up the embeddings in an `EmbeddingCache` before the model is run
+
+    The class exposes the parts of the `SentenceTransformer` interface used by the scripts, so it
+    can be used in place of the model.
+
+    Args:
+        model: The embedding model, e.g. `SentenceTransformer`
+        cache (EmbeddingCache): The embedding cache
+
+    """
+    def __init__(self, model, cache: EmbeddingCache):
+        self.model = model
+        self.cache = cache
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, sentences: List[str], **kwargs) -> np.ndarray:
+        return self.cache.encode(sentences, self.model.encode, **kwargs)
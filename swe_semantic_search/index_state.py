@@ -0,0 +1,97 @@
+"""Record of what is in the vector database
+
+For each `surrogate_key` in the vector database, a hash of the content and the name of the embedding
+model are stored in a separate SQLite database. This makes incremental and resumable builds of the
+vector database possible.
+
+The identity of the vector database the state is of, its backend, path, collection and embedding
+model, is stored as well. A state is only valid for the vector database of the same identity, so that
+switching the backend or path and back does not skip rows missing from the current vector database.
+
+"""
+import os
+import json
+import hashlib
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+
+def content_hash(row: Dict, payload_keys: List[str]) -> str:
+    """Hash of the parts of a row that end up in the vector database
+
+    """
+    hasher = hashlib.sha256()
+    for field in ['content'] + payload_keys:
+        hasher.update(field.encode('utf-8'))
+        hasher.update(b'\x00')
+        hasher.update(str(row[field]).encode('utf-8'))
+        hasher.update(b'\x00')
+    return hasher.hexdigest()
+
+
+def index_identity(config: Dict, model_name: str) -> Dict:
+    """The identity of the configured vector database
+
+    """
+    vector_db_config = config['vector_db']
+    backend = vector_db_config.get('backend', 'qdrant')
+    return {
+        'backend': backend,
+        'path': os.path.abspath(vector_db_config['path']),
+        'collection_name': vector_db_config['collection_name'] if backend == 'qdrant' else None,
+        'model_name': model_name,
+    }
+
+
+class IndexState:
+    """The index state database
+
+    Args:
+        path (str): The path to the index state database
+        sql_strings (Dict): The parsed SQL strings file
+
+    """
+    def __init__(self, path: str, sql_strings: Dict):
+        self.sql_strings = sql_strings
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(sql_strings['sql_create_index_state'])
+        self.conn.execute(sql_strings['sql_create_index_identity'])
+        self.conn.commit()
+
+    def load(self) -> Dict[int, Tuple[str, str]]:
+        """Return the content hash and model name per surrogate key
+
+        """
+        return {
+            surrogate_key: (hash_value, model_name)
+            for surrogate_key, hash_value, model_name in self.conn.execute(self.sql_strings['sql_select_index_state'])
+        }
+
+    def identity(self) -> Optional[Dict]:
+        """Return the identity of the vector database of the state, None if not recorded
+
+        """
+        row = self.conn.execute(self.sql_strings['sql_select_index_identity']).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set_identity(self, identity: Dict):
+        self.conn.execute(self.sql_strings['sql_upsert_index_identity'], (json.dumps(identity, sort_keys=True),))
+        self.conn.commit()
+
+    def record(self, entries: List[Tuple[int, str, str]]):
+        """Record (surrogate key, content hash, model name) of points written to the vector database
+
+        """
+        self.conn.executemany(self.sql_strings['sql_upsert_index_state'], entries)
+        self.conn.commit()
+
+    def remove(self, surrogate_keys: List[int]):
+        self.conn.executemany(self.sql_strings['sql_delete_index_state'], [(key,) for key in surrogate_keys])
+        self.conn.commit()
+
+    def clear(self):
+        self.conn.execute(self.sql_strings['sql_clear_index_state'])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,223 @@
+"""Timing of the stages of the scripts, and optional profiling
+
+A stage is a named block of code, timed with `with instrumentation.stage(name) as stage:`, or the
+production of the items of an iterator, timed with `instrumentation.iterate(name, iterator)`. For each
+stage the number of calls, the number of items, the wall time and the self time are recorded. The self
+time excludes the time of the stages run inside the stage, so the self times of all stages add up to
+the time spent in stages. Stages run on several threads are recorded per thread and summed.
+
+At the end of a run, `finish` prints a JSON summary, or writes it to `instrumentation.summary_file`.
+With `instrumentation.profile` set, the run is also profiled with cProfile, and the statistics are
+written to `instrumentation.profile_file` and the top functions printed.
+
+When `instrumentation.enabled` is false, `stage` returns a shared no-op context manager and `iterate`
+returns the iterator unchanged, so the instrumentation costs a method call per stage.
+
+"""
+import json
+import time
+import pstats
+import cProfile
+import threading
+from typing import Dict, Iterable, Iterator, Optional
+
+
+class _StageRecord:
+    def __init__(self):
+        self.n_calls = 0
+        self.n_items = 0
+        self.wall_sec = 0.0
+        self.self_sec = 0.0
+
+
+class _Stage:
+    """A running stage. Items are counted by adding to `n_items`
+
+    """
+    def __init__(self, instrumentation: 'Instrumentation', name: str, n_items: int):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.n_items = n_items
+        self.child_sec = 0.0
+        self.time_start = None
+
+    def __enter__(self):
+        self.instrumentation._stack().append(self)
+        self.time_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        wall_sec = time.perf_counter() - self.time_start
+        stack = self.instrumentation._stack()
+        stack.pop()
+        if len(stack) > 0:
+            stack[-1].child_sec += wall_sec
+        self.instrumentation._add(self.name, self.n_items, wall_sec, wall_sec - self.child_sec)
+        return False
+
+
+class _NullStage:
+    """The stage when the instrumentation is disabled. Counts of items are ignored
+
+    """
+    n_items = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def __setattr__(self, key, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Instrumentation:
+    """Records the time of the stages of a run
+
+    Args:
+        enabled (bool): If False, nothing is recorded
+        summary_file (Optional[str]): The file the JSON summary is written to. If not given, it is printed
+        profile (bool): If True, the run between `start` and `finish` is profiled with cProfile
+        profile_file (Optional[str]): The file the cProfile statistics are written to
+        n_profile_lines (int): The number of functions printed from the profile, by cumulative time
+
+    """
+    def __init__(self,
+                 enabled: bool = False,
+                 summary_file: Optional[str] = None,
+                 profile: bool = False,
+                 profile_file: Optional[str] = None,
+                 n_profile_lines: int = 25,
+                 ):
+        self.enabled = enabled
+        self.summary_file = summary_file
+        self.profile = profile
+        self.profile_file = profile_file
+        self.n_profile_lines = n_profile_lines
+        self._records = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiler = None
+        self._time_start = time.perf_counter()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _add(self, name: str, n_items: int, wall_sec: float, self_sec: float):
+        with self._lock:
+            record = self._records.setdefault(name, _StageRecord())
+            record.n_calls += 1
+            record.n_items += n_items
+            record.wall_sec += wall_sec
+            record.self_sec += self_sec
+
+    def stage(self, name: str, n_items: int = 0):
+        """Context manager that times a stage
+
+        Args:
+            name (str): The name of the stage
+            n_items (int): The number of items processed, which can also be added to the returned stage
+
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, n_items)
+
+    def iterate(self, name: str, iterable: Iterable) -> Iterable:
+        """Time the production of each item of the iterable as a stage, one item per call
+
+        """
+        if not self.enabled:
+            return iterable
+        return self._iterate(name, iter(iterable))
+
+    def _iterate(self, name: str, iterator: Iterator) -> Iterator:
+        while True:
+            with self.stage(name, n_items=1) as stage:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    stage.n_items = 0
+                    return
+            yield item
+
+    def record(self, name: str, wall_sec: float, n_items: int = 0):
+        """Record a stage timed outside of the instrumentation, such as one before it was created
+
+        """
+        if self.enabled:
+            self._add(name, n_items, wall_sec, wall_sec)
+
+    def start(self):
+        """Start the profiler, if profiling is set
+
+        """
+        if self.enabled and self.profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def summary(self) -> Dict:
+        """The recorded stages, ordered by self time
+
+        """
+        with self._lock:
+            stages = [
+                {
+                    'stage': name,
+                    'n_calls': record.n_calls,
+                    'n_items': record.n_items,
+                    'wall_sec': record.wall_sec,
+                    'self_sec': record.self_sec,
+                    'items_per_sec': record.n_items / record.wall_sec if record.n_items > 0 and record.wall_sec > 0 else None,
+                }
+                for name, record in self._records.items()
+            ]
+        return {
+            'total_sec': time.perf_counter() - self._time_start,
+            'stages': sorted(stages, key=lambda stage: stage['self_sec'], reverse=True),
+        }
+
+    def finish(self):
+        """Stop the profiler and report the profile, then report the summary of the stages
+
+        """
+        if not self.enabled:
+            return
+
+        if self._profiler is not None:
+            self._profiler.disable()
+            stats = pstats.Stats(self._profiler)
+            if self.profile_file is not None:
+                stats.dump_stats(self.profile_file)
+            stats.sort_stats('cumulative').print_stats(self.n_profile_lines)
+            self._profiler = None
+
+        summary = self.summary()
+        if self.summary_file is None:
+            print(json.dumps(summary, indent=2))
+        else:
+            with open(self.summary_file, 'w') as f:
+                json.dump(summary, f, indent=2)
+
+
+def make_instrumentation(config: Dict) -> Instrumentation:
+    """Make the instrumentation set in the configuration file, disabled if not set
+
+    Args:
+        config (Dict): The parsed configuration file
+
+    """
+    instrumentation_config = config.get('instrumentation', {})
+    return Instrumentation(
+        enabled=instrumentation_config.get('enabled', False),
+        summary_file=instrumentation_config.get('summary_file'),
+        profile=instrumentation_config.get('profile', False),
+        profile_file=instrumentation_config.get('profile_file'),
+        n_profile_lines=instrumentation_config.get('n_profile_lines', 25),
+    )
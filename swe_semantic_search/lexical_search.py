@@ -0,0 +1,89 @@
+"""Lexical search over the text segments with an SQLite FTS5 index
+
+Names and regnal numbers, such as "Karl XII" or "Gustav IV Adolf", are often better found by their
+words than by their meaning. The FTS5 index over `document.title` and `document.content` is stored
+in the same SQLite file as the text and ranks segments by BM25. The lexical and the semantic rankings
+are combined with reciprocal rank fusion.
+
+Executed as a script, the FTS5 index of the text database in the configuration file is built.
+
+"""
+import re
+import sqlite3
+from typing import Dict, List
+
+import yaml
+
+from vector_index import Hit
+
+
+def build_fts_index(conn: sqlite3.Connection, sql_strings: Dict, rebuild: bool = True):
+    """Create the FTS5 index of the document table, and fill it from the table
+
+    Args:
+        conn (sqlite3.Connection): The connection to the text database
+        sql_strings (Dict): The parsed SQL strings file
+        rebuild (bool): If False, an existing index is left as it is
+
+    """
+    exists = conn.execute(sql_strings['sql_exists_fts']).fetchone() is not None
+    if exists and not rebuild:
+        return
+    conn.execute(sql_strings['sql_create_fts'])
+    conn.execute(sql_strings['sql_rebuild_fts'])
+    conn.commit()
+
+
+def make_match_expression(query: str) -> str:
+    """Make an FTS5 query that matches any of the words of the query
+
+    Each word is quoted, so characters with a meaning in the FTS5 query syntax are taken literally.
+
+    """
+    words = re.findall(r'\w+', query)
+    return ' OR '.join('"{}"'.format(word) for word in words)
+
+
+def lexical_search(conn: sqlite3.Connection, sql_strings: Dict, query: str, limit: int) -> List[Hit]:
+    """Search for the text segments with the best BM25 score for the query
+
+    """
+    match_expression = make_match_expression(query)
+    if match_expression == '':
+        return []
+    return [
+        Hit(id=surrogate_key, score=-score, payload=None)
+        for surrogate_key, score in conn.execute(sql_strings['sql_search_fts'], (match_expression, limit))
+    ]
+
+
+def is_exact_title_match(conn: sqlite3.Connection, sql_strings: Dict, query: str) -> bool:
+    """Whether the query is the title of a text, such as the name of a monarch
+
+    """
+    return conn.execute(sql_strings['sql_select_title_match'], (query.strip(),)).fetchone() is not None
+
+
+def reciprocal_rank_fusion(rankings: List[List[Hit]], limit: int, k: int = 60) -> List[Hit]:
+    """Fuse rankings by the sum of 1 / (k + rank) over the rankings each segment is in
+
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, hit in enumerate(ranking, start=1):
+            scores[hit.id] = scores.get(hit.id, 0.0) + 1.0 / (k + rank)
+    fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return [Hit(id=surrogate_key, score=score, payload=None) for surrogate_key, score in fused]
+
+
+if __name__ == '__main__':
+    #
+    # Parse the configuration file and sql strings file
+    with open('./conf.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+    with open('./sql_strings.yaml', 'r') as f:
+        sql_strings = yaml.safe_load(f)
+
+    conn = sqlite3.connect(config['text_source']['text_data_file'])
+    build_fts_index(conn, sql_strings)
+    conn.close()
@@ -2,61 +2,95 @@
 
 This script collects the text from Swedish language Wikipedia.
 
+The pages are fetched concurrently by a bounded pool of workers, while the pages already fetched are
+segmented in bulk. The segments of a page are written in one transaction, with the record of the page
+by its title, so a page is either fully in the database or not at all. Pages already in the database,
+also those without segments, are skipped, so a re-run only fetches what is missing. Set
+`text_source.rebuild` to start from an empty database, which is needed after the `segmentor`
+settings are changed, since the settings are recorded in the database when it is created.
+
+The time of fetching, segmenting and inserting is recorded with the instrumentation, see `instrumentation.py`.
+
 """
 import os
+import time
 import yaml
-import wikipedia
 import sqlite3
+from collections import deque
 
-from segment_text import make_segments_of_
+from segment_text import make_segments_of_many
+from lexical_search import build_fts_index
+from page_source import make_page_source, fetch_pages, find_pages_to_fetch, record_segmentor_settings
+from instrumentation import make_instrumentation
 
 #
 # Parse the configuration file and sql strings file
+time_start = time.perf_counter()
 with open('./conf.yaml', 'r') as f:
     config = yaml.safe_load(f)
 with open('./sql_strings.yaml', 'r') as f:
     sql_strings = yaml.safe_load(f)
+text_source_config = config['text_source']
+instrumentation = make_instrumentation(config)
+instrumentation.record('parse_config', time.perf_counter() - time_start)
+instrumentation.start()
 
 #
-# Prepare the Wikipedia API
-wikipedia.set_lang("sv")
+# Prepare the page source, by default the Wikipedia API
+page_source = make_page_source(config)
 
 #
-# Connect to the SQLite database. In case the database file already exists, it is overwritten.
-if os.path.exists(config['text_source']['text_data_file']):
-    os.remove(config['text_source']['text_data_file'])
-conn = sqlite3.connect(config['text_source']['text_data_file'])
+# Connect to the SQLite database. The database file is overwritten only if a rebuild is asked for.
+if text_source_config['rebuild'] and os.path.exists(text_source_config['text_data_file']):
+    os.remove(text_source_config['text_data_file'])
+conn = sqlite3.connect(text_source_config['text_data_file'])
+conn.execute('PRAGMA journal_mode=WAL;')
 cur = conn.cursor()
 
 #
-# Create the table and the insert statement
-cur.execute(sql_strings['sql_create'])
+# Create the tables unless they exist, find the pages not yet in them, and record the segmentor
+# settings in a new database, or check that they are those the database was built with
+page_titles = text_source_config['wikipedia']['swedish_monarchs']
+pages_to_fetch = find_pages_to_fetch(conn, sql_strings, page_titles)
+record_segmentor_settings(conn, sql_strings, config)
+title_of_text_id = dict(pages_to_fetch)
+print('{} pages in database, {} to fetch'.format(len(set(page_titles)) - len(pages_to_fetch), len(pages_to_fetch)))
 
 #
-# Iterate over pages, fetch data, segment text per page and insert into database
-for k_page, page_title in enumerate(config['text_source']['wikipedia']['swedish_monarchs']):
-    page = wikipedia.page(page_title)
-    data_chunk = {
-        'text_id': k_page,
-        'title': page.title,
-        'url': page.url,
-        'content': page.content,
-    }
-    text_segments = make_segments_of_(
-        text=data_chunk['content'],
+# Fetch pages, segment the text of the fetched pages in bulk and insert into database, one
+# transaction per page. The pages are queued as they are handed to the segmentation, which
+# yields the segments of the pages in the same order. The time spent waiting for the fetched
+# pages is recorded as fetch, and excluded from the self time of the segmentation.
+fetched_pages = deque()
+
+
+def _texts_of_fetched_pages():
+    fetched = fetch_pages(page_source, pages_to_fetch, text_source_config['n_workers'])
+    for text_id, page in instrumentation.iterate('fetch', fetched):
+        fetched_pages.append((text_id, page))
+        yield page.content
+
+
+time_start = time.perf_counter()
+for text_segments in instrumentation.iterate('segment', make_segments_of_many(
+        texts=_texts_of_fetched_pages(),
         max_words_in_segment=config['segmentor']['max_segment_size'],
         n_overlapping_sentences=config['segmentor']['n_overlapping_sentences'],
-    )
-    for k_segment, segment in enumerate(text_segments):
-        cur.execute(sql_strings['sql_insert'], (
-            data_chunk['text_id'],
-            k_segment,
-            data_chunk['title'],
-            data_chunk['url'],
-            segment
-        ))
+        batch_size=config['segmentor']['batch_size'],
+)):
+    text_id, page = fetched_pages.popleft()
+    with instrumentation.stage('insert', n_items=len(text_segments)), conn:
+        conn.executemany(sql_strings['sql_insert'], [
+            (text_id, k_segment, page.title, page.url, segment)
+            for k_segment, segment in enumerate(text_segments)
+        ])
+        conn.execute(sql_strings['sql_insert_page'], (title_of_text_id[text_id], text_id, len(text_segments)))
+    print('Inserted {} segments of page {} after {:.1f} sec'.format(
+        len(text_segments), page.title, time.perf_counter() - time_start))
 
 #
-# Commit and close connection
-conn.commit()
+# Build the lexical search index and close connection
+with instrumentation.stage('build_fts_index'):
+    build_fts_index(conn, sql_strings)
 conn.close()
+instrumentation.finish()
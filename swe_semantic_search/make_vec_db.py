@@ -1,20 +1,47 @@
 """Script to make the databases for the semantic search engine.
 
+The rows of the text database are read in chunks, embedded in batches and upserted to the
+vector database in bulk. The chunk size is set by `indexing.batch_size` in the configuration file.
+With `indexing.n_workers` larger than one, the rows of each chunk are embedded in parallel by as many
+worker processes; the chunk size should then be a multiple of the number of workers.
+
+With `indexing.mode` set to `incremental` the vector database is updated rather than rebuilt. A
+content hash and the model name are recorded per `surrogate_key` in a separate state database,
+and only new or changed segments are embedded. The state database records which vector database
+it is of, and the vector database is rebuilt if the configured one is another. Points for rows that no longer exist are deleted.
+The state is committed after every chunk, so an interrupted run resumes where it stopped.
+
+With `vector_db.compression.method` set, the vectors are compressed after the build, and the memory
+of the compressed vectors and the recall@k of the compressed search are reported.
+
+The time of reading, hashing, embedding, upserting and recording the state is recorded with the
+instrumentation, see `instrumentation.py`.
+
 """
+import json
+import time
 import yaml
 import sqlite3
 
-from sentence_transformers import SentenceTransformer
-from qdrant_client import QdrantClient, models
-
 from row_factory import dict_factory
+from embedding import load_embedding_model, embedding_model_id, ParallelEncoder
+from vector_index import make_vector_index
+from index_state import IndexState, content_hash, index_identity
+from embedding_cache import CachedEmbeddingModel
+from instrumentation import make_instrumentation
 
 #
 # Parse the configuration file and sql strings file
+time_start = time.perf_counter()
 with open('./conf.yaml', 'r') as f:
     config = yaml.safe_load(f)
 with open('./sql_strings.yaml', 'r') as f:
     sql_strings = yaml.safe_load(f)
+model_name = embedding_model_id(config)
+payload_keys = config['vector_db']['payload_keys']
+instrumentation = make_instrumentation(config)
+instrumentation.record('parse_config', time.perf_counter() - time_start)
+instrumentation.start()
 
 #
 # Connect to the SQLite database
@@ -24,41 +51,104 @@ cur = conn.cursor()
 cur.execute(sql_strings['sql_select_all'])
 
 #
-# Load the embedding engine
-embedding_model = SentenceTransformer(
-    model_name_or_path=config['embedding_model']['model_name_or_path'],
-    cache_folder=config['embedding_model']['cache_folder'],
-)
+# Connect to the index state database, which records what is in the vector database
+with instrumentation.stage('load_index_state') as stage:
+    index_state_db = IndexState(config['indexing']['state_file'], sql_strings)
+    index_state = index_state_db.load()
+    stage.n_items = len(index_state)
 
 #
-# Load the vector database
-qdrant_handle = QdrantClient(
-    path=config['vector_db']['path'],
-)
-qdrant_handle.recreate_collection(
-    collection_name=config['vector_db']['collection_name'],
-    vectors_config=models.VectorParams(
-        size=embedding_model.get_sentence_embedding_dimension(),
-        distance=models.Distance.COSINE,
-    ),
-)
+# Load the embedding engine, in a pool of worker processes if more than one worker is set
+with instrumentation.stage('load_embedding_model'):
+    embedding_model = load_embedding_model(config, n_workers=config['indexing']['n_workers'])
 
 #
-# Build the vector database for the text segments
+# Load the vector database. It is recreated unless an incremental build is possible, which
+# requires that the index exists, that the index state is of it, and that all its vectors come
+# from the same model.
+vector_index = make_vector_index(config)
+identity = index_identity(config, model_name)
+recreate = config['indexing']['mode'] != 'incremental' \
+    or not vector_index.exists() \
+    or index_state_db.identity() != identity \
+    or any(state_model_name != model_name for _, state_model_name in index_state.values())
+if recreate:
+    vector_index.recreate(dim=embedding_model.get_sentence_embedding_dimension())
+    index_state_db.clear()
+    index_state_db.set_identity(identity)
+    index_state = {}
+
+#
+# Build the vector database for the text segments, one chunk of rows at a time
+batch_size = config['indexing']['batch_size']
+present_keys = set()
+n_segments = 0
+n_embedded = 0
+time_start = time.perf_counter()
 while True:
-    row = cur.fetchone()
-    if row is None:
+    with instrumentation.stage('read_rows') as stage:
+        rows = cur.fetchmany(batch_size)
+        stage.n_items = len(rows)
+    if len(rows) == 0:
         break
 
-    vector = embedding_model.encode([row['content']])[0]
-    qdrant_handle.upsert(
-        collection_name=config['vector_db']['collection_name'],
-        points=[
-            models.PointStruct(
-                id=row['surrogate_key'],
-                vector=vector.tolist(),
-                payload={"title": row['title'],
-                         "url": row['url']}
+    rows_to_embed = []
+    with instrumentation.stage('hash', n_items=len(rows)):
+        for row in rows:
+            present_keys.add(row['surrogate_key'])
+            row['content_hash'] = content_hash(row, payload_keys)
+            if index_state.get(row['surrogate_key']) != (row['content_hash'], model_name):
+                rows_to_embed.append(row)
+
+    if len(rows_to_embed) > 0:
+        with instrumentation.stage('encode', n_items=len(rows_to_embed)):
+            vectors = embedding_model.encode(
+                [row['content'] for row in rows_to_embed],
+                batch_size=batch_size,
+            )
+        with instrumentation.stage('upsert', n_items=len(rows_to_embed)):
+            vector_index.upsert(
+                ids=[row['surrogate_key'] for row in rows_to_embed],
+                vectors=vectors,
+                payloads=[{key: row[key] for key in payload_keys} for row in rows_to_embed],
             )
-        ]
-    )
+        with instrumentation.stage('record_index_state', n_items=len(rows_to_embed)):
+            index_state_db.record(
+                [(row['surrogate_key'], row['content_hash'], model_name) for row in rows_to_embed]
+            )
+
+    n_segments += len(rows)
+    n_embedded += len(rows_to_embed)
+    time_elapsed = time.perf_counter() - time_start
+    print('Indexed {} segments ({} embedded), {:.1f} segments/sec'.format(
+        n_segments, n_embedded, n_segments / time_elapsed))
+
+#
+# Remove the points of segments that are no longer in the text database
+stale_keys = [surrogate_key for surrogate_key in index_state if surrogate_key not in present_keys]
+if len(stale_keys) > 0:
+    with instrumentation.stage('delete_stale', n_items=len(stale_keys)):
+        vector_index.delete(stale_keys)
+        index_state_db.remove(stale_keys)
+    print('Deleted {} stale segments'.format(len(stale_keys)))
+
+#
+# Compress the vectors as set in the configuration file, which also applies a changed setting to an
+# existing index, and report memory and recall
+with instrumentation.stage('compress'):
+    vector_index.compress()
+if config['vector_db']['compression']['method'] != 'none':
+    print('Compression: {}'.format(json.dumps(vector_index.compression_report())))
+
+#
+# Report the peak memory of the embedding workers, if the model was run in parallel
+encoder = embedding_model.model if isinstance(embedding_model, CachedEmbeddingModel) else embedding_model
+if isinstance(encoder, ParallelEncoder):
+    for pid, peak_memory_kb in sorted(encoder.peak_memory_kb.items()):
+        print('Embedding worker {}: peak memory {:.0f} MB'.format(pid, peak_memory_kb / 1024))
+    encoder.close()
+
+vector_index.close()
+index_state_db.close()
+conn.close()
+instrumentation.finish()
@@ -0,0 +1,178 @@
+"""Sources of the pages of raw text
+
+A page source is a callable that takes a page title and returns a `Page`. The source is selected by
+`text_source.page_source` in the configuration file:
+
+* `wikipedia`: the pages are fetched from Wikipedia in the configured language
+* `stub`: the pages are read from a local JSON file, which maps page title to an object with the
+  keys `title`, `url` and `content`. This is for testing and runs without network. The file
+  `data/stub_pages.json` has a few sentences of text for each of the configured pages.
+
+The pages stored in the text database are recorded in its `page` table by the title they were
+requested with, with their `text_id` and number of segments, see `find_pages_to_fetch`. The
+`segmentor` settings the segments were made with are recorded as well, see `record_segmentor_settings`.
+
+"""
+import json
+import sqlite3
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional, Tuple
+
+Page = namedtuple('Page', ['title', 'url', 'content'])
+
+
+class WikipediaPageSource:
+    """Fetch pages from Wikipedia
+
+    Args:
+        lang (str): The language of Wikipedia
+
+    """
+    def __init__(self, lang: str = 'sv'):
+        import wikipedia
+        wikipedia.set_lang(lang)
+        self._wikipedia = wikipedia
+
+    def __call__(self, page_title: str) -> Page:
+        page = self._wikipedia.page(page_title)
+        return Page(title=page.title, url=page.url, content=page.content)
+
+
+class StubPageSource:
+    """Read pages from a local JSON file
+
+    Args:
+        path (str): The path to the JSON file
+
+    """
+    def __init__(self, path: str):
+        with open(path, 'r') as f:
+            self._pages = json.load(f)
+
+    def __call__(self, page_title: str) -> Page:
+        try:
+            page = self._pages[page_title]
+        except KeyError:
+            raise KeyError('Page {} not in stub page source'.format(page_title))
+        return Page(title=page['title'], url=page['url'], content=page['content'])
+
+
+def make_page_source(config: Dict):
+    """Make the page source set in the configuration file
+
+    Args:
+        config (Dict): The parsed configuration file
+
+    """
+    text_source_config = config['text_source']
+    page_source = text_source_config.get('page_source', 'wikipedia')
+    if page_source == 'wikipedia':
+        return WikipediaPageSource(lang=text_source_config.get('lang', 'sv'))
+    elif page_source == 'stub':
+        return StubPageSource(path=text_source_config['stub_path'])
+    else:
+        raise ValueError('Unknown page source: {}'.format(page_source))
+
+
+def fetch_pages(page_source, pages_to_fetch: List[Tuple[int, str]], n_workers: int) -> Iterator[Tuple[int, Page]]:
+    """Fetch pages concurrently and yield them as they arrive, with their text ID
+
+    A page that cannot be fetched is reported and skipped, so it is fetched on the next run.
+
+    """
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            executor.submit(page_source, page_title): (text_id, page_title)
+            for text_id, page_title in pages_to_fetch
+        }
+        for future in as_completed(futures):
+            text_id, page_title = futures[future]
+            try:
+                page = future.result()
+            except Exception as e:
+                print('Failed to fetch page {}: {}'.format(page_title, e))
+                continue
+            yield text_id, page
+
+
+def find_pages_to_fetch(conn: sqlite3.Connection, sql_strings: Dict, page_titles: List[str]) -> List[Tuple[int, str]]:
+    """Return the text ID and title of the pages not yet in the text database
+
+    A page is in the database if its title is in the `page` table, also if it had no segments. A page
+    to fetch gets the text ID after the largest in use, so the text IDs do not depend on the order
+    of the page titles in the configuration file.
+
+    The text databases made before the `page` table have the position of the title in the
+    configuration file as text ID. Those pages are recorded once under that assumption, which holds if
+    the titles have not been changed since.
+
+    """
+    with conn:
+        conn.execute(sql_strings['sql_create'])
+        conn.execute(sql_strings['sql_create_page'])
+        text_id_of_title = {page_title: text_id for page_title, text_id in conn.execute(sql_strings['sql_select_pages'])}
+        recorded_text_ids = set(text_id_of_title.values())
+        legacy_pages = [
+            (page_titles[text_id], text_id, n_segments)
+            for text_id, n_segments in conn.execute(sql_strings['sql_count_segments_of_text_ids']).fetchall()
+            if text_id not in recorded_text_ids and 0 <= text_id < len(page_titles)
+            and page_titles[text_id] not in text_id_of_title
+        ]
+        if len(legacy_pages) > 0:
+            print('Recording {} pages stored before the page table by their position in the configuration'.format(
+                len(legacy_pages)))
+            conn.executemany(sql_strings['sql_insert_page'], legacy_pages)
+            text_id_of_title.update({page_title: text_id for page_title, text_id, _ in legacy_pages})
+        max_text_id = max(
+            [text_id for text_id, in conn.execute(sql_strings['sql_select_text_ids'])] + list(text_id_of_title.values()),
+            default=-1,
+        )
+
+    pages_to_fetch = []
+    for page_title in dict.fromkeys(page_titles):
+        if page_title not in text_id_of_title:
+            max_text_id += 1
+            pages_to_fetch.append((max_text_id, page_title))
+    return pages_to_fetch
+
+
+def segmentor_settings(config: Dict) -> Dict:
+    """The `segmentor` settings that the segments depend on
+
+    """
+    return {
+        'max_segment_size': config['segmentor']['max_segment_size'],
+        'n_overlapping_sentences': config['segmentor']['n_overlapping_sentences'],
+    }
+
+
+def stored_segmentor_settings(conn: sqlite3.Connection, sql_strings: Dict) -> Optional[Dict]:
+    """The `segmentor` settings the text database was built with, None if they are not recorded
+
+    """
+    with conn:
+        conn.execute(sql_strings['sql_create_segmentor_settings'])
+    row = conn.execute(sql_strings['sql_select_segmentor_settings']).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+
+def record_segmentor_settings(conn: sqlite3.Connection, sql_strings: Dict, config: Dict):
+    """Record the `segmentor` settings in a new text database, or check that they are those it was built with
+
+    Raises `ValueError` if the text database was built with other settings, since its segments would be
+    made with different settings. The settings of a text database made before they were recorded are
+    not known, and are left unrecorded.
+
+    """
+    settings = segmentor_settings(config)
+    stored_settings = stored_segmentor_settings(conn, sql_strings)
+    if stored_settings is None:
+        if conn.execute(sql_strings['sql_select_text_ids']).fetchone() is not None:
+            print('The segmentor settings of the text database are not known, set text_source.rebuild to record them')
+            return
+        with conn:
+            conn.execute(sql_strings['sql_insert_segmentor_settings'], (json.dumps(settings, sort_keys=True),))
+    elif stored_settings != settings:
+        raise ValueError('Text database built with the segmentor settings {}, not {}. Set text_source.rebuild'.format(
+            stored_settings, settings))
@@ -0,0 +1,340 @@
+"""End-to-end streaming pipeline from source pages to vector index
+
+The stages of `make_raw_text.py` and `make_vec_db.py` are run concurrently, connected by bounded
+queues, so pages are fetched while earlier pages are segmented and embedded:
+
+    fetch -> segment -> store -> embed -> upsert
+
+The SQLite text database remains the system of record: the segments of a page are stored there in
+one transaction before they are embedded, and the index state is recorded as in `make_vec_db.py`, so
+the two scripts can be used on the same databases afterwards. Pages already in the text database,
+recorded by their title, are skipped. The stored segments that are not in the vector index, or are
+out of date there, are sent to the embedding at the start, so a run that stopped between storing and
+upserting segments is resumed.
+
+The number of items, the throughput and the busy fraction of each stage, as well as the depth of each
+queue, are printed every `pipeline.report_interval` seconds. The stage with the highest busy fraction
+is the bottleneck.
+
+"""
+import time
+import queue
+import sqlite3
+import threading
+from typing import Callable, Dict, List, Optional
+
+import yaml
+
+from segment_text import make_segments_of_many
+from lexical_search import build_fts_index
+from page_source import make_page_source, fetch_pages, find_pages_to_fetch, record_segmentor_settings
+from embedding import load_embedding_model, embedding_model_id
+from vector_index import make_vector_index
+from index_state import IndexState, content_hash, index_identity
+from row_factory import dict_factory
+
+_END = object()
+
+
+class PipelineAbortedError(Exception):
+    pass
+
+
+class Stage:
+    """A stage of the pipeline, run on its own thread
+
+    The work function gets the stage, reads items with `get` and writes items with `put`. The time
+    spent waiting on the queues is not counted as busy time.
+
+    Args:
+        name (str): The name of the stage
+        work (Callable): The function that does the work of the stage
+        in_queue (Optional[queue.Queue]): The queue the stage reads from, None for the first stage
+        out_queue (Optional[queue.Queue]): The queue the stage writes to, None for the last stage
+        abort (threading.Event): Set when any stage fails, which stops all stages
+
+    """
+    def __init__(self,
+                 name: str,
+                 work: Callable,
+                 in_queue: Optional[queue.Queue],
+                 out_queue: Optional[queue.Queue],
+                 abort: threading.Event,
+                 ):
+        self.name = name
+        self.work = work
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.abort = abort
+        self.n_items = 0
+        self.time_waiting = 0.0
+        self.time_start = None
+        self.time_end = None
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+
+    def get(self, block: bool = True):
+        """Read the next item, or `_END` when the previous stage is done
+
+        """
+        time_start = time.perf_counter()
+        try:
+            while True:
+                if self.abort.is_set():
+                    raise PipelineAbortedError()
+                try:
+                    return self.in_queue.get(timeout=0.1) if block else self.in_queue.get_nowait()
+                except queue.Empty:
+                    if not block:
+                        return None
+        finally:
+            self.time_waiting += time.perf_counter() - time_start
+
+    def put(self, item):
+        time_start = time.perf_counter()
+        try:
+            while True:
+                if self.abort.is_set():
+                    raise PipelineAbortedError()
+                try:
+                    self.out_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+        finally:
+            self.time_waiting += time.perf_counter() - time_start
+
+    def _run(self):
+        self.time_start = time.perf_counter()
+        try:
+            self.work(self)
+            if self.out_queue is not None:
+                self.put(_END)
+        except PipelineAbortedError:
+            pass
+        except Exception as e:
+            self.error = e
+            self.abort.set()
+        finally:
+            self.time_end = time.perf_counter()
+
+    def report(self) -> Dict:
+        time_end = self.time_end if self.time_end is not None else time.perf_counter()
+        time_elapsed = max(time_end - self.time_start, 1e-9) if self.time_start is not None else 0.0
+        return {
+            'stage': self.name,
+            'n_items': self.n_items,
+            'items_per_sec': self.n_items / time_elapsed if time_elapsed > 0 else 0.0,
+            'busy_fraction': max(0.0, 1.0 - self.time_waiting / time_elapsed) if time_elapsed > 0 else 0.0,
+            'queue_depth': self.out_queue.qsize() if self.out_queue is not None else None,
+        }
+
+
+def _get_batch(stage: Stage, batch_size: int) -> List:
+    """Block for one item, then take what is already in the queue up to the batch size
+
+    The end marker is put back, so the stage sees it after the batch is processed.
+
+    """
+    item = stage.get()
+    if item is _END:
+        return []
+    batch = [item]
+    while len(batch) < batch_size:
+        item = stage.get(block=False)
+        if item is None:
+            break
+        if item is _END:
+            stage.in_queue.put(_END)
+            break
+        batch.append(item)
+    return batch
+
+
+def run_pipeline(config: Dict, sql_strings: Dict):
+    """Run the pipeline from the page source to the vector index
+
+    Args:
+        config (Dict): The parsed configuration file
+        sql_strings (Dict): The parsed SQL strings file
+
+    """
+    text_source_config = config['text_source']
+    pipeline_config = config['pipeline']
+    model_name = embedding_model_id(config)
+    payload_keys = config['vector_db']['payload_keys']
+
+    #
+    # Find the pages not yet in the text database, and record or check the segmentor settings
+    page_titles = text_source_config['wikipedia']['swedish_monarchs']
+    conn = sqlite3.connect(text_source_config['text_data_file'])
+    conn.execute('PRAGMA journal_mode=WAL;')
+    pages_to_fetch = find_pages_to_fetch(conn, sql_strings, page_titles)
+    record_segmentor_settings(conn, sql_strings, config)
+    conn.close()
+    title_of_text_id = dict(pages_to_fetch)
+    print('{} pages in database, {} to fetch'.format(len(set(page_titles)) - len(pages_to_fetch), len(pages_to_fetch)))
+
+    #
+    # Find the stored segments that are not in the vector index, or not as they are stored, such as
+    # the segments stored by a run that stopped before they were upserted. They are embedded first.
+    vector_index = make_vector_index(config)
+    index_exists = vector_index.exists()
+    vector_index.close()
+    index_state_db = IndexState(config['indexing']['state_file'], sql_strings)
+    index_state = {}
+    if index_exists and index_state_db.identity() == index_identity(config, model_name):
+        index_state = index_state_db.load()
+    index_state_db.close()
+    conn = sqlite3.connect(text_source_config['text_data_file'])
+    conn.row_factory = dict_factory
+    pending_rows = [
+        row for row in conn.execute(sql_strings['sql_select_all'])
+        if index_state.get(row['surrogate_key']) != (content_hash(row, payload_keys), model_name)
+    ]
+    conn.close()
+    print('{} stored segments to embed'.format(len(pending_rows)))
+
+    #
+    # The work of each stage. Resources that are not thread-safe, such as the database
+    # connections, are created on the thread of the stage that uses them.
+    def fetch(stage: Stage):
+        page_source = make_page_source(config)
+        for text_id, page in fetch_pages(page_source, pages_to_fetch, text_source_config['n_workers']):
+            stage.n_items += 1
+            stage.put((text_id, page))
+
+    def segment(stage: Stage):
+        while True:
+            batch = _get_batch(stage, config['segmentor']['batch_size'])
+            if len(batch) == 0:
+                break
+            all_segments = make_segments_of_many(
+                texts=[page.content for _, page in batch],
+                max_words_in_segment=config['segmentor']['max_segment_size'],
+                n_overlapping_sentences=config['segmentor']['n_overlapping_sentences'],
+                batch_size=len(batch),
+            )
+            for (text_id, page), segments in zip(batch, all_segments):
+                stage.n_items += 1
+                stage.put((text_id, page, segments))
+
+    def store(stage: Stage):
+        for row in pending_rows:
+            stage.n_items += 1
+            stage.put(row)
+        conn_store = sqlite3.connect(text_source_config['text_data_file'])
+        conn_store.row_factory = sqlite3.Row
+        while True:
+            item = stage.get()
+            if item is _END:
+                break
+            text_id, page, segments = item
+            with conn_store:
+                conn_store.executemany(sql_strings['sql_insert'], [
+                    (text_id, k_segment, page.title, page.url, segment)
+                    for k_segment, segment in enumerate(segments)
+                ])
+                conn_store.execute(sql_strings['sql_insert_page'], (title_of_text_id[text_id], text_id, len(segments)))
+            for row in conn_store.execute(sql_strings['sql_select_by_text_id'], (text_id,)):
+                stage.n_items += 1
+                stage.put(dict(row))
+        build_fts_index(conn_store, sql_strings)
+        conn_store.close()
+
+    def embed(stage: Stage):
+        embedding_model = load_embedding_model(config)
+        batch_size = config['indexing']['batch_size']
+        while True:
+            rows = _get_batch(stage, batch_size)
+            if len(rows) == 0:
+                break
+            vectors = embedding_model.encode([row['content'] for row in rows], batch_size=batch_size)
+            stage.n_items += len(rows)
+            stage.put((rows, vectors))
+
+    def upsert(stage: Stage):
+        index_state_db = IndexState(config['indexing']['state_file'], sql_strings)
+        vector_index = make_vector_index(config)
+        identity = index_identity(config, model_name)
+        if vector_index.exists() and (index_state_db.identity() != identity or any(
+                state_model_name != model_name for _, state_model_name in index_state_db.load().values())):
+            raise ValueError('Index state of another vector database or model, rebuild it with make_vec_db.py')
+        while True:
+            item = stage.get()
+            if item is _END:
+                break
+            rows, vectors = item
+            if not vector_index.exists():
+                vector_index.recreate(dim=vectors.shape[1])
+                index_state_db.clear()
+                index_state_db.set_identity(identity)
+            vector_index.upsert(
+                ids=[row['surrogate_key'] for row in rows],
+                vectors=vectors,
+                payloads=[{key: row[key] for key in payload_keys} for row in rows],
+            )
+            index_state_db.record(
+                [(row['surrogate_key'], content_hash(row, payload_keys), model_name) for row in rows]
+            )
+            stage.n_items += len(rows)
+        if vector_index.exists():
+            vector_index.compress()
+        vector_index.close()
+        index_state_db.close()
+
+    #
+    # Connect the stages with bounded queues and run them
+    abort = threading.Event()
+    queues = [queue.Queue(maxsize=pipeline_config['queue_size']) for _ in range(4)]
+    stages = [
+        Stage('fetch', fetch, None, queues[0], abort),
+        Stage('segment', segment, queues[0], queues[1], abort),
+        Stage('store', store, queues[1], queues[2], abort),
+        Stage('embed', embed, queues[2], queues[3], abort),
+        Stage('upsert', upsert, queues[3], None, abort),
+    ]
+    for stage in stages:
+        stage.start()
+
+    def _print_report():
+        print(' | '.join(
+            '{stage}: {n_items} ({items_per_sec:.1f}/s, busy {busy_fraction:.0%}{depth})'.format(
+                depth='' if report['queue_depth'] is None else ', queue {}'.format(report['queue_depth']),
+                **report)
+            for report in (stage.report() for stage in stages)
+        ))
+
+    time_next_report = time.perf_counter() + pipeline_config['report_interval']
+    while any(stage.time_end is None for stage in stages):
+        time.sleep(0.1)
+        if time.perf_counter() >= time_next_report:
+            time_next_report += pipeline_config['report_interval']
+            _print_report()
+    for stage in stages:
+        stage.join()
+
+    _print_report()
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+    slowest = max(stages, key=lambda stage: stage.report()['busy_fraction'])
+    print('Slowest stage: {}'.format(slowest.name))
+    return [stage.report() for stage in stages]
+
+
+if __name__ == '__main__':
+    #
+    # Parse the configuration file and sql strings file
+    with open('./conf.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+    with open('./sql_strings.yaml', 'r') as f:
+        sql_strings = yaml.safe_load(f)
+
+    run_pipeline(config, sql_strings)
@@ -0,0 +1,305 @@
+"""Long-running semantic search service
+
+The embedding model and the databases are loaded once, after which the service answers queries
+until it is stopped. Queries that arrive close in time are grouped into micro-batches, so one
+`encode` call and one vector search serve many concurrent queries.
+
+Two interfaces are available, selected by `service.interface` in the configuration file:
+
+* `http`: POST a JSON object `{"query": "...", "n_results": 7}` to `/search`, where `n_results` is
+  optional. GET `/stats` returns the number of queries, the mean batch size and latency percentiles.
+* `stdin`: one JSON object per line on standard input, as for `/search`. One JSON line with the
+  result is written to standard output per query, in the order the queries were read.
+
+"""
+import sys
+import json
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Optional
+
+import yaml
+
+from semantic_searcher import SemanticSearcher
+
+
+class BadSearchRequestError(ValueError):
+    pass
+
+
+def validate_search_request(query, n_results):
+    """Raise `BadSearchRequestError` unless the query is a string and `n_results` is None or a positive integer
+
+    """
+    if not isinstance(query, str):
+        raise BadSearchRequestError('query must be a string, not {}'.format(type(query).__name__))
+    if n_results is not None and (isinstance(n_results, bool) or not isinstance(n_results, int) or n_results < 1):
+        raise BadSearchRequestError('n_results must be a positive integer, not {!r}'.format(n_results))
+
+
+class QueryBatcher:
+    """Answer queries in micro-batches on a single worker thread
+
+    The worker waits for a first query, then collects further queries until either the batch is full
+    or the wait time has passed, and answers the whole batch with one call to the searcher. The searcher
+    is created on the worker thread, so the model and the database connections are only used from there.
+
+    Queries are validated when they are submitted. If the search of a batch fails all the same, the
+    queries of the batch are answered one at a time, so only the queries that fail get the error.
+
+    Args:
+        config (Dict): The parsed configuration file
+        sql_strings (Dict): The parsed SQL strings file
+        max_batch_size (int): The maximum number of queries in a batch
+        max_wait_ms (float): The maximum time to wait for more queries after the first of a batch
+        latency_window (int): The number of most recent latencies the statistics are computed from
+
+    """
+    def __init__(self,
+                 config: Dict,
+                 sql_strings: Dict,
+                 max_batch_size: int = 32,
+                 max_wait_ms: float = 5.0,
+                 latency_window: int = 10000,
+                 ):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._latencies = deque(maxlen=latency_window)
+        self._n_queries = 0
+        self._n_batches = 0
+        self._lock = threading.Lock()
+
+        self._ready = threading.Event()
+        self._startup_error = None
+        self._worker = threading.Thread(target=self._run, args=(config, sql_strings), daemon=True)
+        self._worker.start()
+        self._ready.wait()
+        if self._startup_error is not None:
+            raise self._startup_error
+
+    def submit(self, query: str, n_results: Optional[int] = None) -> Future:
+        """Put a query in line to be answered. Raises `BadSearchRequestError` for an invalid query
+
+        """
+        validate_search_request(query, n_results)
+        future = Future()
+        self._queue.put((time.perf_counter(), query, n_results, future))
+        return future
+
+    def search(self, query: str, n_results: Optional[int] = None) -> List[Dict]:
+        return self.submit(query, n_results).result()
+
+    def stop(self):
+        self._queue.put(None)
+        self._worker.join()
+
+    def _collect_batch(self, first_item) -> List:
+        batch = [first_item]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self, config: Dict, sql_strings: Dict):
+        try:
+            searcher = SemanticSearcher(config, sql_strings)
+        except Exception as e:
+            self._startup_error = e
+            return
+        finally:
+            self._ready.set()
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = self._collect_batch(item)
+
+            queries = [query for _, query, _, _ in batch]
+            n_results = [n if n is not None else config['search']['n_results'] for _, _, n, _ in batch]
+            try:
+                results = searcher.search(queries, n_results)
+            except Exception as e:
+                results = [e] if len(batch) == 1 else self._search_one_by_one(searcher, queries, n_results)
+
+            time_done = time.perf_counter()
+            with self._lock:
+                self._n_queries += len(batch)
+                self._n_batches += 1
+                self._latencies.extend(time_done - time_submit for time_submit, _, _, _ in batch)
+            for (_, _, _, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    @staticmethod
+    def _search_one_by_one(searcher: SemanticSearcher, queries: List[str], n_results: List[int]) -> List:
+        """Answer the queries one at a time, with the exception in place of the result of a query that fails
+
+        """
+        results = []
+        for query, n in zip(queries, n_results):
+            try:
+                results.append(searcher.search([query], [n])[0])
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def stats(self) -> Dict:
+        """Query counts and latency percentiles in milliseconds
+
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            n_queries = self._n_queries
+            n_batches = self._n_batches
+
+        def _percentile(p):
+            if len(latencies) == 0:
+                return None
+            return 1000.0 * latencies[min(len(latencies) - 1, int(p / 100.0 * len(latencies)))]
+
+        return {
+            'n_queries': n_queries,
+            'n_batches': n_batches,
+            'mean_batch_size': n_queries / n_batches if n_batches > 0 else None,
+            'latency_ms_p50': _percentile(50),
+            'latency_ms_p99': _percentile(99),
+        }
+
+
+def make_request_handler(batcher: QueryBatcher):
+    """Make the HTTP request handler class that passes queries to the batcher
+
+    """
+    class SearchRequestHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send_json(200, batcher.stats())
+            else:
+                self._send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+
+        def do_POST(self):
+            if self.path != '/search':
+                self._send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if not isinstance(request, dict):
+                    raise BadSearchRequestError('the request must be a JSON object')
+                future = batcher.submit(request['query'], request.get('n_results'))
+            except (ValueError, KeyError) as e:
+                self._send_json(400, {'error': 'Bad request: {}'.format(e)})
+                return
+            try:
+                result = future.result()
+            except Exception as e:
+                self._send_json(500, {'error': 'Search failed: {}'.format(e)})
+                return
+            self._send_json(200, {'query': request['query'], 'results': result})
+
+        def log_message(self, format, *args):
+            pass
+
+    return SearchRequestHandler
+
+
+def serve_stdin(batcher: QueryBatcher):
+    """Answer queries read as JSON lines from standard input
+
+    The queries are submitted as soon as they are read, so consecutive lines can be batched.
+    The results are written by a separate thread in the order the queries were read.
+
+    """
+    pending = queue.Queue()
+
+    def _write_results():
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            query, future = item
+            try:
+                output = {'query': query, 'results': future.result()}
+            except Exception as e:
+                output = {'query': query, 'error': str(e)}
+            sys.stdout.write(json.dumps(output, ensure_ascii=False) + '\n')
+            sys.stdout.flush()
+
+    writer = threading.Thread(target=_write_results)
+    writer.start()
+    for line in sys.stdin:
+        if line.strip() == '':
+            continue
+        query = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise BadSearchRequestError('the request must be a JSON object')
+            query = request['query']
+            future = batcher.submit(query, request.get('n_results'))
+        except (ValueError, KeyError) as e:
+            future = Future()
+            future.set_exception(BadSearchRequestError('Bad request: {}'.format(e)))
+        pending.put((query, future))
+    pending.put(None)
+    writer.join()
+    sys.stderr.write(json.dumps(batcher.stats()) + '\n')
+
+
+if __name__ == '__main__':
+    #
+    # Parse the configuration file
+    with open('conf.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+    with open('sql_strings.yaml', 'r') as f:
+        sql_strings = yaml.safe_load(f)
+    service_config = config['service']
+
+    batcher = QueryBatcher(
+        config=config,
+        sql_strings=sql_strings,
+        max_batch_size=service_config['max_batch_size'],
+        max_wait_ms=service_config['max_wait_ms'],
+    )
+
+    if service_config['interface'] == 'stdin':
+        serve_stdin(batcher)
+    elif service_config['interface'] == 'http':
+        server = ThreadingHTTPServer(
+            (service_config['host'], service_config['port']),
+            make_request_handler(batcher),
+        )
+        print('Serving semantic search on http://{}:{}'.format(service_config['host'], service_config['port']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+    else:
+        raise ValueError('Unknown service interface: {}'.format(service_config['interface']))
+
+    batcher.stop()
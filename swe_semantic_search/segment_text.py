@@ -1,43 +1,89 @@
 """Segment text into sentences and larger chunks
 
+The Stanza pipeline is loaded when it is first used, so importing the module is cheap.
+
 """
-from stanza import Pipeline
+from itertools import accumulate, islice
+from typing import Iterable, Iterator, List, Tuple
 
-splitter = Pipeline(lang='sv', processors='tokenize')
+_splitter = None
 
 
-def make_segments_of_(text: str, max_words_in_segment: int, n_overlapping_sentences: int):
-    """Split text into segments of max_words_in_segment words.
+def get_splitter():
+    """Return the Stanza sentence splitter, loading it on first use
 
     """
-    doc = splitter(text)
+    global _splitter
+    if _splitter is None:
+        from stanza import Pipeline
+        _splitter = Pipeline(lang='sv', processors='tokenize')
+    return _splitter
 
-    n_tokens_per_sentence = [len(sentence.tokens) for sentence in doc.sentences]
 
-    k_segment = 0
-    mask = {}
-    ind_abs = 0
+def _segment_spans(n_tokens_per_sentence: List[int],
+                   max_words_in_segment: int,
+                   n_overlapping_sentences: int) -> Iterator[Tuple[int, int]]:
+    """Yield the start and end sentence index of each segment, in one pass over the sentences
 
+    A segment is closed before the sentence that would bring its number of tokens to the maximum,
+    and the next segment starts with the last `n_overlapping_sentences` sentences of the closed one,
+    though at least one sentence later. A sentence that reaches the maximum on its own is a segment
+    of its own. The token count of a span is the difference of two prefix sums.
+
+    """
+    n_tokens_before = [0] + list(accumulate(n_tokens_per_sentence))
+    n_sentences = len(n_tokens_per_sentence)
+
+    start = 0
     ind = 0
-    n_tokens_in_segment = 0
-    mask_ = []
-    while ind + ind_abs < len(doc.sentences):
+    while ind < n_sentences:
+        if n_tokens_before[ind + 1] - n_tokens_before[start] >= max_words_in_segment:
+            end = ind if ind > start else ind + 1
+            yield start, end
+            start += max(1, end - start - n_overlapping_sentences)
+            ind = max(ind, start)
+        else:
+            ind += 1
+
+    if start < n_sentences:
+        yield start, n_sentences
+
 
-        if n_tokens_in_segment + n_tokens_per_sentence[ind] >= max_words_in_segment:
-            mask[k_segment] = mask_
-            ind_base = max(1, ind - n_overlapping_sentences)
-            n_tokens_per_sentence = n_tokens_per_sentence[ind_base:]
-            k_segment += 1
-            ind_abs += ind_base
+def _segments_of_doc(doc, max_words_in_segment: int, n_overlapping_sentences: int) -> Iterator[str]:
+    sentences = doc.sentences
+    for start, end in _segment_spans(
+            n_tokens_per_sentence=[len(sentence.tokens) for sentence in sentences],
+            max_words_in_segment=max_words_in_segment,
+            n_overlapping_sentences=n_overlapping_sentences,
+    ):
+        yield ' '.join(sentence.text for sentence in sentences[start:end])
 
-            ind = 0
-            n_tokens_in_segment = 0
-            mask_ = []
 
-        n_tokens_in_segment += n_tokens_per_sentence[ind]
-        mask_.append(ind + ind_abs)
-        ind += 1
+def make_segments_of_(text: str, max_words_in_segment: int, n_overlapping_sentences: int) -> List[str]:
+    """Split text into segments of max_words_in_segment words.
+
+    """
+    doc = get_splitter()(text)
+    return list(_segments_of_doc(doc, max_words_in_segment, n_overlapping_sentences))
+
 
-    mask[k_segment] = mask_
+def make_segments_of_many(texts: Iterable[str],
+                          max_words_in_segment: int,
+                          n_overlapping_sentences: int,
+                          batch_size: int = 32) -> Iterator[List[str]]:
+    """Split many texts into segments, yielding the segments of one text at a time
+
+    The texts are read lazily and passed to Stanza in bulk, `batch_size` texts at a time.
+
+    """
+    from stanza import Document
 
-    return [' '.join([doc.sentences[ind].text for ind in mask[k]]) for k in mask]
+    splitter = get_splitter()
+    texts = iter(texts)
+    while True:
+        batch = list(islice(texts, batch_size))
+        if len(batch) == 0:
+            break
+        docs = splitter.bulk_process([Document([], text=text) for text in batch])
+        for doc in docs:
+            yield list(_segments_of_doc(doc, max_words_in_segment, n_overlapping_sentences))
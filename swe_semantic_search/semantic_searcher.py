@@ -1,56 +1,199 @@
 """Perform the semantic search
 
+The search is done by the `SemanticSearcher` class, which loads the embedding model and opens the
+databases once and then answers any number of queries. Executed as a script, the query in the
+configuration file is answered.
+
+With `search.mode` set to `hybrid`, a lexical search with the FTS5 index of the text database is run
+as well, and the two rankings are fused. A query that is the title of a text is answered by the
+lexical search alone, without the embedding model.
+
+The time of loading, embedding, searching the vector database and retrieving the segments is recorded
+with the instrumentation, see `instrumentation.py`.
+
 """
+import time
+import warnings
+from typing import Dict, List, Optional, Union
+
 import yaml
 import sqlite3
 
-from sentence_transformers import SentenceTransformer
-from qdrant_client import QdrantClient
-
-from row_factory import dict_factory
+from embedding import load_embedding_model
+from vector_index import make_vector_index
+from lexical_search import build_fts_index, lexical_search, is_exact_title_match, reciprocal_rank_fusion
+from instrumentation import Instrumentation, make_instrumentation
 
 #
-# Parse the configuration file
-with open('conf.yaml', 'r') as f:
-    config = yaml.safe_load(f)
-with open('sql_strings.yaml', 'r') as f:
-    sql_strings = yaml.safe_load(f)
+# The number of surrogate keys per query of the text database, below the limit of SQLite on the
+# number of variables of a statement, which is 999 in older versions
+_MAX_IDS_PER_QUERY = 900
 
-#
-# Connect to the SQLite database
-conn = sqlite3.connect(config['text_source']['text_data_file'])
-conn.row_factory = dict_factory
-cur = conn.cursor()
 
-#
-# Load the embedding engine
-embedding_model = SentenceTransformer(
-    model_name_or_path=config['embedding_model']['model_name_or_path'],
-    cache_folder=config['embedding_model']['cache_folder'],
-)
+class SemanticSearcher:
+    """Semantic search over the text segments
 
-#
-# Load the vector database
-qdrant_handle = QdrantClient(
-    path=config['vector_db']['path'],
-)
+    Args:
+        config (Dict): The parsed configuration file
+        sql_strings (Dict): The parsed SQL strings file
+        instrumentation (Optional[Instrumentation]): The instrumentation the stages are recorded with.
+            If not given, the one set in the configuration file.
 
-#
-# Embed query and do the semantic similarity search
-query_vector = embedding_model.encode([config['search']['my_query']])[0]
-hits = qdrant_handle.search(
-    collection_name=config['vector_db']['collection_name'],
-    query_vector=query_vector,
-    limit=config['search']['n_results']
-)
+    """
+    def __init__(self, config: Dict, sql_strings: Dict, instrumentation: Optional[Instrumentation] = None):
+        self.config = config
+        self.sql_strings = sql_strings
+        self.output_keys = config['search']['output_keys']
+        self.instrumentation = instrumentation if instrumentation is not None else make_instrumentation(config)
 
-#
-# Retrieve the text segments
-semantically_similar_segments = []
-for hit in hits:
-    cur.execute(sql_strings['sql_select_by_id'], (hit.id,))
-    data = cur.fetchone()
-    semantically_similar_segments.append({field: data[field] for field in config['search']['output_keys']})
-
-for segment in semantically_similar_segments:
-    print('* {}'.format(segment['content']))
+        #
+        # Connect to the SQLite database. Rows are fetched as plain tuples of the output keys
+        self.conn = sqlite3.connect(config['text_source']['text_data_file'])
+        columns = [column_info[1] for column_info in self.conn.execute('PRAGMA table_info(document);')]
+        unknown_keys = [key for key in self.output_keys if key not in columns]
+        if len(unknown_keys) > 0:
+            raise ValueError('Output keys not in the document table: {}'.format(unknown_keys))
+        self.hybrid = config['search'].get('mode', 'semantic') == 'hybrid'
+        if self.hybrid:
+            with self.instrumentation.stage('build_fts_index'):
+                build_fts_index(self.conn, sql_strings, rebuild=False)
+
+        #
+        # Load the embedding engine
+        with self.instrumentation.stage('load_embedding_model'):
+            self.embedding_model = load_embedding_model(config)
+
+        #
+        # Load the vector database. If the output keys are all stored in the payload of the points,
+        # the text segments are served from the payload and the SQLite database is not queried
+        with self.instrumentation.stage('open_vector_index'):
+            self.vector_index = make_vector_index(config)
+        self.hydrate_from_payload = set(self.output_keys) <= set(config['vector_db']['payload_keys'])
+
+    def search(self,
+               queries: List[str],
+               n_results: Optional[Union[int, List[int]]] = None,
+               ) -> List[List[Dict]]:
+        """Search for the text segments semantically similar to each query
+
+        Args:
+            queries (List[str]): The queries, embedded together in one call
+            n_results (Optional[Union[int, List[int]]]): The number of results, for all queries or per query.
+                If not given, the number in the configuration file.
+
+        """
+        if n_results is None:
+            n_results = self.config['search']['n_results']
+        if isinstance(n_results, int):
+            n_results = [n_results] * len(queries)
+
+        if self.hybrid:
+            return self._hybrid_search(queries, n_results)
+
+        #
+        # Embed queries and do the semantic similarity search
+        with self.instrumentation.stage('encode', n_items=len(queries)):
+            query_vectors = self.embedding_model.encode(queries)
+        with self.instrumentation.stage('vector_search', n_items=len(queries)):
+            hits_per_query = self.vector_index.search(
+                query_vectors=query_vectors,
+                limits=n_results,
+                with_payload=self.output_keys if self.hydrate_from_payload else False,
+            )
+
+        return self._retrieve_segments(hits_per_query, from_payload=self.hydrate_from_payload)
+
+    def _hybrid_search(self, queries: List[str], n_results: List[int]) -> List[List[Dict]]:
+        """Search lexically and semantically and fuse the rankings
+
+        """
+        hybrid_config = self.config['search']['hybrid']
+        n_candidates = [max(hybrid_config['n_candidates'], limit) for limit in n_results]
+
+        with self.instrumentation.stage('lexical_search', n_items=len(queries)):
+            lexical_hits = [
+                lexical_search(self.conn, self.sql_strings, query, limit)
+                for query, limit in zip(queries, n_candidates)
+            ]
+
+        #
+        # Queries that are the title of a text are answered by the lexical search alone
+        semantic_inds = [
+            k for k, query in enumerate(queries)
+            if not (hybrid_config['short_circuit_exact_match'] and is_exact_title_match(self.conn, self.sql_strings, query))
+        ]
+        semantic_hits = {}
+        if len(semantic_inds) > 0:
+            with self.instrumentation.stage('encode', n_items=len(semantic_inds)):
+                query_vectors = self.embedding_model.encode([queries[k] for k in semantic_inds])
+            with self.instrumentation.stage('vector_search', n_items=len(semantic_inds)):
+                semantic_hits = dict(zip(semantic_inds, self.vector_index.search(
+                    query_vectors=query_vectors,
+                    limits=[n_candidates[k] for k in semantic_inds],
+                )))
+
+        hits_per_query = []
+        for k, limit in enumerate(n_results):
+            if k in semantic_hits:
+                hits_per_query.append(reciprocal_rank_fusion([lexical_hits[k], semantic_hits[k]], limit, hybrid_config['rrf_k']))
+            else:
+                hits_per_query.append(lexical_hits[k][:limit])
+
+        return self._retrieve_segments(hits_per_query, from_payload=False)
+
+    def _retrieve_segments(self, hits_per_query, from_payload: bool) -> List[List[Dict]]:
+        """Retrieve the text segments of the hits of all queries
+
+        The segments are taken from the payload of the hits if possible, otherwise they are fetched
+        from the SQLite database, in as few queries as the limit on the number of variables allows.
+        Hits that are not in the text database, which happens when it has been rebuilt after the
+        vector index was built, are left out with a warning to rebuild the vector index.
+
+        """
+        n_hits = sum(len(hits) for hits in hits_per_query)
+        with self.instrumentation.stage('retrieve_segments', n_items=n_hits):
+            if from_payload:
+                return [
+                    [{key: hit.payload[key] for key in self.output_keys} for hit in hits]
+                    for hits in hits_per_query
+                ]
+
+            ids = list({hit.id for hits in hits_per_query for hit in hits})
+            if len(ids) == 0:
+                return [[] for _ in hits_per_query]
+            rows = {}
+            for start in range(0, len(ids), _MAX_IDS_PER_QUERY):
+                chunk = ids[start:start + _MAX_IDS_PER_QUERY]
+                sql = self.sql_strings['sql_select_by_ids'].format(
+                    columns=', '.join(self.output_keys),
+                    placeholders=', '.join(['?'] * len(chunk)),
+                )
+                rows.update((row[0], row[1:]) for row in self.conn.execute(sql, chunk))
+            if len(rows) < len(ids):
+                warnings.warn('{} hits of the vector index are not in the text database, the vector index is '
+                              'out of date; rebuild it with make_vec_db.py'.format(len(ids) - len(rows)))
+
+            return [
+                [dict(zip(self.output_keys, rows[hit.id])) for hit in hits if hit.id in rows]
+                for hits in hits_per_query
+            ]
+
+
+if __name__ == '__main__':
+    #
+    # Parse the configuration file
+    time_start = time.perf_counter()
+    with open('conf.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+    with open('sql_strings.yaml', 'r') as f:
+        sql_strings = yaml.safe_load(f)
+    instrumentation = make_instrumentation(config)
+    instrumentation.record('parse_config', time.perf_counter() - time_start)
+    instrumentation.start()
+
+    searcher = SemanticSearcher(config, sql_strings, instrumentation=instrumentation)
+    semantically_similar_segments = searcher.search([config['search']['my_query']])[0]
+
+    for segment in semantically_similar_segments:
+        print('* {}'.format(segment['content']))
+    instrumentation.finish()
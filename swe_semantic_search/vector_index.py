@@ -0,0 +1,564 @@
+"""Vector index backends for the semantic search
+
+Two backends are available, selected by `vector_db.backend` in the configuration file:
+
+* `qdrant`: the Qdrant vector database, run locally through `QdrantClient(path=...)`
+* `numpy`: normalized embeddings in a memory-mapped matrix, searched with vectorized matrix products.
+  This avoids the startup and per-query overhead of Qdrant for corpora up to a few million segments.
+
+Both backends have the same interface, so the scripts work unchanged against either. Both can compress
+the vectors, with scalar int8 or binary quantization, and rescore an oversampled set of candidates
+found with the compressed vectors with the original vectors. The settings are in `vector_db.compression`.
+
+"""
+import os
+import json
+import sqlite3
+from collections import namedtuple
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+from qdrant_client import QdrantClient, models
+
+Hit = namedtuple('Hit', ['id', 'score', 'payload'])
+
+
+class QdrantIndex:
+    """Vector index in a local Qdrant database
+
+    With compression, Qdrant keeps the quantized vectors in memory and the original vectors on disk,
+    and rescores an oversampled set of candidates with the original vectors. Qdrant run locally
+    through `QdrantClient(path=...)` searches exhaustively and does not use the quantized vectors;
+    the compression takes effect with a Qdrant server.
+
+    Args:
+        path (str): The path to the Qdrant database
+        collection_name (str): The name of the collection
+        compression (Optional[Dict]): The compression settings: `method` is `none`, `scalar_int8` or
+            `binary`, and `oversampling` the number of candidates to rescore per result
+
+    """
+    def __init__(self, path: str, collection_name: str, compression: Optional[Dict] = None):
+        self.collection_name = collection_name
+        self.compression = compression
+        self.client = QdrantClient(path=path)
+
+        self._method = 'none' if compression is None else compression['method']
+        if compression is not None and compression.get('pca_dim') is not None:
+            raise ValueError('Dimensionality reduction is not available with the Qdrant backend')
+        if self._method == 'none':
+            self._quantization_config = None
+            self._search_params = None
+        else:
+            if self._method == 'scalar_int8':
+                self._quantization_config = models.ScalarQuantization(
+                    scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True),
+                )
+            elif self._method == 'binary':
+                self._quantization_config = models.BinaryQuantization(
+                    binary=models.BinaryQuantizationConfig(always_ram=True),
+                )
+            else:
+                raise ValueError('Unknown compression method: {}'.format(self._method))
+            self._search_params = models.SearchParams(
+                quantization=models.QuantizationSearchParams(rescore=True, oversampling=compression['oversampling']),
+            )
+
+    def exists(self) -> bool:
+        return self.client.collection_exists(self.collection_name)
+
+    def recreate(self, dim: int):
+        self.client.recreate_collection(
+            collection_name=self.collection_name,
+            vectors_config=models.VectorParams(
+                size=dim,
+                distance=models.Distance.COSINE,
+                on_disk=self._quantization_config is not None,
+            ),
+            quantization_config=self._quantization_config,
+        )
+
+    def upsert(self, ids: List[int], vectors: np.ndarray, payloads: List[Dict]):
+        self.client.upsert(
+            collection_name=self.collection_name,
+            points=[
+                models.PointStruct(id=point_id, vector=vector.tolist(), payload=payload)
+                for point_id, vector, payload in zip(ids, vectors, payloads)
+            ],
+        )
+
+    def delete(self, ids: List[int]):
+        self.client.delete(
+            collection_name=self.collection_name,
+            points_selector=models.PointIdsList(points=ids),
+        )
+
+    def search(self,
+               query_vectors: np.ndarray,
+               limits: List[int],
+               with_payload: Union[bool, List[str]] = False,
+               exact: bool = False,
+               ) -> List[List[Hit]]:
+        return self.client.search_batch(
+            collection_name=self.collection_name,
+            requests=[
+                models.SearchRequest(
+                    vector=query_vector.tolist(),
+                    limit=limit,
+                    with_payload=with_payload,
+                    params=models.SearchParams(exact=True) if exact else self._search_params,
+                )
+                for query_vector, limit in zip(query_vectors, limits)
+            ],
+        )
+
+    def compress(self):
+        """Apply the compression settings to the collection, which may have been created with others
+
+        Qdrant makes the quantized vectors itself as points are upserted. With the method `none`, the
+        quantization of the collection is removed.
+
+        """
+        self.client.update_collection(
+            collection_name=self.collection_name,
+            vectors_config={'': models.VectorParamsDiff(on_disk=self._quantization_config is not None)},
+            quantization_config=self._quantization_config if self._quantization_config is not None else models.Disabled.DISABLED,
+        )
+
+    @staticmethod
+    def _method_of_quantization_config(quantization_config) -> str:
+        if quantization_config is None:
+            return 'none'
+        if isinstance(quantization_config, models.ScalarQuantization):
+            return 'scalar_{}'.format(quantization_config.scalar.type.value)
+        if isinstance(quantization_config, models.BinaryQuantization):
+            return 'binary'
+        return type(quantization_config).__name__
+
+    def compression_report(self, n_queries: int = 100, k: int = 10) -> Dict:
+        """Estimated memory of the vectors searched in memory, and recall@k of the search against exact search
+
+        The compression method is the one of the collection, which is the one it was created with
+        unless `compress` has been called since. Qdrant run locally reports no compression, as it
+        does not use it. The queries are the first stored vectors.
+
+        """
+        info = self.client.get_collection(self.collection_name)
+        size = info.points_count
+        dim = info.config.params.vectors.size
+        method = self._method_of_quantization_config(info.config.quantization_config)
+        full_bytes = size * dim * 4
+        compressed_bytes = {
+            'none': full_bytes, 'scalar_int8': size * dim, 'binary': size * -(-dim // 8),
+        }.get(method, full_bytes)
+
+        points, _ = self.client.scroll(self.collection_name, limit=n_queries, with_vectors=True)
+        query_vectors = np.array([point.vector for point in points], dtype=np.float32)
+        recall = 1.0
+        if len(points) > 0:
+            limits = [min(k, size)] * len(points)
+            exact = self.search(query_vectors, limits, exact=True)
+            compressed = self.search(query_vectors, limits)
+            recall = float(np.mean([
+                len({hit.id for hit in hits_compressed} & {hit.id for hit in hits_exact}) / len(hits_exact)
+                for hits_compressed, hits_exact in zip(compressed, exact)
+            ]))
+
+        return {
+            'method': method,
+            'n_vectors': size,
+            'full_bytes': full_bytes,
+            'compressed_bytes': compressed_bytes,
+            'recall_at_k': recall,
+            'k': k,
+        }
+
+    def close(self):
+        self.client.close()
+
+
+class NumpyIndex:
+    """Vector index of normalized embeddings in a memory-mapped matrix
+
+    The index is a folder with the matrix of embeddings, the `surrogate_key` of each row, the
+    payloads in SQLite and a small metadata file. The rows are kept dense: a deleted row is
+    replaced by the last row. Cosine similarity is the inner product of normalized vectors,
+    and the top-k rows are found with `argpartition`, one block of rows at a time.
+
+    The index can be compressed after it is built, see `compress`.
+
+    Args:
+        path (str): The folder of the index
+        dtype (str): The data type of the stored embeddings, `float32` or `float16`
+        block_size (int): The number of rows scored at a time, which bounds the memory of a search
+        compression (Optional[Dict]): The compression settings: `method` is `none`, `scalar_int8` or
+            `binary`, `oversampling` the number of candidates to rescore per result, `pca_dim` the
+            dimension after PCA or None for no reduction, and `sample_size` the number of vectors
+            the compression is fitted on
+
+    """
+    def __init__(self,
+                 path: str,
+                 dtype: str = 'float32',
+                 block_size: int = 65536,
+                 compression: Optional[Dict] = None,
+                 ):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        self.compression = compression
+        self._meta_file = os.path.join(path, 'meta.json')
+        self._compressed = None
+        self._compression_params = {}
+
+        self._vectors = None
+        self._keys = None
+        self._row_of_key = {}
+        self._meta = None
+        self._payload_db = None
+        if self.exists():
+            with open(self._meta_file, 'r') as f:
+                self._meta = json.load(f)
+            self._open()
+
+    def exists(self) -> bool:
+        return os.path.exists(self._meta_file)
+
+    def _open(self):
+        capacity, dim = self._meta['capacity'], self._meta['dim']
+        self._vectors = np.memmap(os.path.join(self.path, 'vectors.bin'), dtype=self._meta['dtype'],
+                                  mode='r+', shape=(capacity, dim))
+        self._keys = np.memmap(os.path.join(self.path, 'keys.bin'), dtype=np.int64,
+                               mode='r+', shape=(capacity,))
+        self._row_of_key = {int(key): row for row, key in enumerate(self._keys[:self._meta['size']])}
+        self._payload_db = sqlite3.connect(os.path.join(self.path, 'payload.db'))
+        self._payload_db.execute('CREATE TABLE IF NOT EXISTS payload (id INTEGER PRIMARY KEY, data TEXT NOT NULL);')
+        self._load_compression()
+
+    def _flush(self):
+        self._vectors.flush()
+        self._keys.flush()
+        self._payload_db.commit()
+        with open(self._meta_file, 'w') as f:
+            json.dump(self._meta, f)
+
+    def _allocate(self, capacity: int):
+        """Create the matrix files with room for `capacity` rows, keeping the rows in use
+
+        """
+        size, dim = self._meta['size'], self._meta['dim']
+        for name, dtype, shape, old in (('vectors.bin', self._meta['dtype'], (capacity, dim), self._vectors),
+                                        ('keys.bin', np.int64, (capacity,), self._keys)):
+            tmp_file = os.path.join(self.path, name + '.tmp')
+            new = np.memmap(tmp_file, dtype=dtype, mode='w+', shape=shape)
+            if old is not None:
+                new[:size] = old[:size]
+            new.flush()
+            del new
+            os.replace(tmp_file, os.path.join(self.path, name))
+        self._meta['capacity'] = capacity
+
+    def recreate(self, dim: int):
+        os.makedirs(self.path, exist_ok=True)
+        if self._payload_db is not None:
+            self._payload_db.close()
+        payload_file = os.path.join(self.path, 'payload.db')
+        if os.path.exists(payload_file):
+            os.remove(payload_file)
+
+        self._vectors = None
+        self._keys = None
+        self._meta = {'dim': dim, 'dtype': self.dtype.name, 'size': 0, 'capacity': 0, 'compression': None}
+        self._allocate(1024)
+        self._open()
+        self._flush()
+
+    def __len__(self):
+        return self._meta['size'] if self._meta is not None else 0
+
+    def upsert(self, ids: List[int], vectors: np.ndarray, payloads: List[Dict]):
+        self._invalidate_compression()
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        n_new = len({point_id for point_id in ids if point_id not in self._row_of_key})
+        if self._meta['size'] + n_new > self._meta['capacity']:
+            capacity = self._meta['capacity']
+            while self._meta['size'] + n_new > capacity:
+                capacity *= 2
+            self._allocate(capacity)
+            self._payload_db.close()
+            self._open()
+
+        for point_id, vector in zip(ids, vectors):
+            row = self._row_of_key.get(point_id)
+            if row is None:
+                row = self._meta['size']
+                self._meta['size'] += 1
+                self._row_of_key[point_id] = row
+                self._keys[row] = point_id
+            self._vectors[row] = vector
+        self._payload_db.executemany(
+            'INSERT OR REPLACE INTO payload (id, data) VALUES (?, ?);',
+            [(point_id, json.dumps(payload)) for point_id, payload in zip(ids, payloads)],
+        )
+        self._flush()
+
+    def delete(self, ids: List[int]):
+        self._invalidate_compression()
+        for point_id in ids:
+            row = self._row_of_key.pop(point_id, None)
+            if row is None:
+                continue
+            last = self._meta['size'] - 1
+            if row != last:
+                last_key = int(self._keys[last])
+                self._vectors[row] = self._vectors[last]
+                self._keys[row] = last_key
+                self._row_of_key[last_key] = row
+            self._meta['size'] = last
+        self._payload_db.executemany('DELETE FROM payload WHERE id = ?;', [(point_id,) for point_id in ids])
+        self._flush()
+
+    def _payloads(self, ids: List[int], with_payload: Union[bool, List[str]]) -> Dict[int, Optional[Dict]]:
+        if with_payload is False or len(ids) == 0:
+            return {}
+        sql = 'SELECT id, data FROM payload WHERE id IN ({});'.format(', '.join(['?'] * len(ids)))
+        payloads = {point_id: json.loads(data) for point_id, data in self._payload_db.execute(sql, ids)}
+        if with_payload is not True:
+            payloads = {point_id: {key: payload[key] for key in with_payload} for point_id, payload in payloads.items()}
+        return payloads
+
+    def _top_k_rows(self, scores_of_block, n_queries: int, k: int):
+        """Find the k rows with the highest score for each query, sorted by score
+
+        The queries are scored together against one block of rows at a time, and the running top-k
+        of each query is merged with the top-k of the block.
+
+        """
+        size = len(self)
+        best_scores = np.full((n_queries, 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((n_queries, 0), dtype=np.int64)
+        for start in range(0, size, self.block_size):
+            end = min(start + self.block_size, size)
+            scores = np.concatenate([best_scores, scores_of_block(start, end)], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, end), (n_queries, end - start))], axis=1)
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                rows = np.take_along_axis(rows, top, axis=1)
+            best_scores, best_rows = scores, rows
+
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
+
+    def _search_rows(self, query_vectors: np.ndarray, k: int):
+        """Exact search with the stored vectors
+
+        """
+        return self._top_k_rows(
+            lambda start, end: query_vectors @ np.asarray(self._vectors[start:end], dtype=np.float32).T,
+            n_queries=query_vectors.shape[0],
+            k=k,
+        )
+
+    def _search_rows_compressed(self, query_vectors: np.ndarray, k: int):
+        """Search with the compressed vectors, then rescore the candidates with the stored vectors
+
+        """
+        n_candidates = min(len(self), int(np.ceil(k * self.compression['oversampling'])))
+        _, candidate_rows = self._top_k_rows(
+            self._compressed_scorer(query_vectors),
+            n_queries=query_vectors.shape[0],
+            k=n_candidates,
+        )
+
+        scores = np.stack([
+            np.asarray(self._vectors[np.sort(rows)], dtype=np.float32) @ query_vector
+            for query_vector, rows in zip(query_vectors, candidate_rows)
+        ])
+        candidate_rows = np.sort(candidate_rows, axis=1)
+        top = np.argsort(-scores, axis=1)[:, :k]
+        return np.take_along_axis(scores, top, axis=1), np.take_along_axis(candidate_rows, top, axis=1)
+
+    def search(self,
+               query_vectors: np.ndarray,
+               limits: List[int],
+               with_payload: Union[bool, List[str]] = False,
+               exact: bool = False,
+               ) -> List[List[Hit]]:
+        """Find the rows with the highest cosine similarity to each query
+
+        If the index is compressed and `exact` is not set, the compressed vectors are searched
+        first and an oversampled set of candidates is rescored with the stored vectors.
+
+        """
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        query_vectors = query_vectors / np.maximum(np.linalg.norm(query_vectors, axis=1, keepdims=True), 1e-12)
+        n_queries = query_vectors.shape[0]
+        k = min(max(limits), len(self))
+        if k == 0:
+            return [[] for _ in range(n_queries)]
+
+        if self._compressed is not None and not exact:
+            best_scores, best_rows = self._search_rows_compressed(query_vectors, k)
+        else:
+            best_scores, best_rows = self._search_rows(query_vectors, k)
+        best_keys = self._keys[:len(self)][best_rows]
+
+        payloads = self._payloads(list({int(key) for key in best_keys.ravel()}), with_payload)
+        return [
+            [Hit(id=int(key), score=float(score), payload=payloads.get(int(key)))
+             for key, score in zip(best_keys[q, :limit], best_scores[q, :limit])]
+            for q, limit in enumerate(limits)
+        ]
+
+    #
+    # Compression of the vectors. The compressed vectors are derived from the stored vectors after the
+    # index is built, and are kept in memory, while the stored vectors stay on disk and are only read
+    # for the rescoring. Any change of the index invalidates the compressed vectors.
+    def _project(self, vectors: np.ndarray, center: bool = True) -> np.ndarray:
+        """Center and reduce the stored vectors. Queries are not centered, since the inner product
+        of a query with the mean is the same for all rows and does not change the ranking.
+
+        """
+        if center:
+            vectors = vectors - self._compression_params['mean']
+        if 'components' not in self._compression_params:
+            return vectors
+        return vectors @ self._compression_params['components'].T
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        projected = self._project(vectors)
+        if self.compression['method'] == 'scalar_int8':
+            codes = np.rint(projected / self._compression_params['scale'] * 127.0)
+            return np.clip(codes, -127, 127).astype(np.int8)
+        elif self.compression['method'] == 'binary':
+            return np.packbits(projected > 0, axis=1)
+        else:
+            raise ValueError('Unknown compression method: {}'.format(self.compression['method']))
+
+    def _compressed_scorer(self, query_vectors: np.ndarray):
+        projected = self._project(query_vectors, center=False)
+        if self.compression['method'] == 'scalar_int8':
+            projected = projected * self._compression_params['scale'] / 127.0
+            return lambda start, end: projected @ self._compressed[start:end].astype(np.float32).T
+        else:
+            code_dim = projected.shape[1]
+            return lambda start, end: projected @ (
+                2.0 * np.unpackbits(self._compressed[start:end], axis=1, count=code_dim).astype(np.float32) - 1.0
+            ).T
+
+    def _compression_id(self) -> Optional[Dict]:
+        if self.compression is None or self.compression['method'] == 'none':
+            return None
+        return {'method': self.compression['method'], 'pca_dim': self.compression.get('pca_dim')}
+
+    def _invalidate_compression(self):
+        self._compressed = None
+        if self._meta is not None:
+            self._meta['compression'] = None
+
+    def _load_compression(self):
+        """Load the compressed vectors, if they were made with the current compression settings
+
+        """
+        self._compressed = None
+        if self._meta.get('compression') is not None and self._meta['compression'] == self._compression_id():
+            with np.load(os.path.join(self.path, 'compression.npz')) as params:
+                self._compression_params = {name: params[name] for name in params.files}
+            self._compressed = np.load(os.path.join(self.path, 'compressed.npy'))
+
+    def compress(self):
+        """Compress the stored vectors as set by the compression settings
+
+        The vectors are centered on the mean of a sample of the stored vectors, which matters for the
+        sign bits of the binary quantization. The dimensionality reduction, if any, is fitted with PCA
+        on the sample, and the scale of the scalar quantization is a high quantile of each dimension.
+
+        """
+        if self._compression_id() is None or len(self) == 0:
+            return
+        size = len(self)
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(rng.choice(size, size=min(size, self.compression['sample_size']), replace=False))
+        sample = np.asarray(self._vectors[sample_rows], dtype=np.float32)
+
+        self._compression_params = {'mean': sample.mean(axis=0)}
+        if self.compression.get('pca_dim') is not None:
+            _, _, components = np.linalg.svd(sample - self._compression_params['mean'], full_matrices=False)
+            self._compression_params['components'] = components[:self.compression['pca_dim']]
+        if self.compression['method'] == 'scalar_int8':
+            self._compression_params['scale'] = np.maximum(
+                np.quantile(np.abs(self._project(sample)), 0.99, axis=0), 1e-6
+            ).astype(np.float32)
+
+        self._compressed = np.concatenate([
+            self._encode(np.asarray(self._vectors[start:min(start + self.block_size, size)], dtype=np.float32))
+            for start in range(0, size, self.block_size)
+        ])
+        np.savez(os.path.join(self.path, 'compression.npz'), **self._compression_params)
+        np.save(os.path.join(self.path, 'compressed.npy'), self._compressed)
+        self._meta['compression'] = self._compression_id()
+        self._flush()
+
+    def compression_report(self, n_queries: int = 100, k: int = 10) -> Dict:
+        """Memory of the vectors searched in memory, and recall@k of the compressed search against exact search
+
+        The queries are a fixed random sample of the stored vectors.
+
+        """
+        size = len(self)
+        full_bytes = size * self._meta['dim'] * np.dtype(self._meta['dtype']).itemsize
+        report = {
+            'method': self.compression['method'] if self._compressed is not None else 'none',
+            'n_vectors': size,
+            'full_bytes': full_bytes,
+            'compressed_bytes': self._compressed.nbytes if self._compressed is not None else full_bytes,
+            'recall_at_k': 1.0,
+            'k': k,
+        }
+        if self._compressed is None or size == 0:
+            return report
+
+        rng = np.random.default_rng(1)
+        query_rows = np.sort(rng.choice(size, size=min(size, n_queries), replace=False))
+        query_vectors = np.asarray(self._vectors[query_rows], dtype=np.float32)
+        limits = [min(k, size)] * len(query_rows)
+        exact = self.search(query_vectors, limits, exact=True)
+        compressed = self.search(query_vectors, limits)
+        report['recall_at_k'] = float(np.mean([
+            len({hit.id for hit in hits_compressed} & {hit.id for hit in hits_exact}) / len(hits_exact)
+            for hits_compressed, hits_exact in zip(compressed, exact)
+        ]))
+        return report
+
+    def close(self):
+        if self._payload_db is not None:
+            self._flush()
+            self._payload_db.close()
+
+
+def make_vector_index(config: Dict):
+    """Make the vector index backend set in the configuration file
+
+    Args:
+        config (Dict): The parsed configuration file
+
+    """
+    vector_db_config = config['vector_db']
+    backend = vector_db_config.get('backend', 'qdrant')
+    if backend == 'qdrant':
+        return QdrantIndex(
+            path=vector_db_config['path'],
+            collection_name=vector_db_config['collection_name'],
+            compression=vector_db_config.get('compression'),
+        )
+    elif backend == 'numpy':
+        return NumpyIndex(
+            path=vector_db_config['path'],
+            dtype=vector_db_config.get('dtype', 'float32'),
+            compression=vector_db_config.get('compression'),
+        )
+    else:
+        raise ValueError('Unknown vector database backend: {}'.format(backend))
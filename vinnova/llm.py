@@ -5,18 +5,76 @@ Written by: Anders Ohrn, 2024 May
 """
 import os
 import json
-from typing import List, Dict, Optional, Union
+import asyncio
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Union, Callable, Iterator, Generator
 
 from openai import OpenAI
-from openai.types.chat import ChatCompletionMessage
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessage
 from mistralai.client import MistralClient
 
 from vinnova_drl import VinnovaDataRetrievalLayer
+from vinnova_api import run_in_background_loop
+from llm_cache import LLMResponseCache, canonical_request
+
+
+#
+# The tokens of a message besides its content, such as the role, as counted by OpenAI
+_MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def _approximate_token_count(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+def get_token_counter(model: Optional[str] = None) -> Callable[[str], int]:
+    """Return a function that counts the tokens of a text for the model
+
+    The count is made with the `tiktoken` package. If it is not installed, or has no encoding for the
+    model, the count is approximated as one token per four characters.
+
+    """
+    try:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model) if model is not None else tiktoken.get_encoding('cl100k_base')
+        except KeyError:
+            encoding = tiktoken.get_encoding('cl100k_base')
+    except Exception:
+        return _approximate_token_count
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def _role(row: Union[Dict, ChatCompletionMessage]) -> str:
+    return row['role'] if isinstance(row, Dict) else row.role
 
 
 class MessageStack:
-    def __init__(self):
+    """The messages of the conversation, with a running count of their tokens
+
+    The tokens of a message are counted once, when it is added, and the count of the stack is kept as
+    messages are added or deleted. With a token budget, the stack is compacted when it exceeds the
+    budget, see `compact`.
+
+    Args:
+        token_budget (Optional[int]): The maximum number of tokens of the stack. If not given, no limit
+        count_tokens (Optional[Callable[[str], int]]): The function that counts the tokens of a text. If
+            not given, one token per four characters.
+        compacted_tool_tokens (int): The number of tokens old tool messages are truncated to in compaction
+
+    """
+    def __init__(self,
+                 token_budget: Optional[int] = None,
+                 count_tokens: Optional[Callable[[str], int]] = None,
+                 compacted_tool_tokens: int = 200,
+                 ):
         self._message_collection = []
+        self._token_counts = []
+        self.n_tokens = 0
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens if count_tokens is not None else _approximate_token_count
+        self.compacted_tool_tokens = compacted_tool_tokens
 
     def __repr__(self):
         ret_str = ''
@@ -29,14 +87,34 @@ class MessageStack:
             ret_str += '\n'
         return ret_str[:-51]
 
+    def _count_message_tokens(self, row: Union[Dict, ChatCompletionMessage]) -> int:
+        if isinstance(row, Dict):
+            text = row.get('content') or ''
+        else:
+            text = row.content or ''
+            for tool_call in row.tool_calls or []:
+                text += tool_call.function.name + tool_call.function.arguments
+        return self.count_tokens(text) + _MESSAGE_OVERHEAD_TOKENS
+
     def _add_payload(self, payload: Union[Dict[str, str], ChatCompletionMessage]):
         self._message_collection.append(payload)
+        n_tokens = self._count_message_tokens(payload)
+        self._token_counts.append(n_tokens)
+        self.n_tokens += n_tokens
+        if self.token_budget is not None and self.n_tokens > self.token_budget:
+            self.compact()
+
+    def _set_content(self, index: int, content: str):
+        self._message_collection[index]['content'] = content
+        n_tokens = self._count_message_tokens(self._message_collection[index])
+        self.n_tokens += n_tokens - self._token_counts[index]
+        self._token_counts[index] = n_tokens
 
     def set_system_instruction(self, value: str):
-        for row in self._message_collection:
+        for index, row in enumerate(self._message_collection):
             if isinstance(row, Dict):
                 if row['role'] == 'system':
-                    row['content'] = value
+                    self._set_content(index, value)
                     break
         else:
             self._add_payload({'role': 'system', 'content': value})
@@ -57,10 +135,40 @@ class MessageStack:
 
     def delete(self, slc):
         del self._message_collection[slc]
+        del self._token_counts[slc]
+        self.n_tokens = sum(self._token_counts)
+
+    def compact(self):
+        """Compact the stack until it is within the token budget
+
+        The latest turn, from the last user message on, and the system instruction are kept as they are.
+        First, the tool messages of earlier turns are truncated. If that is not enough, the earliest
+        turns are dropped, each with its user message, assistant messages and tool messages, so that no
+        tool message is left without the assistant message that called the tool.
 
+        """
+        turn_starts = [k for k, row in enumerate(self._message_collection) if _role(row) == 'user']
+        if len(turn_starts) < 2:
+            return
+
+        for index in range(turn_starts[-1]):
+            if self.n_tokens <= self.token_budget:
+                return
+            row = self._message_collection[index]
+            n_content_tokens = self._token_counts[index] - _MESSAGE_OVERHEAD_TOKENS
+            if _role(row) == 'tool' and n_content_tokens > 2 * self.compacted_tool_tokens:
+                n_chars = len(row['content']) * self.compacted_tool_tokens // n_content_tokens
+                self._set_content(
+                    index, f'{row["content"][:n_chars]} ... [truncated from {n_content_tokens} tokens]'
+                )
+
+        while self.n_tokens > self.token_budget and len(turn_starts) > 1:
+            self.delete(slice(turn_starts[0], turn_starts[1]))
+            turn_starts = [k for k, row in enumerate(self._message_collection) if _role(row) == 'user']
 
-def get_openai_client() -> OpenAI:
-    return OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+
+def get_openai_client(base_url: Optional[str] = None) -> OpenAI:
+    return OpenAI(api_key=os.environ.get('OPENAI_API_KEY'), base_url=base_url)
 
 
 def send_request_to_openai_chat_completion(
@@ -75,6 +183,7 @@ def send_request_to_openai_chat_completion(
         frequency_penalty: float = 0.0,
         presence_penalty: float = 0.0,
         n_completions: int = 1,
+        stream: bool = False,
 ):
     kwargs = {
         'model': model,
@@ -88,6 +197,8 @@ def send_request_to_openai_chat_completion(
         'presence_penalty': presence_penalty,
         'n': n_completions
     }
+    if stream:
+        kwargs['stream'] = True
     if tools is None:
         del kwargs['tools']
         del kwargs['tool_choice']
@@ -100,22 +211,186 @@ def send_request_to_openai_chat_completion(
     return openai_completion
 
 
+def _assemble_streamed_message(chunks, index: int = 0) -> Generator[str, None, ChatCompletionMessage]:
+    """Yield the content deltas of a choice of a streamed completion, the first by default, and return
+    the message they make up, with the tool calls assembled from their streamed fragments
+
+    """
+    content = []
+    tool_calls = {}
+    for chunk in chunks:
+        for choice in chunk.choices:
+            if choice.index != index:
+                continue
+            delta = choice.delta
+            if delta.content:
+                content.append(delta.content)
+                yield delta.content
+            for tool_call_delta in delta.tool_calls or []:
+                tool_call = tool_calls.setdefault(tool_call_delta.index, {
+                    'id': None, 'type': 'function', 'function': {'name': '', 'arguments': ''},
+                })
+                if tool_call_delta.id:
+                    tool_call['id'] = tool_call_delta.id
+                if tool_call_delta.function is not None:
+                    tool_call['function']['name'] += tool_call_delta.function.name or ''
+                    tool_call['function']['arguments'] += tool_call_delta.function.arguments or ''
+
+    return ChatCompletionMessage(
+        role='assistant',
+        content=''.join(content) if len(content) > 0 else None,
+        tool_calls=[tool_calls[index] for index in sorted(tool_calls)] if len(tool_calls) > 0 else None,
+    )
+
+
+def _drain(generator: Generator):
+    """Exhaust the generator and return its return value
+
+    """
+    while True:
+        try:
+            next(generator)
+        except StopIteration as e:
+            return e.value
+
+
+def _completion_of_chunks(chunks: List[ChatCompletionChunk]) -> ChatCompletion:
+    """The completion made up by the chunks of a streamed completion, with all its choices
+
+    """
+    finish_reasons = {}
+    for chunk in chunks:
+        for choice in chunk.choices:
+            if choice.finish_reason is not None or choice.index not in finish_reasons:
+                finish_reasons[choice.index] = choice.finish_reason
+    return ChatCompletion.model_validate({
+        'id': chunks[0].id,
+        'object': 'chat.completion',
+        'created': chunks[0].created,
+        'model': chunks[0].model,
+        'choices': [
+            {
+                'index': index,
+                'message': _drain(_assemble_streamed_message(chunks, index)).model_dump(),
+                'finish_reason': finish_reasons[index] or 'stop',
+            }
+            for index in sorted(finish_reasons)
+        ],
+    })
+
+
+def _chunks_of_completion(completion: ChatCompletion) -> Iterator[ChatCompletionChunk]:
+    """Replay a completion as a stream, one chunk per choice
+
+    """
+    for choice in completion.choices:
+        delta = {'role': 'assistant', 'content': choice.message.content}
+        if choice.message.tool_calls:
+            delta['tool_calls'] = [
+                {
+                    'index': k,
+                    'id': tool_call.id,
+                    'type': 'function',
+                    'function': {'name': tool_call.function.name, 'arguments': tool_call.function.arguments},
+                }
+                for k, tool_call in enumerate(choice.message.tool_calls)
+            ]
+        yield ChatCompletionChunk.model_validate({
+            'id': completion.id,
+            'object': 'chat.completion.chunk',
+            'created': completion.created,
+            'model': completion.model,
+            'choices': [{'index': choice.index, 'delta': delta, 'finish_reason': choice.finish_reason}],
+        })
+
+
+def _record_stream(cache: LLMResponseCache, request_json: str, chunks) -> Iterator[ChatCompletionChunk]:
+    """Pass the chunks of a streamed completion through, and store the completion once the stream is done
+
+    """
+    collected = []
+    for chunk in chunks:
+        collected.append(chunk)
+        yield chunk
+    if len(collected) > 0:
+        cache.put(request_json, _completion_of_chunks(collected).model_dump_json())
+
+
+def send_cached_request_to_openai_chat_completion(
+        cache: LLMResponseCache,
+        client: Optional[OpenAI],
+        stream: bool = False,
+        **kwargs,
+):
+    """Send the chat completion request as `send_request_to_openai_chat_completion`, through the cache
+
+    The request is keyed by its canonical JSON, with the defaults of the parameters applied, so the
+    same request is the same key whether its parameters are given or defaulted. Streamed and
+    non-streamed requests share their responses, and a stored response is returned as a stream if one
+    is requested. In replay mode, the client is not used and can be None.
+
+    Args:
+        cache (LLMResponseCache): The response cache
+        client (Optional[OpenAI]): The client, used for requests without a stored response
+        stream (bool): If True, the completion is returned as an iterator of chunks
+        **kwargs: The parameters of `send_request_to_openai_chat_completion`
+
+    """
+    request = inspect.signature(send_request_to_openai_chat_completion).bind(client=None, **kwargs)
+    request.apply_defaults()
+    request = {name: value for name, value in request.arguments.items() if name not in ('client', 'stream')}
+    request_json = canonical_request(request)
+
+    response_json = cache.get(request_json)
+    if response_json is not None:
+        completion = ChatCompletion.model_validate_json(response_json)
+        return _chunks_of_completion(completion) if stream else completion
+
+    response = send_request_to_openai_chat_completion(client=client, stream=stream, **kwargs)
+    if stream:
+        return _record_stream(cache, request_json, response)
+    cache.put(request_json, response.model_dump_json())
+    return response
+
+
 class SemanticEngine:
     """Bla bla
 
+    The tool calls of a response are run concurrently, up to `max_parallel_tools` at a time. A tool
+    call that fails gets an error as its tool message, so the other tool calls of the turn are not
+    affected.
+
+    With a `token_budget`, the message stack is compacted when it exceeds the budget, so the requests
+    do not grow without bound, see `MessageStack.compact`.
+
+    With `process_stream`, the completions are streamed and the content is yielded as it arrives. The
+    messages added to the message stack are the same as with `process`.
+
+    With a `response_cache`, the completions are served from the cache when the same request has been
+    made before, and the tool results when the same tool call has been made before. In replay mode of
+    the cache, no request is sent, no tool is called and the client can be None, see `llm_cache`.
+
     """
     def __init__(self,
-                 client: Union[OpenAI, MistralClient],
+                 client: Optional[Union[OpenAI, MistralClient]],
                  system_definition: str,
                  llm_params: Dict,
                  tools: Optional[List[VinnovaDataRetrievalLayer]] = None,
-                 respond_to_function: bool = True
+                 respond_to_function: bool = True,
+                 max_parallel_tools: int = 4,
+                 token_budget: Optional[int] = None,
+                 response_cache: Optional[LLMResponseCache] = None,
                  ):
         self.client = client
-        self.message_stack = MessageStack()
+        self.response_cache = response_cache
+        self.message_stack = MessageStack(
+            token_budget=token_budget,
+            count_tokens=get_token_counter(llm_params.get('model')),
+        )
         self.message_stack.set_system_instruction(system_definition)
         self.llm_params = llm_params
         self.respond_to_function = respond_to_function
+        self.max_parallel_tools = max_parallel_tools
 
         self.tools_str = None
         if tools is not None:
@@ -125,38 +400,91 @@ class SemanticEngine:
         self.tools = tools
 
     def process(self, user_message: str):
+        for _ in self._process(user_message, stream=False):
+            pass
+
+    def process_stream(self, user_message: str) -> Iterator[str]:
+        """Process the user message as `process`, and yield the content of the completions as it arrives
+
+        """
+        yield from self._process(user_message, stream=True)
+
+    def _complete(self, stream: bool) -> Generator[str, None, ChatCompletionMessage]:
+        """Request a completion of the message stack and return its message, yielding its content if streamed
+
+        """
+        if self.response_cache is None:
+            response = send_request_to_openai_chat_completion(
+                client=self.client,
+                messages=self.message_stack.get_message_stack(),
+                tools=self.tools_str,
+                stream=stream,
+                **self.llm_params
+            )
+        else:
+            response = send_cached_request_to_openai_chat_completion(
+                cache=self.response_cache,
+                client=self.client,
+                messages=self.message_stack.get_message_stack(),
+                tools=self.tools_str,
+                stream=stream,
+                **self.llm_params
+            )
+        if not stream:
+            return response.choices[0].message
+        return (yield from _assemble_streamed_message(response))
+
+    def _process(self, user_message: str, stream: bool) -> Iterator[str]:
         self.message_stack.add_user_message(user_message)
-        response = send_request_to_openai_chat_completion(
-            client=self.client,
-            messages=self.message_stack.get_message_stack(),
-            tools=self.tools_str,
-            **self.llm_params
-        )
-        response_message = response.choices[0].message
+        response_message = yield from self._complete(stream)
         self.message_stack.add_assistant_message(response_message)
 
         if response_message.tool_calls is not None:
-            for tool_call in response_message.tool_calls:
-                tool_call_id = tool_call.id
-                function_name = tool_call.function.name
-                function_args = json.loads(tool_call.function.arguments)
-
-                tool = next(filter(lambda x: x.name == function_name, self.tools))
-                tool_response = tool(**function_args)
-
+            tool_contents = self._run_tool_calls(response_message.tool_calls)
+            for tool_call, content in zip(response_message.tool_calls, tool_contents):
                 self.message_stack.add_tool_message(
-                    content=json.dumps(tool_response),
-                    tool_call_id=tool_call_id,
-                    name=function_name,
+                    content=content,
+                    tool_call_id=tool_call.id,
+                    name=tool_call.function.name,
                     type='function'
                 )
 
             if self.respond_to_function:
-                response = send_request_to_openai_chat_completion(
-                    client=self.client,
-                    messages=self.message_stack.get_message_stack(),
-                    tools=self.tools_str,
-                    **self.llm_params
-                )
-                self.message_stack.add_assistant_message(response.choices[0].message)
+                response_message = yield from self._complete(stream)
+                self.message_stack.add_assistant_message(response_message)
+
+    def _run_tool_calls(self, tool_calls) -> List[str]:
+        """Run the tool calls concurrently and return the content of their tool messages, in their order
+
+        """
+        if len(tool_calls) == 1 or self.max_parallel_tools <= 1:
+            return [self._run_tool_call(tool_call) for tool_call in tool_calls]
+        with ThreadPoolExecutor(max_workers=min(self.max_parallel_tools, len(tool_calls))) as executor:
+            return list(executor.map(self._run_tool_call, tool_calls))
+
+    def _run_tool_call(self, tool_call) -> str:
+        """Run the tool call and return the content of its tool message, an error if the tool call failed
 
+        """
+        function_name = tool_call.function.name
+        try:
+            function_args = json.loads(tool_call.function.arguments)
+        except Exception as e:
+            return json.dumps({'error': f'{type(e).__name__}: {e}'})
+        if self.response_cache is not None:
+            content = self.response_cache.get_tool_result(function_name, function_args)
+            if content is not None:
+                return content
+        try:
+            tool = next(filter(lambda x: x.name == function_name, self.tools or []), None)
+            if tool is None:
+                raise ValueError(f'Unknown tool: {function_name}')
+            tool_response = tool(**function_args)
+            if asyncio.iscoroutine(tool_response):
+                tool_response = run_in_background_loop(tool_response)
+            content = json.dumps(tool_response)
+        except Exception as e:
+            content = json.dumps({'error': f'{type(e).__name__}: {e}'})
+        if self.response_cache is not None:
+            self.response_cache.put_tool_result(function_name, function_args, content)
+        return content
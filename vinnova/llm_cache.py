@@ -0,0 +1,195 @@
+"""Disk-backed cache of the responses of the LLM chat completions and of the tool calls
+
+A chat completion request is keyed by a canonical hash of its message stack, tools and parameters,
+so identical conversations are identical requests. The responses are stored in an SQLite database as
+the JSON of the completion, including the tool calls of the assistant message. The results of the tool
+calls are stored as well, keyed by a canonical hash of the tool name and arguments. The cache has two modes:
+
+* `record`: a stored response is served, otherwise the request is sent and the response stored. The
+  same holds for the tool calls.
+* `replay`: only stored responses and tool results are served, and a request or tool call without one
+  raises an error. No request is sent and no tool is called, so a recorded flow of the semantic engine
+  runs offline and repeats exactly, also when the data behind the tools has changed.
+
+Since the tool call ids of a replayed response are the recorded ones, and the tool results are the
+recorded ones, the tool messages that follow are the same, and so are the keys of the requests after them.
+
+"""
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Dict, Optional
+
+LLM_CACHE_MODES = ('record', 'replay')
+
+_SQL_CREATE = '''
+CREATE TABLE IF NOT EXISTS completion (
+    key TEXT PRIMARY KEY,
+    request TEXT NOT NULL,
+    response TEXT NOT NULL,
+    time_stored REAL NOT NULL
+);
+'''
+_SQL_CREATE_TOOL_RESULT = '''
+CREATE TABLE IF NOT EXISTS tool_result (
+    key TEXT PRIMARY KEY,
+    tool_call TEXT NOT NULL,
+    result TEXT NOT NULL,
+    time_stored REAL NOT NULL
+);
+'''
+_SQL_SELECT = 'SELECT response FROM completion WHERE key = ?;'
+_SQL_UPSERT = '''
+INSERT INTO completion (key, request, response, time_stored) VALUES (?, ?, ?, ?)
+ON CONFLICT (key) DO UPDATE SET request = excluded.request, response = excluded.response, time_stored = excluded.time_stored;
+'''
+_SQL_COUNT = 'SELECT COUNT(*) FROM completion;'
+_SQL_CLEAR = 'DELETE FROM completion;'
+_SQL_SELECT_TOOL_RESULT = 'SELECT result FROM tool_result WHERE key = ?;'
+_SQL_UPSERT_TOOL_RESULT = '''
+INSERT INTO tool_result (key, tool_call, result, time_stored) VALUES (?, ?, ?, ?)
+ON CONFLICT (key) DO UPDATE SET tool_call = excluded.tool_call, result = excluded.result, time_stored = excluded.time_stored;
+'''
+_SQL_COUNT_TOOL_RESULTS = 'SELECT COUNT(*) FROM tool_result;'
+_SQL_CLEAR_TOOL_RESULTS = 'DELETE FROM tool_result;'
+
+
+class LLMReplayMissError(Exception):
+    pass
+
+
+def canonical_request(request: Dict) -> str:
+    """The canonical JSON of a chat completion request, with sorted keys and no whitespace
+
+    The messages of the request can be dictionaries or the messages of completions, which are
+    converted to dictionaries without their unset fields.
+
+    """
+    def _default(obj):
+        if hasattr(obj, 'model_dump'):
+            return obj.model_dump(exclude_none=True)
+        raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+    return json.dumps(request, default=_default, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+class LLMResponseCache:
+    """The cache of the LLM chat completion responses and the tool results. It can be used from several threads.
+
+    Args:
+        path (str): The path to the SQLite database of the cache
+        mode (str): `record` to send and store requests without a stored response, `replay` to
+            serve stored responses only
+
+    """
+    def __init__(self, path: str, mode: str = 'record'):
+        if mode not in LLM_CACHE_MODES:
+            raise ValueError(f'Unknown LLM cache mode: {mode}')
+        self.path = path
+        self.mode = mode
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_tool_hits = 0
+        self.n_tool_misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL;')
+        self._conn.execute(_SQL_CREATE)
+        self._conn.execute(_SQL_CREATE_TOOL_RESULT)
+        self._conn.commit()
+
+    @property
+    def replay(self) -> bool:
+        return self.mode == 'replay'
+
+    @staticmethod
+    def key(request_json: str) -> str:
+        return hashlib.sha256(request_json.encode('utf-8')).hexdigest()
+
+    def get(self, request_json: str) -> Optional[str]:
+        """Return the JSON of the stored response of the request, or None if there is none
+
+        In replay mode, a request without a stored response raises `LLMReplayMissError`.
+
+        """
+        key = self.key(request_json)
+        with self._lock:
+            row = self._conn.execute(_SQL_SELECT, (key,)).fetchone()
+            if row is None:
+                self.n_misses += 1
+            else:
+                self.n_hits += 1
+        if row is None and self.replay:
+            raise LLMReplayMissError(f'No recorded response for request {key}')
+        return row[0] if row is not None else None
+
+    def put(self, request_json: str, response_json: str):
+        with self._lock:
+            self._conn.execute(_SQL_UPSERT, (self.key(request_json), request_json, response_json, time.time()))
+            self._conn.commit()
+
+    @staticmethod
+    def tool_call_json(tool_name: str, arguments: Dict) -> str:
+        return canonical_request({'name': tool_name, 'arguments': arguments})
+
+    def get_tool_result(self, tool_name: str, arguments: Dict) -> Optional[str]:
+        """Return the JSON of the stored result of the tool call, or None if there is none
+
+        In replay mode, a tool call without a stored result raises `LLMReplayMissError`.
+
+        """
+        tool_call_json = self.tool_call_json(tool_name, arguments)
+        key = self.key(tool_call_json)
+        with self._lock:
+            row = self._conn.execute(_SQL_SELECT_TOOL_RESULT, (key,)).fetchone()
+            if row is None:
+                self.n_tool_misses += 1
+            else:
+                self.n_tool_hits += 1
+        if row is None and self.replay:
+            raise LLMReplayMissError(f'No recorded result for tool call {tool_call_json}')
+        return row[0] if row is not None else None
+
+    def put_tool_result(self, tool_name: str, arguments: Dict, result_json: str):
+        tool_call_json = self.tool_call_json(tool_name, arguments)
+        with self._lock:
+            self._conn.execute(_SQL_UPSERT_TOOL_RESULT, (self.key(tool_call_json), tool_call_json, result_json, time.time()))
+            self._conn.commit()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            n_stored, = self._conn.execute(_SQL_COUNT).fetchone()
+            n_stored_tool_results, = self._conn.execute(_SQL_COUNT_TOOL_RESULTS).fetchone()
+            return {
+                'mode': self.mode,
+                'n_hits': self.n_hits,
+                'n_misses': self.n_misses,
+                'n_stored': n_stored,
+                'n_tool_hits': self.n_tool_hits,
+                'n_tool_misses': self.n_tool_misses,
+                'n_stored_tool_results': n_stored_tool_results,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute(_SQL_CLEAR)
+            self._conn.execute(_SQL_CLEAR_TOOL_RESULTS)
+            self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def build_llm_response_cache(cache_conf: Dict) -> LLMResponseCache:
+    """Build the LLM response cache from its configuration
+
+    Args:
+        cache_conf (Dict): The cache configuration, with `path` and optionally `mode`
+
+    """
+    return LLMResponseCache(
+        path=cache_conf['path'],
+        mode=cache_conf.get('mode', 'record'),
+    )
@@ -1,16 +1,32 @@
 """Main entry point for the Vinnova data project.
 
+With the environment variable `LLM_CACHE_MODE` set to `record` or `replay`, the completions and the
+results of the tool calls are served from the LLM response cache, see `llm_cache`. In replay mode no
+OpenAI client is made and the Vinnova tools are not called, so a recorded run repeats offline.
+
+The `projekt-search` tool searches the project search index, which is built by executing
+`vinnova_project_search.py`. Until it is built, the tool returns an error.
+
 """
-from vinnova_drl import build_vinnova_drl_func, VinnovaDataRetrievalLayer
+import os
+
+from vinnova_drl import build_vinnova_drl_funcs, close_vinnova_drl_funcs
 from llm import SemanticEngine, get_openai_client
+from llm_cache import build_llm_response_cache
 
 
 VINNOVA_API_CONF_FILE = "vinnova_drl_conf.json"
+LLM_CACHE_FILE = "llm_response_cache.db"
+TOOL_NAMES = ['projekt-list', 'projekt-details', 'projekt-search']
 
 
 def main():
-    vinnova_drl_func = build_vinnova_drl_func(VINNOVA_API_CONF_FILE)
-    llm_client = get_openai_client()
+    vinnova_drl_func = build_vinnova_drl_funcs(VINNOVA_API_CONF_FILE, TOOL_NAMES)
+    llm_cache_mode = os.environ.get('LLM_CACHE_MODE')
+    llm_cache = None
+    if llm_cache_mode is not None:
+        llm_cache = build_llm_response_cache({'path': LLM_CACHE_FILE, 'mode': llm_cache_mode})
+    llm_client = get_openai_client() if llm_cache_mode != 'replay' else None
     engine = SemanticEngine(
         client=llm_client,
         system_definition="You are the nice assistant brought forth by nice people to help with information.",
@@ -23,14 +39,23 @@ def main():
             'presence_penalty': 0.0,
             'n_completions': 1
         },
-        tools=[vinnova_drl_func[api_key] for api_key in ['projekt-list', 'projekt-details']],
-        respond_to_function=False
+        tools=[vinnova_drl_func[api_key] for api_key in TOOL_NAMES],
+        respond_to_function=False,
+        token_budget=32000,
+        response_cache=llm_cache,
     )
 
     engine.process('I am researching Vinnova projects. I am curious about projects active in 2023 or later. Can you list them?')
     print(engine.message_stack)
     engine.process('I want detailed information on the Vinnova project "2023-02723".')
     print(engine.message_stack)
+    engine.process('Which Vinnova projects are about recycling of batteries?')
+    print(engine.message_stack)
+
+    close_vinnova_drl_funcs(vinnova_drl_func)
+    if llm_cache is not None:
+        print(llm_cache.stats())
+        llm_cache.close()
 
 
 if __name__ == '__main__':
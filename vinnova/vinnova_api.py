@@ -1,8 +1,15 @@
 """The interface to the Vinnova API and post-processing of the returned data.
 
 """
-from typing import Dict, Optional, List, Callable
-from httpx import Client
+import json
+import time
+import asyncio
+import threading
+from typing import Dict, Optional, List, Callable, Tuple, Sequence, Iterable, Iterator, AsyncIterator
+from httpx import Client, AsyncClient, Response, Request, Limits, TransportError
+from httpx import BaseTransport, AsyncBaseTransport, HTTPTransport, AsyncHTTPTransport
+
+from vinnova_cache import VinnovaResponseCache, CacheEntry
 
 
 class VinnovaHTTPClientError(Exception):
@@ -13,6 +20,203 @@ def get_httpx_client(timeout: float = 60.0) -> Client:
     return Client(timeout=timeout)
 
 
+def get_httpx_async_client(timeout: float = 60.0) -> AsyncClient:
+    return AsyncClient(timeout=timeout)
+
+
+#
+# The event loop of the asynchronous calls made from synchronous code, run on a background thread.
+# One loop is used for all calls, since the connections of an httpx.AsyncClient are bound to the
+# loop they were made in.
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+
+def run_in_background_loop(coroutine):
+    """Run the coroutine on the background event loop and return its result
+
+    """
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name='vinnova-http', daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _background_loop).result()
+
+
+class _RetryPolicy:
+    """When and how long to wait before a request is retried
+
+    A request is retried on a transport error, such as a failed connection or a timeout, or on a
+    response with one of the retry status codes. The wait grows exponentially with the attempt,
+    unless the response says how long to wait with a Retry-After header in seconds.
+
+    """
+    def __init__(self, max_retries: int, backoff_factor: float, retry_status_codes: Sequence[int]):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.retry_status_codes = set(retry_status_codes)
+
+    def delay(self, attempt: int, response: Optional[Response] = None) -> float:
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after is not None and retry_after.isdigit():
+                return float(retry_after)
+        return self.backoff_factor * 2 ** attempt
+
+
+class _RetryTransport(BaseTransport):
+    def __init__(self, transport: HTTPTransport, policy: _RetryPolicy):
+        self._transport = transport
+        self._policy = policy
+
+    def handle_request(self, request: Request) -> Response:
+        attempt = 0
+        while True:
+            try:
+                response = self._transport.handle_request(request)
+            except TransportError:
+                if attempt >= self._policy.max_retries:
+                    raise
+                response = None
+            else:
+                if response.status_code not in self._policy.retry_status_codes or attempt >= self._policy.max_retries:
+                    return response
+                response.close()
+            time.sleep(self._policy.delay(attempt, response))
+            attempt += 1
+
+    def close(self):
+        self._transport.close()
+
+
+class _AsyncRetryTransport(AsyncBaseTransport):
+    def __init__(self, transport: AsyncHTTPTransport, policy: _RetryPolicy):
+        self._transport = transport
+        self._policy = policy
+
+    async def handle_async_request(self, request: Request) -> Response:
+        attempt = 0
+        while True:
+            try:
+                response = await self._transport.handle_async_request(request)
+            except TransportError:
+                if attempt >= self._policy.max_retries:
+                    raise
+                response = None
+            else:
+                if response.status_code not in self._policy.retry_status_codes or attempt >= self._policy.max_retries:
+                    return response
+                await response.aclose()
+            await asyncio.sleep(self._policy.delay(attempt, response))
+            attempt += 1
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class VinnovaHTTPTransport:
+    """The HTTP clients shared by all Vinnova APIs built from one configuration
+
+    The synchronous and the asynchronous client are made when first used. They keep a pool of
+    connections alive, so the APIs reuse connections to the host rather than making a new connection,
+    and TLS handshake, per API. Failed requests are retried with exponential backoff.
+
+    Args:
+        timeout (float): The timeout in seconds of a request
+        max_connections (int): The maximum number of connections of each client
+        max_keepalive_connections (int): The maximum number of idle connections kept alive
+        keepalive_expiry (float): The time in seconds an idle connection is kept alive
+        http2 (bool): If True, HTTP/2 is used if the server supports it. Requires the `h2` package
+        max_retries (int): The maximum number of retries of a request
+        backoff_factor (float): The wait in seconds before the first retry, doubled for each retry
+        retry_status_codes (Sequence[int]): The status codes of the responses that are retried
+
+    """
+    def __init__(self,
+                 timeout: float = 60.0,
+                 max_connections: int = 20,
+                 max_keepalive_connections: int = 10,
+                 keepalive_expiry: float = 30.0,
+                 http2: bool = False,
+                 max_retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 retry_status_codes: Sequence[int] = (429, 500, 502, 503, 504),
+                 ):
+        self.timeout = timeout
+        self.limits = Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self.retry_policy = _RetryPolicy(max_retries, backoff_factor, retry_status_codes)
+        self._client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self) -> Client:
+        with self._lock:
+            if self._client is None:
+                self._client = Client(
+                    timeout=self.timeout,
+                    transport=_RetryTransport(
+                        HTTPTransport(limits=self.limits, http2=self.http2),
+                        self.retry_policy,
+                    ),
+                )
+            return self._client
+
+    @property
+    def async_client(self) -> AsyncClient:
+        with self._lock:
+            if self._async_client is None:
+                self._async_client = AsyncClient(
+                    timeout=self.timeout,
+                    transport=_AsyncRetryTransport(
+                        AsyncHTTPTransport(limits=self.limits, http2=self.http2),
+                        self.retry_policy,
+                    ),
+                )
+            return self._async_client
+
+    def close(self):
+        """Close the clients and their connections. The asynchronous client is closed on the background
+        event loop, so it is to be used from there, or closed with `aclose` from the loop it is used in.
+
+        """
+        with self._lock:
+            client, self._client = self._client, None
+            async_client, self._async_client = self._async_client, None
+        if client is not None:
+            client.close()
+        if async_client is not None:
+            run_in_background_loop(async_client.aclose())
+
+    async def aclose(self):
+        """Close the clients and their connections, from the event loop the asynchronous client is used in
+
+        """
+        with self._lock:
+            client, self._client = self._client, None
+            async_client, self._async_client = self._async_client, None
+        if client is not None:
+            client.close()
+        if async_client is not None:
+            await async_client.aclose()
+
+
+def build_vinnova_http_transport(transport_conf: Dict) -> VinnovaHTTPTransport:
+    """Build the shared HTTP transport from the `transport` section of the DRL configuration file
+
+    Args:
+        transport_conf (Dict): The transport configuration, with the arguments of `VinnovaHTTPTransport`
+
+    """
+    return VinnovaHTTPTransport(**transport_conf)
+
+
 class VinnovaAPI:
     """The basic interface to the Vinnova APIs
 
@@ -21,16 +225,45 @@ class VinnovaAPI:
 
     Documentation is found at https://data.vinnova.se/api/
 
+    With a response cache, a response younger than the time-to-live is returned without a request,
+    and an older response is revalidated with a conditional request if the server allows it.
+
+    Args:
+        endpoint (str): The endpoint of the API
+        headers (Optional[Dict[str, str]]): The headers of the requests
+        cache (Optional[VinnovaResponseCache]): The response cache, if any
+        cache_ttl (Optional[float]): The time-to-live in seconds of the cached responses. If not given,
+            the default of the cache.
+        transport (Optional[VinnovaHTTPTransport]): The shared HTTP transport the client is taken from.
+            If not given, the API has a client of its own, which is closed with `close`.
+        stream (bool): If True, decorators that post-process record by record get the records as they
+            are parsed from the response, see `iter_records`. Requires the `ijson` package.
+
     """
     base_url = "https://data.vinnova.se/api"
 
     def __init__(self,
                  endpoint: str,
                  headers: Optional[Dict[str, str]] = None,
+                 cache: Optional[VinnovaResponseCache] = None,
+                 cache_ttl: Optional[float] = None,
+                 transport: Optional[VinnovaHTTPTransport] = None,
+                 stream: bool = False,
                  ):
         self.endpoint = endpoint
         self.headers = headers
-        self._client = get_httpx_client()
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        self.transport = transport
+        self.stream = stream
+        self._owns_client = transport is None
+        self._client = self._make_client()
+
+    def _make_client(self) -> Client:
+        """The client of the shared transport, or else a client of the API's own
+
+        """
+        return self.transport.client if self.transport is not None else get_httpx_client()
 
     @property
     def client(self):
@@ -40,19 +273,213 @@ class VinnovaAPI:
 
     @client.setter
     def client(self, client: Client):
+        self.close()
+        self._owns_client = False
         self._client = client
 
+    def close(self):
+        """Close the client if it is the API's own. The client of a shared transport is closed with the transport.
+
+        """
+        client, self._client = self._client, None
+        if self._owns_client and client is not None:
+            client.close()
+
     def __call__(self, data: str) -> Dict:
         """Invoke the API by passing data to the endpoint.
 
         """
-        url = f"{self.base_url}/{self.endpoint}/{data}"
-        response = self.client.get(url, headers=self.headers)
+        entry, headers = self._lookup_cache(data)
+        if entry is not None and headers is None:
+            return json.loads(entry.body)
+        response = self.client.get(self._url(data), headers=headers)
+        return self._handle_response(data, entry, response)
+
+    def _url(self, data: str) -> str:
+        return f"{self.base_url}/{self.endpoint}/{data}"
+
+    def _lookup_cache(self, data: str) -> Tuple[Optional[CacheEntry], Optional[Dict[str, str]]]:
+        """Return the cached response and the headers of the request to make. If the cached response is
+        fresh, no request is to be made and the headers are None.
+
+        """
+        if self.cache is None:
+            return None, self.headers
+
+        entry = self.cache.get(self.endpoint, data)
+        if entry is not None and self.cache.is_fresh(entry, self.cache_ttl):
+            self.cache.count('hit')
+            return entry, None
+
+        headers = dict(self.headers) if self.headers is not None else {}
+        if entry is not None and entry.etag is not None:
+            headers['If-None-Match'] = entry.etag
+        if entry is not None and entry.last_modified is not None:
+            headers['If-Modified-Since'] = entry.last_modified
+        return entry, headers
+
+    def _handle_response(self, data: str, entry: Optional[CacheEntry], response: Response) -> Dict:
+        """Return the data of the response, or of the cached response if the server confirmed it
+
+        """
+        if self._is_revalidated(data, entry, response):
+            return json.loads(entry.body)
+        self._check_status(response)
+        self._store(data, response, response.content)
+        return response.json()
+
+    def _is_revalidated(self, data: str, entry: Optional[CacheEntry], response: Response) -> bool:
+        if self.cache is not None and response.status_code == 304 and entry is not None:
+            self.cache.refresh(self.endpoint, data)
+            self.cache.count('revalidated')
+            return True
+        return False
+
+    @staticmethod
+    def _check_status(response: Response):
         if response.status_code != 200:
             raise VinnovaHTTPClientError(f"HTTP GET request failed with status code {response.status_code}")
 
-        return response.json()
+    def _store(self, data: str, response: Response, body: bytes):
+        if self.cache is not None:
+            self.cache.count('miss')
+            self.cache.put(
+                self.endpoint, data, body,
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified'),
+            )
+
+    def iter_records(self, data: str) -> Iterator[Dict]:
+        """Invoke the API and yield the records of the returned JSON array one at a time, parsed as the
+        response body arrives, so the whole payload is never in memory as Python objects.
+
+        With a response cache, the raw body is collected to be stored in the cache.
+
+        """
+        entry, headers = self._lookup_cache(data)
+        if entry is not None and headers is None:
+            yield from _parse_json_array(_slices(entry.body))
+            return
+
+        body = bytearray() if self.cache is not None else None
+        with self.client.stream('GET', self._url(data), headers=headers) as response:
+            if self._is_revalidated(data, entry, response):
+                yield from _parse_json_array(_slices(entry.body))
+                return
+            self._check_status(response)
+            yield from _parse_json_array(_collect(response.iter_bytes(), body))
+        self._store(data, response, body)
+
+
+class AsyncVinnovaAPI(VinnovaAPI):
+    """The asynchronous interface to the Vinnova APIs, so that many requests can be made concurrently
+
+    The client is an `httpx.AsyncClient`. Otherwise as `VinnovaAPI`, including the response cache.
+    A client of the API's own is closed on the background event loop, see `close`, or with `aclose` from
+    the loop it is used in.
+
+    """
+    def _make_client(self) -> AsyncClient:
+        return self.transport.async_client if self.transport is not None else get_httpx_async_client()
+
+    def close(self):
+        client, self._client = self._client, None
+        if self._owns_client and client is not None:
+            run_in_background_loop(client.aclose())
+
+    async def aclose(self):
+        client, self._client = self._client, None
+        if self._owns_client and client is not None:
+            await client.aclose()
+
+    async def __call__(self, data: str) -> Dict:
+        """Invoke the API by passing data to the endpoint.
+
+        """
+        entry, headers = self._lookup_cache(data)
+        if entry is not None and headers is None:
+            return json.loads(entry.body)
+        response = await self.client.get(self._url(data), headers=headers)
+        return self._handle_response(data, entry, response)
 
+    async def aiter_records(self, data: str) -> AsyncIterator[Dict]:
+        """Invoke the API and yield the records of the returned JSON array one at a time, as `iter_records`
+
+        """
+        entry, headers = self._lookup_cache(data)
+        if entry is not None and headers is None:
+            for record in _parse_json_array(_slices(entry.body)):
+                yield record
+            return
+
+        body = bytearray() if self.cache is not None else None
+        parser = _JSONArrayParser()
+        async with self.client.stream('GET', self._url(data), headers=headers) as response:
+            if self._is_revalidated(data, entry, response):
+                for record in _parse_json_array(_slices(entry.body)):
+                    yield record
+                return
+            self._check_status(response)
+            async for chunk in response.aiter_bytes():
+                if body is not None:
+                    body.extend(chunk)
+                for record in parser.feed(chunk):
+                    yield record
+        for record in parser.close():
+            yield record
+        self._store(data, response, body)
+
+
+class _JSONArrayParser:
+    """Incremental parser of a JSON array. The bytes are fed as they arrive, and the items of the
+    array completed so far are returned. Numbers are parsed as floats, as by `json.loads`.
+
+    The parser requires the `ijson` package.
+
+    """
+    def __init__(self):
+        import ijson
+        self._items = ijson.sendable_list()
+        self._coroutine = ijson.items_coro(self._items, 'item', use_float=True)
+
+    def _take(self) -> List:
+        items = list(self._items)
+        del self._items[:]
+        return items
+
+    def feed(self, chunk: bytes) -> List:
+        self._coroutine.send(chunk)
+        return self._take()
+
+    def close(self) -> List:
+        self._coroutine.close()
+        return self._take()
+
+
+def _parse_json_array(chunks: Iterable[bytes]) -> Iterator:
+    parser = _JSONArrayParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+def _slices(body: bytes, size: int = 65536) -> Iterator[bytes]:
+    """The body in slices, so that it is parsed as if it were arriving
+
+    """
+    view = memoryview(body)
+    for start in range(0, len(view), size):
+        yield bytes(view[start:start + size])
+
+
+def _collect(chunks: Iterable[bytes], body: Optional[bytearray]) -> Iterator[bytes]:
+    """Pass the chunks on, and collect them in the body if one is given
+
+    """
+    for chunk in chunks:
+        if body is not None:
+            body.extend(chunk)
+        yield chunk
 
 #
 # The Vinnova APIs are basic and return typically very large and information rich JSON
@@ -64,10 +491,42 @@ def _identity_func(x):
 
 
 def _make_vinnova_api_decorator(func_pre: Callable = _identity_func,
-                                func_post: Callable = _identity_func) -> Callable:
-    """Make a decorator for the VinnovaAPI object."""
+                                func_post: Callable = _identity_func,
+                                func_post_record: Optional[Callable] = None) -> Callable:
+    """Make a decorator for the VinnovaAPI object. The decorated AsyncVinnovaAPI is a coroutine function.
+
+    With `func_post_record`, each record of the JSON array returned by the API is post-processed on its
+    own, and `func_post` is applied to the list of post-processed records. If the API streams, the records
+    are parsed and post-processed one at a time, so the memory is bounded by the post-processed records
+    rather than by the payload.
+
+    """
+    def _post_records(records: Iterable) -> List:
+        return func_post([func_post_record(record) for record in records])
+
     def decorator(api: VinnovaAPI) -> Callable:
+        streams = func_post_record is not None and getattr(api, 'stream', False)
+
+        if isinstance(api, AsyncVinnovaAPI):
+            async def async_wrapper(data: str) -> List:
+                if streams:
+                    return func_post([
+                        func_post_record(record) async for record in api.aiter_records(func_pre(data))
+                    ])
+                if func_post_record is not None:
+                    return _post_records(await api(func_pre(data)))
+                return func_post(
+                    await api(
+                        func_pre(data)
+                    )
+                )
+            return async_wrapper
+
         def wrapper(data: str) -> List:
+            if streams:
+                return _post_records(api.iter_records(func_pre(data)))
+            if func_post_record is not None:
+                return _post_records(api(func_pre(data)))
             return func_post(
                 api(
                     func_pre(data)
@@ -77,19 +536,16 @@ def _make_vinnova_api_decorator(func_pre: Callable = _identity_func,
     return decorator
 
 
-def _post_only_diarienr(payload: Dict):
-    diarienr = []
-    for entry in payload:
-        try:
-            diarienr.append(entry['Diarienummer'])
-        except KeyError:
-            print(entry)
-            raise KeyError("Diarienummer not found in entry")
-    return diarienr
+def _post_record_diarienr(entry: Dict):
+    try:
+        return entry['Diarienummer']
+    except KeyError:
+        print(entry)
+        raise KeyError("Diarienummer not found in entry")
 
 
 decorators_to_vinnova_api = {
-    'only_diarienr': _make_vinnova_api_decorator(func_post=_post_only_diarienr),
+    'only_diarienr': _make_vinnova_api_decorator(func_post_record=_post_record_diarienr),
 }
 
 
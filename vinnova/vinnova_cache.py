@@ -0,0 +1,181 @@
+"""Disk-backed cache of the responses of the Vinnova APIs
+
+The Vinnova APIs return large JSON objects that change slowly, for example the list of projects
+changed since a date. The raw response bodies are therefore stored in an SQLite database, keyed by
+endpoint and data, and reused while they are younger than the time-to-live of the API, which is set
+per API in the DRL configuration file. Older responses are revalidated with a conditional request if
+the server sent an ETag or Last-Modified header, otherwise fetched again.
+
+The total size of the stored bodies is capped. When the cap is exceeded, the least recently used
+responses are evicted.
+
+"""
+import time
+import sqlite3
+import threading
+from collections import namedtuple
+from typing import Dict, Optional
+
+CacheEntry = namedtuple('CacheEntry', ['body', 'etag', 'last_modified', 'time_stored'])
+
+_SQL_CREATE = '''
+CREATE TABLE IF NOT EXISTS response (
+    endpoint TEXT NOT NULL,
+    data TEXT NOT NULL,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    time_stored REAL NOT NULL,
+    time_used REAL NOT NULL,
+    PRIMARY KEY (endpoint, data)
+);
+'''
+_SQL_SELECT = 'SELECT body, etag, last_modified, time_stored FROM response WHERE endpoint = ? AND data = ?;'
+_SQL_UPSERT = '''
+INSERT INTO response (endpoint, data, body, size, etag, last_modified, time_stored, time_used)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (endpoint, data) DO UPDATE SET
+    body = excluded.body, size = excluded.size, etag = excluded.etag, last_modified = excluded.last_modified,
+    time_stored = excluded.time_stored, time_used = excluded.time_used;
+'''
+_SQL_TOUCH = 'UPDATE response SET time_used = ? WHERE endpoint = ? AND data = ?;'
+_SQL_REFRESH = 'UPDATE response SET time_stored = ?, time_used = ? WHERE endpoint = ? AND data = ?;'
+_SQL_TOTAL_SIZE = 'SELECT COALESCE(SUM(size), 0) FROM response;'
+_SQL_SELECT_LRU = 'SELECT endpoint, data, size FROM response ORDER BY time_used ASC;'
+_SQL_DELETE = 'DELETE FROM response WHERE endpoint = ? AND data = ?;'
+_SQL_CLEAR = 'DELETE FROM response;'
+
+
+class VinnovaResponseCache:
+    """The cache of the Vinnova API responses, shared by all APIs
+
+    The cache counts hits (fresh responses), revalidations (stale responses confirmed by the server),
+    misses (responses fetched in full) and evictions. It can be used from several threads.
+
+    Args:
+        path (str): The path to the SQLite database of the cache
+        max_bytes (int): The maximum total size of the stored response bodies
+        default_ttl (float): The time-to-live in seconds of the responses of APIs without their own
+
+    """
+    def __init__(self,
+                 path: str,
+                 max_bytes: int = 500_000_000,
+                 default_ttl: float = 3600.0,
+                 ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.n_hits = 0
+        self.n_revalidated = 0
+        self.n_misses = 0
+        self.n_evicted = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL;')
+        self._conn.execute(_SQL_CREATE)
+        self._conn.commit()
+
+    def get(self, endpoint: str, data: str) -> Optional[CacheEntry]:
+        """Return the stored response, fresh or not, or None if there is none
+
+        """
+        with self._lock:
+            row = self._conn.execute(_SQL_SELECT, (endpoint, data)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(_SQL_TOUCH, (time.time(), endpoint, data))
+            self._conn.commit()
+        return CacheEntry(*row)
+
+    def is_fresh(self, entry: CacheEntry, ttl: Optional[float] = None) -> bool:
+        """Whether the stored response is younger than the time-to-live
+
+        """
+        ttl = self.default_ttl if ttl is None else ttl
+        return time.time() - entry.time_stored < ttl
+
+    def put(self,
+            endpoint: str,
+            data: str,
+            body: bytes,
+            etag: Optional[str] = None,
+            last_modified: Optional[str] = None,
+            ):
+        """Store a response, then evict the least recently used responses if the cache is too large
+
+        A response larger than the cache is not stored.
+
+        """
+        if len(body) > self.max_bytes:
+            return
+        time_now = time.time()
+        with self._lock:
+            self._conn.execute(_SQL_UPSERT, (endpoint, data, body, len(body), etag, last_modified, time_now, time_now))
+            total_size, = self._conn.execute(_SQL_TOTAL_SIZE).fetchone()
+            if total_size > self.max_bytes:
+                for evict_endpoint, evict_data, size in self._conn.execute(_SQL_SELECT_LRU).fetchall():
+                    if total_size <= self.max_bytes:
+                        break
+                    self._conn.execute(_SQL_DELETE, (evict_endpoint, evict_data))
+                    total_size -= size
+                    self.n_evicted += 1
+            self._conn.commit()
+
+    def refresh(self, endpoint: str, data: str):
+        """Mark a stored response as fresh, after the server confirmed it has not changed
+
+        """
+        time_now = time.time()
+        with self._lock:
+            self._conn.execute(_SQL_REFRESH, (time_now, time_now, endpoint, data))
+            self._conn.commit()
+
+    def count(self, outcome: str):
+        """Count the outcome of a lookup: `hit`, `revalidated` or `miss`
+
+        """
+        with self._lock:
+            if outcome == 'hit':
+                self.n_hits += 1
+            elif outcome == 'revalidated':
+                self.n_revalidated += 1
+            elif outcome == 'miss':
+                self.n_misses += 1
+            else:
+                raise ValueError(f'Unknown cache outcome: {outcome}')
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total_size, = self._conn.execute(_SQL_TOTAL_SIZE).fetchone()
+            return {
+                'n_hits': self.n_hits,
+                'n_revalidated': self.n_revalidated,
+                'n_misses': self.n_misses,
+                'n_evicted': self.n_evicted,
+                'total_bytes': total_size,
+                'max_bytes': self.max_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute(_SQL_CLEAR)
+            self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def build_vinnova_response_cache(cache_conf: Dict) -> VinnovaResponseCache:
+    """Build the response cache from the `cache` section of the DRL configuration file
+
+    Args:
+        cache_conf (Dict): The cache configuration, with `path` and optionally `max_bytes` and `default_ttl`
+
+    """
+    return VinnovaResponseCache(
+        path=cache_conf['path'],
+        max_bytes=cache_conf.get('max_bytes', 500_000_000),
+        default_ttl=cache_conf.get('default_ttl', 3600.0),
+    )
@@ -2,9 +2,14 @@
 
 """
 import json
-from typing import Dict, Optional, Callable
+import asyncio
+from typing import Dict, List, Optional, Callable, Union
 
-from vinnova_api import decorators_to_vinnova_api, VinnovaAPI
+from vinnova_api import decorators_to_vinnova_api, VinnovaAPI, AsyncVinnovaAPI, run_in_background_loop
+from vinnova_api import VinnovaHTTPTransport, build_vinnova_http_transport
+from vinnova_cache import VinnovaResponseCache, build_vinnova_response_cache
+from vinnova_mirror import VinnovaMirror, MirroredVinnovaAPI
+from vinnova_project_search import VinnovaProjectSearchAPI, build_vinnova_project_search_api
 
 
 class VinnovaDataRetrievalLayerMissingAPIError(Exception):
@@ -22,6 +27,9 @@ class VinnovaDataRetrievalLayer:
         description (Optional[str]): The description of the API; required for LLM tools
         parameters_description (Optional[Dict[str, Dict[str, str]]): The description of the parameters; required for LLM tools
         api_decorator (Optional[Callable]): The decorator function
+        mirror (Optional[VinnovaMirror]): The local mirror of the Vinnova datasets, to serve the calls
+            from when it can, rather than from the API
+        mirror_query (Optional[str]): The query of the mirror the calls correspond to, `list` or `details`
 
     """
     def __init__(self,
@@ -30,16 +38,23 @@ class VinnovaDataRetrievalLayer:
                  description: Optional[str] = None,
                  parameters_description: Optional[Dict[str, Dict[str, str]]] = None,
                  api_decorator: Optional[Callable] = None,
+                 mirror: Optional[VinnovaMirror] = None,
+                 mirror_query: Optional[str] = None,
                  ):
         self.name = name
         self.vinnova_api = vinnova_api
         self.description = description
         self.parameters_description = parameters_description
+        self.mirror = mirror
+
+        source = self.vinnova_api
+        if mirror is not None:
+            source = MirroredVinnovaAPI(mirror, self.vinnova_api, mirror_query)
 
         if api_decorator is not None:
-            self._func = api_decorator(self.vinnova_api)
+            self._func = api_decorator(source)
         else:
-            self._func = self.vinnova_api
+            self._func = source
 
     @property
     def specification_str(self):
@@ -66,15 +81,72 @@ class VinnovaDataRetrievalLayer:
         return self._func(data)
 
 
-def build_vinnova_drl_func(
-        api_name: str,
-        api_conf_fp: str
-) -> VinnovaDataRetrievalLayer:
-    """Build a data retrieval layer according to configuration
+class AsyncVinnovaDataRetrievalLayer(VinnovaDataRetrievalLayer):
+    """The asynchronous Vinnova data retrieval layer. Many data values can be passed to the API
+    concurrently in one batch call, such as the details of each project of a project list.
+
+    The layer is used either from one event loop of the caller, or from synchronous code with
+    `run_batch`, which runs the batch on a background event loop.
 
     Args:
-        api_name (str): The name of the API
-        api_conf_fp (str): The path to the configuration file
+        name (str): The name of the DRL
+        vinnova_api (AsyncVinnovaAPI): The asynchronous Vinnova API object, single endpoint
+        description (Optional[str]): The description of the API; required for LLM tools
+        parameters_description (Optional[Dict[str, Dict[str, str]]): The description of the parameters; required for LLM tools
+        api_decorator (Optional[Callable]): The decorator function
+        max_concurrency (int): The maximum number of concurrent requests of a batch
+
+    """
+    def __init__(self,
+                 name: str,
+                 vinnova_api: AsyncVinnovaAPI,
+                 description: Optional[str] = None,
+                 parameters_description: Optional[Dict[str, Dict[str, str]]] = None,
+                 api_decorator: Optional[Callable] = None,
+                 max_concurrency: int = 8,
+                 ):
+        super().__init__(
+            name=name,
+            vinnova_api=vinnova_api,
+            description=description,
+            parameters_description=parameters_description,
+            api_decorator=api_decorator,
+        )
+        self.max_concurrency = max_concurrency
+
+    async def __call__(self, data: str) -> Dict:
+        """Pass the data to the API
+
+        """
+        return await self._func(data)
+
+    async def batch(self, data_values: List[str]) -> List[Union[Dict, List, Exception]]:
+        """Pass each of the data values to the API, concurrently up to the concurrency limit
+
+        The results are in the order of the data values. A data value for which the API fails gets the
+        exception in place of its result, and the other data values are not affected.
+
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def _call(data: str):
+            async with semaphore:
+                try:
+                    return await self._func(data)
+                except Exception as e:
+                    return e
+
+        return await asyncio.gather(*(_call(data) for data in data_values))
+
+    def run_batch(self, data_values: List[str]) -> List[Union[Dict, List, Exception]]:
+        """Run `batch` from synchronous code
+
+        """
+        return run_in_background_loop(self.batch(data_values))
+
+
+def _load_api_conf(api_name: str, api_conf_fp: str):
+    """Return the configuration file and the configuration of the API
 
     """
     with open(api_conf_fp, 'r') as f:
@@ -85,7 +157,48 @@ def build_vinnova_drl_func(
     except KeyError:
         raise VinnovaDataRetrievalLayerMissingAPIError(f"API {api_name} not found in DRL configuration file")
 
-    vinnova_api = VinnovaAPI(conf['endpoint'])
+    return api_conf, conf
+
+
+def build_vinnova_drl_func(
+        api_name: str,
+        api_conf_fp: str,
+        cache: Optional[VinnovaResponseCache] = None,
+        transport: Optional[VinnovaHTTPTransport] = None,
+        mirror: Optional[VinnovaMirror] = None,
+) -> VinnovaDataRetrievalLayer:
+    """Build a data retrieval layer according to configuration
+
+    The responses of the API are cached if the configuration file has a `cache` section, with the
+    time-to-live set by `cache_ttl` of the API. The HTTP client is taken from a pooled transport with
+    retries if the configuration file has a `transport` section. The calls are served from the local
+    mirror if the configuration file has a `mirror` section with `serve` set, and the API a `mirror_query`.
+
+    Args:
+        api_name (str): The name of the API
+        api_conf_fp (str): The path to the configuration file
+        cache (Optional[VinnovaResponseCache]): The response cache, to share one between layers. If not
+            given, one is built from the configuration file.
+        transport (Optional[VinnovaHTTPTransport]): The HTTP transport, to share one between layers. If
+            not given, one is built from the configuration file.
+        mirror (Optional[VinnovaMirror]): The local mirror, to share one between layers. If not given, the
+            one of the configuration file.
+
+    """
+    api_conf, conf = _load_api_conf(api_name, api_conf_fp)
+    cache, transport = _shared_resources(api_conf, cache, transport)
+    if 'mirror_query' not in conf:
+        mirror = None
+    elif mirror is None and api_conf.get('mirror', {}).get('serve', False):
+        mirror = VinnovaMirror(api_conf['mirror']['path'])
+
+    vinnova_api = VinnovaAPI(
+        conf['endpoint'],
+        cache=cache,
+        cache_ttl=conf.get('cache_ttl'),
+        transport=transport,
+        stream=conf.get('stream', False),
+    )
 
     if 'decorator' in conf:
         _decorator = decorators_to_vinnova_api[conf['decorator']]
@@ -98,9 +211,164 @@ def build_vinnova_drl_func(
         parameters_description=conf['parameters'],
         vinnova_api=vinnova_api,
         api_decorator=_decorator,
+        mirror=mirror,
+        mirror_query=conf.get('mirror_query'),
+    )
+
+
+def build_async_vinnova_drl_func(
+        api_name: str,
+        api_conf_fp: str,
+        cache: Optional[VinnovaResponseCache] = None,
+        transport: Optional[VinnovaHTTPTransport] = None,
+) -> AsyncVinnovaDataRetrievalLayer:
+    """Build an asynchronous data retrieval layer according to configuration
+
+    The concurrency limit of the batch calls is set by `max_concurrency` of the configuration file.
+    The calls are not served from the local mirror.
+
+    Args:
+        api_name (str): The name of the API
+        api_conf_fp (str): The path to the configuration file
+        cache (Optional[VinnovaResponseCache]): The response cache, to share one between layers. If not
+            given, one is built from the configuration file.
+        transport (Optional[VinnovaHTTPTransport]): The HTTP transport, to share one between layers. If
+            not given, one is built from the configuration file.
+
+    """
+    api_conf, conf = _load_api_conf(api_name, api_conf_fp)
+    cache, transport = _shared_resources(api_conf, cache, transport)
+
+    vinnova_api = AsyncVinnovaAPI(
+        conf['endpoint'],
+        cache=cache,
+        cache_ttl=conf.get('cache_ttl'),
+        transport=transport,
+        stream=conf.get('stream', False),
+    )
+
+    if 'decorator' in conf:
+        _decorator = decorators_to_vinnova_api[conf['decorator']]
+    else:
+        _decorator = None
+
+    return AsyncVinnovaDataRetrievalLayer(
+        name=api_name,
+        description=conf['description'],
+        parameters_description=conf['parameters'],
+        vinnova_api=vinnova_api,
+        api_decorator=_decorator,
+        max_concurrency=api_conf.get('max_concurrency', 8),
+    )
+
+
+def build_vinnova_project_search_func(
+        api_conf_fp: str,
+        mirror: Optional[VinnovaMirror] = None,
+) -> VinnovaDataRetrievalLayer:
+    """Build the data retrieval layer of the semantic search over the projects of the local mirror,
+    set by the `project_search` section of the configuration file, see `vinnova_project_search.py`
+
+    Args:
+        api_conf_fp (str): The path to the configuration file
+        mirror (Optional[VinnovaMirror]): The local mirror, to share one between layers. If not given, the
+            one of the configuration file.
+
+    """
+    with open(api_conf_fp, 'r') as f:
+        api_conf = json.load(f)
+    try:
+        search_conf = api_conf['project_search']
+    except KeyError:
+        raise VinnovaDataRetrievalLayerMissingAPIError("Project search not found in DRL configuration file")
+    if mirror is None:
+        mirror = VinnovaMirror(api_conf['mirror']['path'])
+
+    return VinnovaDataRetrievalLayer(
+        name=search_conf['name'],
+        description=search_conf['description'],
+        parameters_description=search_conf['parameters'],
+        vinnova_api=build_vinnova_project_search_api(search_conf, mirror),
     )
 
 
+def _shared_resources(api_conf: Dict,
+                      cache: Optional[VinnovaResponseCache],
+                      transport: Optional[VinnovaHTTPTransport]):
+    """Return the cache and transport given, or else built from the configuration file if set there
+
+    """
+    if cache is None and 'cache' in api_conf:
+        cache = build_vinnova_response_cache(api_conf['cache'])
+    if transport is None and 'transport' in api_conf:
+        transport = build_vinnova_http_transport(api_conf['transport'])
+    return cache, transport
+
+
+def build_vinnova_drl_funcs(
+        api_conf_fp: str,
+        api_names: Optional[List[str]] = None,
+        asynchronous: bool = False,
+) -> Dict[str, VinnovaDataRetrievalLayer]:
+    """Build the data retrieval layers of the configuration file, which share one response cache, one
+    HTTP transport and one local mirror. Close them with `close_vinnova_drl_funcs`.
+
+    The name of the project search, `project_search.name`, can be among the names of the APIs, for the
+    semantic search over the projects of the local mirror. Its layer is not asynchronous, also when the
+    other layers are, since the search is local and does not wait on the network.
+
+    Args:
+        api_conf_fp (str): The path to the configuration file
+        api_names (Optional[List[str]]): The names of the APIs. If not given, all APIs of the configuration file
+        asynchronous (bool): If True, the layers are asynchronous
+
+    """
+    with open(api_conf_fp, 'r') as f:
+        api_conf = json.load(f)
+    if api_names is None:
+        api_names = list(api_conf['apis'])
+    cache, transport = _shared_resources(api_conf, None, None)
+
+    search_name = api_conf.get('project_search', {}).get('name')
+    serve = api_conf.get('mirror', {}).get('serve', False) and not asynchronous
+    mirror = None
+    if serve or search_name in api_names:
+        mirror = VinnovaMirror(api_conf['mirror']['path'])
+    serve_mirror = mirror if serve else None
+
+    def _build(api_name: str) -> VinnovaDataRetrievalLayer:
+        if api_name == search_name:
+            return build_vinnova_project_search_func(api_conf_fp, mirror=mirror)
+        if asynchronous:
+            return build_async_vinnova_drl_func(api_name, api_conf_fp, cache=cache, transport=transport)
+        return build_vinnova_drl_func(api_name, api_conf_fp, cache=cache, transport=transport, mirror=serve_mirror)
+
+    return {api_name: _build(api_name) for api_name in api_names}
+
+
+def close_vinnova_drl_funcs(drl_funcs: Dict[str, VinnovaDataRetrievalLayer]):
+    """Close the HTTP clients and transports, response caches, local mirrors and project search indexes
+    of the data retrieval layers
+
+    """
+    transports = {id(drl.vinnova_api.transport): drl.vinnova_api.transport for drl in drl_funcs.values()}
+    caches = {id(drl.vinnova_api.cache): drl.vinnova_api.cache for drl in drl_funcs.values()}
+    mirrors = {id(drl.mirror): drl.mirror for drl in drl_funcs.values()}
+    for drl in drl_funcs.values():
+        if isinstance(drl.vinnova_api, VinnovaProjectSearchAPI):
+            mirrors[id(drl.vinnova_api.mirror)] = drl.vinnova_api.mirror
+        drl.vinnova_api.close()
+    for transport in transports.values():
+        if transport is not None:
+            transport.close()
+    for cache in caches.values():
+        if cache is not None:
+            cache.close()
+    for mirror in mirrors.values():
+        if mirror is not None:
+            mirror.close()
+
+
 def test_vinnova_drl_program():
     drl_program_list = build_vinnova_drl_func('program-list', 'vinnova_drl_conf.json')
     x = drl_program_list('2024-01-01')
@@ -138,6 +406,21 @@ def test_vinnova_drl_ansokningsomgang_details():
     print (x)
 
 
+def test_vinnova_drl_projekt_details_batch():
+    drl_project_list = build_vinnova_drl_func('projekt-list', 'vinnova_drl_conf.json')
+    drl_project_details = build_async_vinnova_drl_func('projekt-details', 'vinnova_drl_conf.json')
+    diarienr = drl_project_list('2024-01-01')
+    x = drl_project_details.run_batch(diarienr[:50])
+    print (x)
+
+
+
+def test_vinnova_drl_projekt_search():
+    drl_project_search = build_vinnova_project_search_func('vinnova_drl_conf.json')
+    print(drl_project_search.vinnova_api.refresh())
+    x = drl_project_search('Projekt om återvinning av batterier')
+    print (x)
+
 
 if __name__ == '__main__':
     #test_vinnova_drl_utlysningar()
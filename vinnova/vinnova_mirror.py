@@ -0,0 +1,279 @@
+"""Local mirror of the Vinnova datasets in SQLite
+
+The records of the endpoints of the DRL configuration file, such as `projekt` and `program`, are
+stored in an indexed SQLite database, keyed by endpoint and Diarienummer. The mirror is synced with
+the list call of each endpoint, which returns the records changed since a date:
+
+* The first sync requests the records changed since `mirror.start_date`, and then since each
+  `mirror.initial_window_days` after it. A record is in the response of every date up to its change,
+  so its change date is known to within one window.
+* Later syncs request the records changed since the previous sync, so only what changed is fetched.
+
+The details of the new and changed records are then fetched concurrently, if `mirror.fetch_details`
+is set. Details that could not be fetched are fetched on the next sync.
+
+A data retrieval layer with a mirror serves tool calls from it, see `MirroredVinnovaAPI`. A list call
+since a date before `mirror.start_date` is passed on to the API. Executed
+as a script, the mirror of the DRL configuration file is synced.
+
+"""
+import json
+import sqlite3
+import asyncio
+import threading
+from datetime import date, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from vinnova_api import VinnovaAPI, AsyncVinnovaAPI, VinnovaHTTPTransport, run_in_background_loop
+from vinnova_api import build_vinnova_http_transport
+
+_SQL_CREATE = [
+    '''
+    CREATE TABLE IF NOT EXISTS record (
+        endpoint TEXT NOT NULL,
+        diarienummer TEXT NOT NULL,
+        entry TEXT NOT NULL,
+        details TEXT,
+        changed_after TEXT NOT NULL,
+        PRIMARY KEY (endpoint, diarienummer)
+    );
+    ''',
+    'CREATE INDEX IF NOT EXISTS record_changed_after ON record (endpoint, changed_after);',
+    '''
+    CREATE TABLE IF NOT EXISTS sync_window (
+        endpoint TEXT NOT NULL,
+        since_date TEXT NOT NULL,
+        PRIMARY KEY (endpoint, since_date)
+    );
+    ''',
+    'CREATE TABLE IF NOT EXISTS sync_state (endpoint TEXT PRIMARY KEY, last_sync_date TEXT NOT NULL);',
+]
+_SQL_UPSERT_RECORD = '''
+INSERT INTO record (endpoint, diarienummer, entry, details, changed_after) VALUES (?, ?, ?, NULL, ?)
+ON CONFLICT (endpoint, diarienummer) DO UPDATE SET
+    entry = excluded.entry,
+    details = CASE WHEN excluded.changed_after > record.changed_after THEN NULL ELSE record.details END,
+    changed_after = MAX(record.changed_after, excluded.changed_after);
+'''
+_SQL_INSERT_WINDOW = 'INSERT OR IGNORE INTO sync_window (endpoint, since_date) VALUES (?, ?);'
+_SQL_UPSERT_STATE = '''
+INSERT INTO sync_state (endpoint, last_sync_date) VALUES (?, ?)
+ON CONFLICT (endpoint) DO UPDATE SET last_sync_date = excluded.last_sync_date;
+'''
+_SQL_SELECT_STATE = 'SELECT last_sync_date FROM sync_state WHERE endpoint = ?;'
+_SQL_SELECT_WINDOW = 'SELECT MAX(since_date) FROM sync_window WHERE endpoint = ? AND since_date <= ?;'
+_SQL_SELECT_CHANGED = 'SELECT entry FROM record WHERE endpoint = ? AND changed_after >= ? ORDER BY diarienummer;'
+_SQL_SELECT_RECORDS = 'SELECT diarienummer, entry, details FROM record WHERE endpoint = ? ORDER BY diarienummer;'
+_SQL_SELECT_DETAILS = 'SELECT details FROM record WHERE endpoint = ? AND diarienummer = ?;'
+_SQL_SELECT_MISSING_DETAILS = 'SELECT diarienummer FROM record WHERE endpoint = ? AND details IS NULL;'
+_SQL_UPDATE_DETAILS = 'UPDATE record SET details = ? WHERE endpoint = ? AND diarienummer = ?;'
+
+
+class VinnovaMirror:
+    """The SQLite database of the mirror. It can be used from several threads.
+
+    Args:
+        path (str): The path to the SQLite database of the mirror
+
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL;')
+        for sql in _SQL_CREATE:
+            self._conn.execute(sql)
+        self._conn.commit()
+
+    def last_sync_date(self, endpoint: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(_SQL_SELECT_STATE, (endpoint,)).fetchone()
+        return row[0] if row is not None else None
+
+    def store_changed(self, endpoint: str, since_date: str, entries: List[Dict]):
+        """Store the records returned by the list call for the date, in one transaction
+
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(_SQL_UPSERT_RECORD, [
+                (endpoint, entry['Diarienummer'], json.dumps(entry), since_date) for entry in entries
+            ])
+            self._conn.execute(_SQL_INSERT_WINDOW, (endpoint, since_date))
+
+    def set_last_sync_date(self, endpoint: str, sync_date: str):
+        with self._lock, self._conn:
+            self._conn.execute(_SQL_UPSERT_STATE, (endpoint, sync_date))
+
+    def missing_details(self, endpoint: str) -> List[str]:
+        with self._lock:
+            return [diarienummer for diarienummer, in self._conn.execute(_SQL_SELECT_MISSING_DETAILS, (endpoint,))]
+
+    def store_details(self, endpoint: str, details: Dict[str, Union[Dict, List]]):
+        with self._lock, self._conn:
+            self._conn.executemany(_SQL_UPDATE_DETAILS, [
+                (json.dumps(payload), endpoint, diarienummer) for diarienummer, payload in details.items()
+            ])
+
+    def changed_since(self, endpoint: str, since_date: str) -> Optional[List[Dict]]:
+        """The records changed since the date, or None if the mirror cannot tell
+
+        The change date of a record is known to within the sync window it changed in, so records changed
+        in the window of the date, but before it, are included as well. The mirror cannot tell if the
+        endpoint has not been synced, or if the date is before the first sync window, since the records
+        changed before `mirror.start_date` and not after it are not in the mirror.
+
+        """
+        if self.last_sync_date(endpoint) is None:
+            return None
+        with self._lock:
+            window_date, = self._conn.execute(_SQL_SELECT_WINDOW, (endpoint, since_date)).fetchone()
+            if window_date is None:
+                return None
+            rows = self._conn.execute(_SQL_SELECT_CHANGED, (endpoint, window_date)).fetchall()
+        return [json.loads(entry) for entry, in rows]
+
+    def records(self, endpoint: str) -> Iterator[Tuple[str, Dict, Optional[Union[Dict, List]]]]:
+        """The Diarienummer, entry and details, None if not fetched, of each record of the endpoint
+
+        """
+        with self._lock:
+            rows = self._conn.execute(_SQL_SELECT_RECORDS, (endpoint,)).fetchall()
+        for diarienummer, entry, details in rows:
+            yield diarienummer, json.loads(entry), json.loads(details) if details is not None else None
+
+    def details(self, endpoint: str, diarienummer: str) -> Optional[Union[Dict, List]]:
+        """The details of the record, or None if they are not in the mirror
+
+        """
+        with self._lock:
+            row = self._conn.execute(_SQL_SELECT_DETAILS, (endpoint, diarienummer)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def close(self):
+        self._conn.close()
+
+
+class MirroredVinnovaAPI:
+    """A Vinnova API that is served from the mirror, and from the API when the mirror cannot answer
+
+    It is used in place of the `VinnovaAPI` of a data retrieval layer, so the decorators of the layer
+    apply to the records of the mirror as to the responses of the API.
+
+    Args:
+        mirror (VinnovaMirror): The mirror
+        vinnova_api (VinnovaAPI): The API, used when the mirror cannot answer
+        query (str): `list` for the records changed since a date, `details` for the details of a record
+
+    """
+    def __init__(self, mirror: VinnovaMirror, vinnova_api: VinnovaAPI, query: str):
+        if query not in ('list', 'details'):
+            raise ValueError(f'Unknown mirror query: {query}')
+        self.mirror = mirror
+        self.vinnova_api = vinnova_api
+        self.endpoint = vinnova_api.endpoint
+        self.query = query
+
+    def __call__(self, data: str) -> Union[Dict, List]:
+        if self.query == 'list':
+            payload = self.mirror.changed_since(self.endpoint, data)
+        else:
+            payload = self.mirror.details(self.endpoint, data)
+        if payload is None:
+            payload = self.vinnova_api(data)
+        return payload
+
+
+def _sync_dates(last_sync_date: Optional[str], start_date: str, initial_window_days: int, today: date) -> List[str]:
+    """The dates to request the records changed since, in increasing order
+
+    """
+    if last_sync_date is not None:
+        return [last_sync_date]
+    dates = []
+    since = date.fromisoformat(start_date)
+    while since < today:
+        dates.append(since.isoformat())
+        since += timedelta(days=initial_window_days)
+    return dates
+
+
+async def _fetch_details(api: AsyncVinnovaAPI, diarienummer: List[str], max_concurrency: int) -> Dict:
+    """Fetch the details of the records concurrently. The records that fail are left out
+
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _call(data: str):
+        async with semaphore:
+            try:
+                return data, await api(data)
+            except Exception as e:
+                print(f'Failed to fetch details of {api.endpoint}/{data}: {e}')
+                return data, None
+
+    results = await asyncio.gather(*(_call(data) for data in diarienummer))
+    return {data: payload for data, payload in results if payload is not None}
+
+
+def sync_vinnova_mirror(
+        api_conf_fp: str,
+        mirror: Optional[VinnovaMirror] = None,
+        transport: Optional[VinnovaHTTPTransport] = None,
+) -> Dict[str, Dict[str, int]]:
+    """Sync the mirror with the endpoints of the APIs of the configuration file
+
+    The response cache is not used, so the records are always as current as the API.
+
+    Args:
+        api_conf_fp (str): The path to the configuration file
+        mirror (Optional[VinnovaMirror]): The mirror. If not given, the one of the configuration file
+        transport (Optional[VinnovaHTTPTransport]): The HTTP transport. If not given, one is built from
+            the configuration file, if set there.
+
+    """
+    with open(api_conf_fp, 'r') as f:
+        api_conf = json.load(f)
+    mirror_conf = api_conf['mirror']
+    if mirror is None:
+        mirror = VinnovaMirror(mirror_conf['path'])
+    if transport is None and 'transport' in api_conf:
+        transport = build_vinnova_http_transport(api_conf['transport'])
+
+    endpoints = sorted({conf['endpoint'] for conf in api_conf['apis'].values()})
+    today = date.today()
+    report = {}
+    for endpoint in endpoints:
+        list_api = VinnovaAPI(endpoint, transport=transport)
+        n_changed = 0
+        for since_date in _sync_dates(
+                mirror.last_sync_date(endpoint),
+                mirror_conf['start_date'],
+                mirror_conf['initial_window_days'],
+                today,
+        ):
+            entries = list_api(since_date)
+            mirror.store_changed(endpoint, since_date, entries)
+            n_changed = max(n_changed, len(entries))
+        list_api.close()
+        mirror.set_last_sync_date(endpoint, today.isoformat())
+
+        n_details = 0
+        if mirror_conf.get('fetch_details', True):
+            details_api = AsyncVinnovaAPI(endpoint, transport=transport)
+            details = run_in_background_loop(_fetch_details(
+                details_api, mirror.missing_details(endpoint), api_conf.get('max_concurrency', 8),
+            ))
+            details_api.close()
+            mirror.store_details(endpoint, details)
+            n_details = len(details)
+
+        report[endpoint] = {'n_changed': n_changed, 'n_details': n_details}
+        print(f'Synced {endpoint}: {n_changed} records changed, {n_details} details fetched')
+
+    return report
+
+
+if __name__ == '__main__':
+    sync_vinnova_mirror('vinnova_drl_conf.json')
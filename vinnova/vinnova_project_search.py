@@ -0,0 +1,338 @@
+"""Local semantic search over the Vinnova projects
+
+The titles and descriptions of the projects in the local mirror, see `vinnova_mirror.py`, are embedded
+with a sentence transformer and stored in an SQLite database, one normalized vector per project. A
+natural-language query is embedded with the same model and the projects with the highest cosine
+similarity are returned, so the LLM gets the top-k matching projects rather than a full project list.
+
+This is the approach of the semantic search in `swe_semantic_search`: the same embedding models, the
+normalized vectors searched with an inner product and `argpartition`, as the `numpy` backend there,
+and a content hash and the model name recorded per project, so the index is refreshed incrementally.
+A refresh embeds only the new and changed projects of the mirror and deletes the projects no longer
+in it.
+
+The index is built and refreshed outside the tool calls, by executing this module as a script after
+the mirror is synced, or with `VinnovaProjectSearchAPI.refresh`, e.g. on a background thread. A tool
+call only embeds the query, and reloads the vectors if the index database has been changed since they
+were loaded, so new projects are found after the next refresh. A tool call on an empty index raises
+`VinnovaProjectSearchIndexEmptyError`, so the LLM is told that the search is not available rather than
+that no project matches.
+
+The fields of a project that are embedded and returned are set in the `project_search` section of the
+DRL configuration file. The fields of the details of a project take precedence over those of its list
+entry. Executed as a script, the mirror is synced and the index refreshed.
+
+"""
+import json
+import sqlite3
+import hashlib
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from vinnova_mirror import VinnovaMirror, sync_vinnova_mirror
+
+_SQL_CREATE = '''
+CREATE TABLE IF NOT EXISTS project (
+    diarienummer TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    model_name TEXT NOT NULL,
+    vector BLOB NOT NULL,
+    payload TEXT NOT NULL
+);
+'''
+_SQL_SELECT_STATE = 'SELECT diarienummer, content_hash, model_name FROM project;'
+_SQL_SELECT_VECTORS = 'SELECT diarienummer, vector, payload FROM project WHERE model_name = ? ORDER BY diarienummer;'
+_SQL_UPSERT = '''
+INSERT INTO project (diarienummer, content_hash, model_name, vector, payload) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (diarienummer) DO UPDATE SET
+    content_hash = excluded.content_hash, model_name = excluded.model_name, vector = excluded.vector,
+    payload = excluded.payload;
+'''
+_SQL_DELETE = 'DELETE FROM project WHERE diarienummer = ?;'
+
+
+class VinnovaProjectSearchIndexEmptyError(Exception):
+    pass
+
+
+def _project_fields(entry: Dict, details: Optional[Union[Dict, List]]) -> Dict:
+    """The fields of the project, from its list entry and its details if fetched
+
+    """
+    if isinstance(details, list):
+        details = details[0] if len(details) > 0 else None
+    if isinstance(details, dict):
+        return {**entry, **details}
+    return entry
+
+
+def project_text(fields: Dict, text_fields: List[str]) -> str:
+    """The text of the project that is embedded, the non-empty text fields one per line
+
+    """
+    return '\n'.join(str(fields[key]).strip() for key in text_fields if fields.get(key) and str(fields[key]).strip())
+
+
+def _content_hash(text: str, payload: Dict) -> str:
+    hasher = hashlib.sha256()
+    hasher.update(text.encode('utf-8'))
+    hasher.update(b'\x00')
+    hasher.update(json.dumps(payload, sort_keys=True).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+class VinnovaProjectIndex:
+    """The vectors of the projects in SQLite, searched in memory
+
+    The vectors of the model are loaded in a matrix when the index is opened and after it is changed,
+    also by another connection to the database, see `changed`.
+
+    Args:
+        path (str): The path to the SQLite database of the index
+        model_name (str): The name of the embedding model. Vectors of other models are not searched.
+
+    """
+    def __init__(self, path: str, model_name: str):
+        self.path = path
+        self.model_name = model_name
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(_SQL_CREATE)
+        self._conn.commit()
+        self._diarienummer = []
+        self._payloads = []
+        self._vectors = None
+        self._load()
+
+    def _data_version(self) -> int:
+        return self._conn.execute('PRAGMA data_version;').fetchone()[0]
+
+    def _load(self):
+        self._loaded_data_version = self._data_version()
+        rows = self._conn.execute(_SQL_SELECT_VECTORS, (self.model_name,)).fetchall()
+        self._diarienummer = [diarienummer for diarienummer, _, _ in rows]
+        self._payloads = [json.loads(payload) for _, _, payload in rows]
+        if len(rows) > 0:
+            self._vectors = np.stack([np.frombuffer(vector, dtype=np.float32) for _, vector, _ in rows])
+        else:
+            self._vectors = None
+
+    def __len__(self):
+        return len(self._diarienummer)
+
+    def state(self) -> Dict[str, Tuple[str, str]]:
+        """Return the content hash and model name per Diarienummer
+
+        """
+        return {
+            diarienummer: (hash_value, model_name)
+            for diarienummer, hash_value, model_name in self._conn.execute(_SQL_SELECT_STATE)
+        }
+
+    def upsert(self, diarienummer: List[str], content_hashes: List[str], vectors: np.ndarray, payloads: List[Dict]):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        self._conn.executemany(_SQL_UPSERT, [
+            (key, hash_value, self.model_name, vector.tobytes(), json.dumps(payload))
+            for key, hash_value, vector, payload in zip(diarienummer, content_hashes, vectors, payloads)
+        ])
+        self._conn.commit()
+
+    def delete(self, diarienummer: List[str]):
+        self._conn.executemany(_SQL_DELETE, [(key,) for key in diarienummer])
+        self._conn.commit()
+
+    def reload(self):
+        self._load()
+
+    def changed(self) -> bool:
+        """Whether the database has been changed by another connection, such as the script that refreshes
+        the index, since the vectors were loaded
+
+        """
+        return self._data_version() != self._loaded_data_version
+
+    def search(self, query_vector: np.ndarray, k: int) -> List[Tuple[str, float, Dict]]:
+        """The Diarienummer, cosine similarity and payload of the k projects most similar to the query
+
+        """
+        k = min(k, len(self))
+        if k == 0:
+            return []
+        query_vector = np.asarray(query_vector, dtype=np.float32).ravel()
+        query_vector = query_vector / max(float(np.linalg.norm(query_vector)), 1e-12)
+        scores = self._vectors @ query_vector
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self._diarienummer[row], float(scores[row]), self._payloads[row]) for row in top]
+
+    def close(self):
+        self._conn.close()
+
+
+def _load_embedding_model(model_name_or_path: str, cache_folder: Optional[str]):
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name_or_path=model_name_or_path, cache_folder=cache_folder)
+
+
+class VinnovaProjectSearchAPI:
+    """The semantic search over the projects of the mirror, used in place of the `VinnovaAPI` of a
+    data retrieval layer. It can be used from several threads.
+
+    The embedding model is loaded at the first call. The calls do not embed the projects, the index is
+    built with `refresh`, which can run while the index is searched.
+
+    Args:
+        mirror (VinnovaMirror): The mirror the projects are read from
+        index (VinnovaProjectIndex): The index of the project vectors
+        endpoint (str): The endpoint of the projects in the mirror
+        text_fields (List[str]): The fields of a project that are embedded
+        payload_fields (List[str]): The fields of a project that are returned
+        model_name_or_path (str): The sentence transformer model
+        cache_folder (Optional[str]): The folder the model is downloaded to
+        query_prefix (str): The prefix of the queries, as the model expects
+        passage_prefix (str): The prefix of the project texts, as the model expects
+        n_results (int): The number of projects returned
+        batch_size (int): The number of projects embedded at a time
+
+    """
+    def __init__(self,
+                 mirror: VinnovaMirror,
+                 index: VinnovaProjectIndex,
+                 endpoint: str,
+                 text_fields: List[str],
+                 payload_fields: List[str],
+                 model_name_or_path: str,
+                 cache_folder: Optional[str] = None,
+                 query_prefix: str = '',
+                 passage_prefix: str = '',
+                 n_results: int = 10,
+                 batch_size: int = 64,
+                 ):
+        self.mirror = mirror
+        self.index = index
+        self.endpoint = endpoint
+        self.text_fields = text_fields
+        self.payload_fields = payload_fields
+        self.model_name_or_path = model_name_or_path
+        self.cache_folder = cache_folder
+        self.query_prefix = query_prefix
+        self.passage_prefix = passage_prefix
+        self.n_results = n_results
+        self.batch_size = batch_size
+        self.cache = None
+        self.transport = None
+        self.stream = False
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        with self._model_lock:
+            if self._model is None:
+                self._model = _load_embedding_model(self.model_name_or_path, self.cache_folder)
+        return self._model
+
+    def refresh(self) -> Dict[str, int]:
+        """Embed the new and changed projects of the mirror and delete the projects no longer in it
+
+        A project is changed if its text or payload is, or if it was embedded with another model.
+        Projects without text are not indexed. The projects are embedded without holding the lock of
+        the index, so the search is only held up while a batch is written.
+
+        """
+        with self._refresh_lock:
+            return self._refresh()
+
+    def _refresh(self) -> Dict[str, int]:
+        with self._lock:
+            state = self.index.state()
+        present = set()
+        to_embed = []
+        for diarienummer, entry, details in self.mirror.records(self.endpoint):
+            fields = _project_fields(entry, details)
+            text = project_text(fields, self.text_fields)
+            if len(text) == 0:
+                continue
+            present.add(diarienummer)
+            payload = {key: fields[key] for key in self.payload_fields if key in fields}
+            hash_value = _content_hash(self.passage_prefix + text, payload)
+            if state.get(diarienummer) != (hash_value, self.model_name_or_path):
+                to_embed.append((diarienummer, text, hash_value, payload))
+
+        for start in range(0, len(to_embed), self.batch_size):
+            batch = to_embed[start:start + self.batch_size]
+            vectors = self.model.encode([self.passage_prefix + text for _, text, _, _ in batch], batch_size=self.batch_size)
+            with self._lock:
+                self.index.upsert(
+                    diarienummer=[diarienummer for diarienummer, _, _, _ in batch],
+                    content_hashes=[hash_value for _, _, hash_value, _ in batch],
+                    vectors=vectors,
+                    payloads=[payload for _, _, _, payload in batch],
+                )
+
+        stale = [diarienummer for diarienummer in state if diarienummer not in present]
+        with self._lock:
+            if len(stale) > 0:
+                self.index.delete(stale)
+            if len(to_embed) > 0 or len(stale) > 0:
+                self.index.reload()
+
+        return {'n_projects': len(present), 'n_embedded': len(to_embed), 'n_deleted': len(stale)}
+
+    def __call__(self, data: str) -> List[Dict]:
+        """The projects most similar to the query, each its payload fields and similarity `score`
+
+        Raises `VinnovaProjectSearchIndexEmptyError` if there are no projects in the index.
+
+        """
+        with self._lock:
+            if self.index.changed():
+                self.index.reload()
+            if len(self.index) == 0:
+                raise VinnovaProjectSearchIndexEmptyError(
+                    'The project search index is empty. Build it with `python vinnova_project_search.py`')
+        query_vector = self.model.encode([self.query_prefix + data])[0]
+        with self._lock:
+            hits = self.index.search(query_vector, self.n_results)
+        return [{**payload, 'score': round(score, 4)} for _, score, payload in hits]
+
+    def close(self):
+        self.index.close()
+
+
+def build_vinnova_project_search_api(search_conf: Dict, mirror: VinnovaMirror) -> VinnovaProjectSearchAPI:
+    """Build the project search from the `project_search` section of the DRL configuration file
+
+    Args:
+        search_conf (Dict): The project search configuration
+        mirror (VinnovaMirror): The mirror the projects are read from
+
+    """
+    return VinnovaProjectSearchAPI(
+        mirror=mirror,
+        index=VinnovaProjectIndex(search_conf['path'], search_conf['model_name_or_path']),
+        endpoint=search_conf.get('endpoint', 'projekt'),
+        text_fields=search_conf['text_fields'],
+        payload_fields=search_conf['payload_fields'],
+        model_name_or_path=search_conf['model_name_or_path'],
+        cache_folder=search_conf.get('cache_folder'),
+        query_prefix=search_conf.get('query_prefix', ''),
+        passage_prefix=search_conf.get('passage_prefix', ''),
+        n_results=search_conf.get('n_results', 10),
+        batch_size=search_conf.get('batch_size', 64),
+    )
+
+
+if __name__ == '__main__':
+    with open('vinnova_drl_conf.json', 'r') as f:
+        api_conf = json.load(f)
+    mirror = VinnovaMirror(api_conf['mirror']['path'])
+    sync_vinnova_mirror('vinnova_drl_conf.json', mirror=mirror)
+    search_api = build_vinnova_project_search_api(api_conf['project_search'], mirror)
+    print(search_api.refresh())
+    search_api.close()
+    mirror.close()